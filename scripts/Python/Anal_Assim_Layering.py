@@ -0,0 +1,258 @@
+"""Anal_Assim_Layering
+In-process equivalent of layer_anal_assim.ncl, the layering of RAP,
+HRRR and MRMS (precipitation) data for the analysis and assimilation
+configuration.  Selected with [layering] analysis_assimilation_engine =
+python.
+
+MRMS precipitation is mostly zero.  It is taken as a
+Regrid_Engine.SparseField (its nonzero and missing cells, written with
+the regridded MRMS file by the sparse regrid kernel, or found in the
+dense field otherwise), and the gap-filling blend of the NCL script
+
+   rain = RAP*wR*bR + HRRR*wH*bH + MRMS*wM*bM, with the missing terms
+   dropped (RAP alone where both HRRR and MRMS are missing)
+
+is computed as the RAP/HRRR part everywhere plus the MRMS term at the
+nonzero MRMS cells only: a missing or zero MRMS term adds nothing.  On
+a dry hour the MRMS part costs nothing.
+"""
+
+import time
+import numpy as np
+from netCDF4 import Dataset
+import WhfLog
+import Grib2_Index as gi
+import Grib2_Reader as gr
+import Regrid_Engine as rge
+from ForcingEngineError import UnrecognizedCommandError
+
+# Fill value of the layered output, as in layer_anal_assim.ncl
+OUT_FILL = 1.e+20
+
+# Layered fields: (name, units, long name, from the 0hr (True) or 3hr
+# (False) forecast files)
+LAYERED_FIELDS = [
+   ('T2D', 'K', '2-m Air Temperature', True),
+   ('Q2D', 'kg/kg', '2-m specific humidity', True),
+   ('U2D', 'm/s', '10-m U-wind component', True),
+   ('V2D', 'm/s', '10-m V-wind component', True),
+   ('PSFC', 'Pa', 'Surface Pressure', True),
+   ('RAINRATE', 'mm s^-1', 'RAINRATE', False),
+   ('LWDOWN', 'W/m^2', 'Surface downward longwave radiation', False),
+   ('SWDOWN', 'W/m^2', 'Surface downward shortwave radiation', False),
+]
+
+#----------------------------------------------------------------------------
+def read_ldasin(ncFile, names, dtype=np.float64):
+   """2D fields of a regridded or downscaled file
+
+   Parameters
+   ----------
+   ncFile: str
+      netCDF file
+   names: list
+      Variable names
+   dtype: numpy.dtype
+      Type of the returned fields
+
+   Returns
+   -------
+   dict
+      name -> numpy.ma.MaskedArray of dtype, masked where missing
+   """
+   ret = {}
+   nc = Dataset(ncFile, 'r')
+   try:
+      for name in names:
+         values = np.ma.asarray(nc.variables[name][:]).astype(dtype)
+         ret[name] = values.reshape(values.shape[-2:])
+   finally:
+      nc.close()
+   return ret
+
+#----------------------------------------------------------------------------
+def read_param(gribFile, dtype=np.float64):
+   """Bias correction or weight grid of the QPE blending (the first
+   message of its GRIB2 file)
+
+   Returns
+   -------
+   numpy.ma.MaskedArray
+      dtype, masked where missing
+   """
+   inventory = gi.get_inventory(gribFile)
+   f = open(gribFile, 'rb')
+   try:
+      values = gr.decode_message(f, inventory[0])
+   finally:
+      f.close()
+   return np.ma.asarray(values).astype(dtype)
+
+#----------------------------------------------------------------------------
+def read_mrms(ncFile):
+   """MRMS precipitation rate of a regridded MRMS file as a SparseField"""
+   sparse = rge.read_sparse(ncFile, 'precip_rate')
+   if sparse is None:
+      sparse = rge.sparse_from_dense(read_ldasin(ncFile, ['precip_rate'])['precip_rate'])
+   sparse.debugPrint()
+   return sparse
+
+#----------------------------------------------------------------------------
+def gap_fill(primary, backup, index):
+   """primary with the backup values at index (flat indices)"""
+   out = primary.copy().reshape(-1)
+   out[index] = backup.reshape(-1)[index]
+   return out.reshape(primary.shape)
+
+#----------------------------------------------------------------------------
+def blend_precip(rainRAP, rainHRRR, mrms, params):
+   """Gap-filling blend of RAP, HRRR and MRMS precipitation
+
+   Parameters
+   ----------
+   rainRAP: numpy.ma.MaskedArray
+      RAP RAINRATE (3hr forecast)
+   rainHRRR: numpy.ma.MaskedArray
+      HRRR RAINRATE (3hr forecast)
+   mrms: Regrid_Engine.SparseField
+      MRMS precip_rate
+   params: dict
+      'rapB', 'hrrrB', 'mrmsB', 'rapW', 'hrrrW', 'mrmsW' -> parameter
+      grids, as named by the files they come from
+
+   Returns
+   -------
+   numpy.ma.MaskedArray
+      Blended RAINRATE
+   """
+   # The NCL script reads the MRMS weight from the MRMS bias file and
+   # the MRMS bias from the MRMS weight file; kept as is.  Missing bias
+   # values are 1 (no correction).
+   wR = params['rapW']
+   wH = params['hrrrW']
+   wM = params['mrmsB']
+   bR = params['rapB'].filled(1.0)
+   bH = params['hrrrB'].filled(1.0)
+   bM = params['mrmsW'].filled(1.0)
+
+   rr = rainRAP*wR*bR
+   hh = rainHRRR*wH*bH
+   # RAP + HRRR, RAP alone where HRRR is missing
+   rain = rr + hh.filled(0.0)
+   rain = np.ma.array(rain.filled(0.0), mask=np.ma.getmaskarray(rr))
+
+   # + MRMS where its term is there: nonzero MRMS cells with a weight,
+   # and a RAP/HRRR value to add to
+   cells = mrms._index
+   wMCells = wM.reshape(-1)[cells]
+   valid = ~np.ma.getmaskarray(wMCells) & ~rain.mask.reshape(-1)[cells]
+   cells = cells[valid]
+   mm = mrms._values[valid].astype(rain.dtype)*np.ma.getdata(wMCells)[valid]* \
+        bM.reshape(-1)[cells]
+   rain.data.reshape(-1)[cells] += mm
+   WhfLog.debug("MRMS blended at %d of %d cells", len(cells), rain.size)
+   return rain
+
+#----------------------------------------------------------------------------
+def layer(process, files, outPath, precision='double'):
+   """Layer RAP, HRRR and MRMS data into one LDASIN file
+
+   Parameters
+   ----------
+   process: int
+      1: RAP only, 2: RAP and HRRR, 3: RAP, HRRR and MRMS precipitation
+   files: dict
+      'rap0', 'rap3', 'hrrr0', 'hrrr3', 'mrms' -> downscaled/regridded
+      files, 'rapB', 'hrrrB', 'mrmsB', 'rapW', 'hrrrW', 'mrmsW' -> QPE
+      blending parameter files (as for layer_anal_assim.ncl)
+   outPath: str
+      Output file
+   precision: str
+      'double' to layer and write in double, as the NCL script, 'single'
+      in float (see Regrid_Engine.PRECISIONS)
+
+   Returns
+   -------
+   None
+   """
+   if process not in [1, 2, 3]:
+      WhfLog.error("Invalid layering process %d", process)
+      raise UnrecognizedCommandError('Invalid layering process %d'%process)
+   start = time.time()
+   dtype = rge.PRECISIONS[precision]
+   names0 = [f[0] for f in LAYERED_FIELDS if f[3]]
+   names3 = [f[0] for f in LAYERED_FIELDS if not f[3]]
+   rap = read_ldasin(files['rap0'], names0, dtype)
+   rap.update(read_ldasin(files['rap3'], names3, dtype))
+   if process == 1:
+      layered = rap
+   else:
+      hrrr = read_ldasin(files['hrrr0'], names0, dtype)
+      hrrr.update(read_ldasin(files['hrrr3'], names3, dtype))
+      # RAP where HRRR has no data (outside its domain)
+      index = np.flatnonzero(np.ma.getmaskarray(hrrr['T2D']))
+      layered = {}
+      for name in names0 + names3:
+         layered[name] = gap_fill(hrrr[name], rap[name], index)
+      if process == 3:
+         params = {}
+         for key in ['rapB', 'hrrrB', 'mrmsB', 'rapW', 'hrrrW', 'mrmsW']:
+            params[key] = read_param(files[key], dtype)
+         layered['RAINRATE'] = blend_precip(rap['RAINRATE'], hrrr['RAINRATE'],
+                                            read_mrms(files['mrms']), params)
+   write_layered(outPath, layered, precision)
+   WhfLog.info("Time(sec) to layer (process %d) %s", process, time.time() - start)
+
+#----------------------------------------------------------------------------
+def write_layered(outPath, fields, precision='double'):
+   """Write the layered fields as layer_anal_assim.ncl does
+
+   Parameters
+   ----------
+   outPath: str
+      Output file
+   fields: dict
+      name -> 2D field for each LAYERED_FIELDS entry
+   precision: str
+      'double' for double variables, as the NCL script, 'single' for float
+
+   Returns
+   -------
+   None
+   """
+   dtype = rge.PRECISIONS[precision]
+   fill = dtype(OUT_FILL)
+   (ny, nx) = fields['T2D'].shape
+   nc = Dataset(outPath, 'w', format='NETCDF3_64BIT_OFFSET')
+   try:
+      nc.title = "Combined HRRR/RAP/MRMS forcing for Analysis and Assimilation WRF-Hydro configuration"
+      nc.creation_date = time.strftime('%a %b %d %H:%M:%S %Z %Y')
+      nc.author = "National Center for Atmospheric Research"
+      nc.Conventions = "None"
+      nc.createDimension('Time', None)
+      nc.createDimension('south_north', ny)
+      nc.createDimension('west_east', nx)
+      for (name, units, longName, zeroHour) in LAYERED_FIELDS:
+         var = nc.createVariable(name, dtype, ('Time', 'south_north', 'west_east'),
+                                 fill_value=fill)
+         var.missing_value = fill
+         var.remap = "remapped via ESMF_regrid_with_weights: Bilinear"
+         var.units = units
+         var.long_name = longName
+         if name == 'RAINRATE':
+            var.description = "RAINRATE"
+         var[0, :, :] = np.ma.asarray(fields[name]).astype(dtype).filled(fill)
+   finally:
+      nc.close()
+
+#----------------------------------------------------------------------------
+def get_layering_engine(parser):
+   """Analysis and assimilation layering engine, [layering]
+   analysis_assimilation_engine: 'ncl' (the default) or 'python'"""
+   if not parser.has_option('layering', 'analysis_assimilation_engine'):
+      return 'ncl'
+   engine = parser.get('layering', 'analysis_assimilation_engine').strip().lower()
+   if engine not in ['ncl', 'python']:
+      WhfLog.error("Unrecognized layering engine %s", engine)
+      raise UnrecognizedCommandError('Unrecognized layering engine %s'%engine)
+   return engine
@@ -2,6 +2,7 @@ import WRF_Hydro_forcing as whf
 import DataFiles as df
 import WhfLog
 import os
+import time
 from ConfigParser import SafeConfigParser
 import sys
 import datetime
@@ -380,12 +381,27 @@ def anal_assim_layer(cycleYYYYMMDDHH,fhr,action,config):
                  hrrrW_param + mrmsW_param + rapW_param + \
                  hrrr0_param + hrrr3_param + rap0_param + rap3_param + \
                  mrms_param + process_param + out_param
-    cmd = ncl_exec + " -Q " + cmd_params + " " + layer_exe
-    status = os.system(cmd)
+    import Anal_Assim_Layering as aal
+    if aal.get_layering_engine(parser) == 'python':
+        # Layer in-process, MRMS precipitation blended over its
+        # nonzero cells only
+        files = {'rap0': rap0Path, 'rap3': rap3Path, 'hrrr0': hrrr0Path,
+                 'hrrr3': hrrr3Path, 'mrms': mrmsPath,
+                 'rapB': rapBiasPath, 'hrrrB': hrrrBiasPath,
+                 'mrmsB': mrmsBiasPath, 'rapW': rapWgtPath,
+                 'hrrrW': hrrrWgtPath, 'mrmsW': mrmsWgtPath}
+        import Regrid_Engine as rge
+        import Stage_Pipeline as sp
+        start = time.time()
+        aal.layer(process, files, LDASIN_path_tmp, rge.get_precision(parser))
+        sp.log_stage('layer', start)
+    else:
+        cmd = ncl_exec + " -Q " + cmd_params + " " + layer_exe
+        status = os.system(cmd)
 
-    if status != 0:
-        WhfLog.error("Error in combinining NCL program")
-        raise NCLError("NCL error encountered while combining in AA")
+        if status != 0:
+            WhfLog.error("Error in combinining NCL program")
+            raise NCLError("NCL error encountered while combining in AA")
    
     # Double check to make sure file was created, delete temporary regridded file
     whf.file_exists(LDASIN_path_tmp)
@@ -0,0 +1,136 @@
+"""Domain_Config
+Several WRF-Hydro domains (CONUS and regional nests) run from one parm
+file.  The parm file describes the first domain as before; [domains]
+extra_domains lists the others, and each of those has sections named
+<section>:<domain> (e.g. [regridding:d02], [downscaling:d02]) whose
+options replace the options of <section> for that domain: destination
+grid, weight files, hgt/geo files, output roots, state files.  Options
+not overridden are shared.
+
+The forcing scripts are unchanged and run once per domain, each with a
+config file holding the merged options of its domain.  Those files are
+written (only when their content changes) to [domains]
+domain_config_dir, by default next to the parm file, as
+<parm file name>.<domain>; the layering drivers can be run with them
+as well.  Regrid_Driver decodes each input file once for all the
+domains (WRF_Hydro_forcing.regrid_data_domains) before running them.
+"""
+
+import os
+import tempfile
+from StringIO import StringIO
+from ConfigParser import SafeConfigParser
+import WhfLog
+
+# Separates the section and the domain in the name of a domain section
+SEPARATOR = ':'
+
+#----------------------------------------------------------------------------
+def get_domain_names(parser):
+   """Names of the domains besides the first one, [domains] extra_domains
+   (comma separated), empty if not set"""
+   if not parser.has_option('domains', 'extra_domains'):
+      return []
+   names = parser.get('domains', 'extra_domains').split(',')
+   return [name.strip() for name in names if name.strip()]
+
+#----------------------------------------------------------------------------
+def domain_parser(parser, domain):
+   """Parser of one domain
+
+   Parameters
+   ----------
+   parser: ConfigParser
+      Parser to the config/parm file
+   domain: str
+      Domain name, from get_domain_names
+
+   Returns
+   -------
+   SafeConfigParser
+      All the sections of parser (but the domain sections), with the
+      options of the <section>:<domain> sections in place of theirs
+   """
+   merged = SafeConfigParser()
+   for (option, value) in parser.defaults().items():
+      merged.set('DEFAULT', option, value)
+   for section in parser.sections():
+      if SEPARATOR in section:
+         continue
+      merged.add_section(section)
+      for (option, value) in parser.items(section, True):
+         merged.set(section, option, value)
+   for section in parser.sections():
+      (base, sep, name) = section.partition(SEPARATOR)
+      if name.strip() != domain:
+         continue
+      if not merged.has_section(base):
+         merged.add_section(base)
+      for option in parser.options(section):
+         merged.set(base, option, parser.get(section, option, True))
+   return merged
+
+#----------------------------------------------------------------------------
+def write_domain_config(parser, configFile, domain):
+   """Write the config file of one domain if its content changed
+
+   Parameters
+   ----------
+   parser: ConfigParser
+      Parser to configFile
+   configFile: str
+      The config/parm file
+   domain: str
+      Domain name
+
+   Returns
+   -------
+   str
+      Config file of the domain
+   """
+   configDir = os.path.dirname(os.path.abspath(configFile))
+   if parser.has_option('domains', 'domain_config_dir'):
+      configDir = parser.get('domains', 'domain_config_dir').strip()
+   domainFile = os.path.join(configDir, os.path.basename(configFile) + '.' + domain)
+
+   content = StringIO()
+   content.write('# Written from %s for domain %s, do not edit\n' %
+                 (os.path.abspath(configFile), domain))
+   domain_parser(parser, domain).write(content)
+   content = content.getvalue()
+   if os.path.exists(domainFile) and open(domainFile).read() == content:
+      return domainFile
+
+   if not os.path.exists(configDir):
+      os.makedirs(configDir)
+   fd, tmpName = tempfile.mkstemp(dir=configDir,
+                                  prefix='.' + os.path.basename(domainFile))
+   f = os.fdopen(fd, 'w')
+   try:
+      f.write(content)
+   finally:
+      f.close()
+   os.chmod(tmpName, 0644)
+   os.rename(tmpName, domainFile)
+   WhfLog.info("Wrote config file %s of domain %s", domainFile, domain)
+   return domainFile
+
+#----------------------------------------------------------------------------
+def domain_configs(configFile):
+   """Config files of all the domains of a config/parm file
+
+   Parameters
+   ----------
+   configFile: str
+      The config/parm file
+
+   Returns
+   -------
+   list
+      configFile itself (the first domain), then the config file of each
+      of the extra domains
+   """
+   parser = SafeConfigParser()
+   parser.read(configFile)
+   return [configFile] + [write_domain_config(parser, configFile, domain)
+                          for domain in get_domain_names(parser)]
@@ -0,0 +1,756 @@
+"""Downscale_Engine
+In-process equivalent of All_WRF_Hydro_downscale.ncl (and its 0hr
+version) followed by topo_adj.ncl, and of CFSv2_downscale_conus.ncl,
+for regridded fields held in memory (the fused pipeline) or read from a
+regridded file ([downscaling] <product>_downscale_engine = python).
+The downscaling is the height correction of the NCL scripts:
+
+   T2D  += DHGT*lapse/1000
+   PSFC += DHGT*PSFC/287.05/T2D*9.8
+   Q2D   = specific humidity at the new T2D and PSFC, keeping the
+           relative humidity (capped at 100%) of the input
+
+with DHGT the source model terrain (hgt file) minus the WRF-Hydro
+terrain (HGT_M of the geo file) and the lapse rate from the lapse rate
+file (6.49 K/km if there is none).  DHGT*lapse/1000 and DHGT*9.8/287.05
+do not change between forecasts and are computed once per process, or
+once for all processes with the terrain cache (Terrain_Cache, [downscaling]
+terrain_cache_dir).  The other fields pass through.  The
+shortwave adjustment is the terrain slope/aspect correction of
+topo_adj.f90 (no shading, no diffuse fraction, as called from
+topo_adj.ncl), at the valid time of the output file, or the Fortran
+routine itself called through Topo_Adj ([downscaling]
+shortwave_adjust_library).
+
+The humidity conversions use the formulas of NCL's mixhum_ptrh for the
+saturation mixing ratio in both directions, so Q2D is returned unchanged
+where DHGT is 0.  Cells missing (FILL_VALUE) in any input of a field are
+missing in the output.
+
+Tolerances against the NCL output: T2D and PSFC are the same expressions
+computed in float64 (NCL computes in the float type of the inputs), so
+they differ by float32 rounding only.  mixhum_ptrh is matched to
+rounding.  NCL's relhum interpolates a table of saturation vapour
+pressures instead of the Tetens formula of mixhum_ptrh; against
+tabulated (Goff-Gratch) values over water the formula is within 0.2%
+from -15 C to 45 C and 2.5% low at -40 C, which bounds the relative Q2D
+difference where DHGT is not 0 (the relative humidity cap at 100% aside).
+
+In single precision ([precision] mode = single) the height correction
+runs in float32 and the CFSv2 output is float; against the double path
+T2D and PSFC differ by a few float32 roundings (relative 1e-6) and Q2D
+by the float32 rounding of the exponential (relative 1e-5), well under
+the precision of the forcing data; Precision_Check measures them on a
+real file.
+"""
+
+import os
+import re
+import math
+import time
+import datetime
+import numpy as np
+from netCDF4 import Dataset
+import WhfLog
+import Regrid_Engine as rge
+from Regrid_Engine import FILL_VALUE
+from ForcingEngineError import MissingFileError
+from ForcingEngineError import FilenameMatchError
+
+# Lapse rate (K/km) when there is no lapse rate file, as in the NCL script
+DEFAULT_LAPSE = 6.49
+
+# Gas constant of dry air (J/kg/K) and gravity (m/s2), as in the NCL script
+RD = 287.05
+GRAVITY = 9.8
+
+# Saturation vapour pressure constants of NCL's mixhum_ptrh
+_T0 = 273.15
+_EP = 0.622
+_ONEMEP = 0.378
+_ES0 = 6.11
+_A = 17.269
+_B = 35.86
+
+# Output fields in the order the NCL script writes them
+DOWNSCALED_FIELDS = ['T2D', 'Q2D', 'U2D', 'V2D', 'PSFC', 'RAINRATE',
+                     'SWDOWN', 'LWDOWN']
+
+# Fields of the CFSv2 output: (name, units, long name), in the order
+# CFSv2_downscale_conus.ncl writes them, and their fill value
+CFS_FIELDS = [
+   ('T2D', 'K', '2-m Air Temperature'),
+   ('Q2D', 'kg/kg', '2-m specific humidity'),
+   ('U2D', 'm/s', '10-m U-wind component'),
+   ('V2D', 'm/s', '10-m V-wind component'),
+   ('PSFC', 'Pa', 'Surface Pressure'),
+   ('RAINRATE', 'mm s^-1', 'RAINRATE'),
+   ('LWDOWN', 'W/m^2', 'Surface downward longwave radiation'),
+   ('SWDOWN', 'W/m^2', 'Surface downward shortwave radiation'),
+]
+CFS_FILL = 1.e+20
+
+# Static terrain terms of the shortwave adjustment, see geometry_terms
+GEOMETRY_TERMS = ['sin_lat', 'cos_lat', 'sin_lon', 'cos_lon', 'term_cos',
+                  'term_sin', 'term_decl', 'flat']
+
+# Terrain and geometry already read by this process, keyed by files
+_terrain = {}
+_geometry = {}
+
+#----------------------------------------------------------------------------
+def _read_2d(ncFile, name):
+   """First 2D slice of a variable of a netCDF file, as float32"""
+   if not os.path.exists(ncFile):
+      WhfLog.error('File: ' + ncFile + ' not found.')
+      raise MissingFileError('File %s not found'%ncFile)
+   nc = Dataset(ncFile, 'r')
+   try:
+      values = np.ma.filled(nc.variables[name][:], np.nan)
+   finally:
+      nc.close()
+   values = np.asarray(values, dtype=np.float32)
+   return values.reshape(values.shape[-2:])
+
+#----------------------------------------------------------------------------
+def static_terrain(hgtFile, geoFile, lapseFile):
+   """Static terms of the height correction, which do not change between
+   forecasts
+
+   Parameters
+   ----------
+   hgtFile: str
+      Source model terrain on the WRF-Hydro grid (HGT)
+   geoFile: str
+      WRF-Hydro geo file (HGT_M)
+   lapseFile: str
+      Lapse rate file (lapse, K/km), DEFAULT_LAPSE if it does not exist
+
+   Returns
+   -------
+   tuple
+      (DHGT float32 (m), DHGT*lapse/1000 float64 (K), added to T2D,
+      DHGT*GRAVITY/RD float64 (K), PSFC being corrected by PSFC times
+      this over T2D)
+   """
+   dhgt = _read_2d(hgtFile, 'HGT') - _read_2d(geoFile, 'HGT_M')
+   if lapseFile and os.path.exists(lapseFile):
+      lapse = _read_2d(lapseFile, 'lapse')
+      WhfLog.debug("Using narr lapse rate %s", lapseFile)
+   else:
+      lapse = np.float32(DEFAULT_LAPSE)
+      WhfLog.debug("Using constant lapse rate")
+   tIncrement = dhgt.astype(np.float64)
+   np.multiply(tIncrement, lapse, out=tIncrement)
+   np.divide(tIncrement, 1000.0, out=tIncrement)
+   pFactor = dhgt.astype(np.float64)
+   np.multiply(pFactor, GRAVITY/RD, out=pFactor)
+   return (dhgt, tIncrement, pFactor)
+
+#----------------------------------------------------------------------------
+def get_terrain(hgtFile, geoFile, lapseFile, cacheDir=None,
+                precision='double'):
+   """Static terms of the height correction, read once per process.  With
+   a cache directory they come from the terrain cache (Terrain_Cache),
+   computed once for all processes, otherwise from the files.
+
+   Parameters
+   ----------
+   hgtFile, geoFile, lapseFile: str
+      As for static_terrain
+   cacheDir: str
+      Terrain cache directory, or None to read the files directly
+   precision: str
+      'double', or 'single' for float32 terms (copies of the float64
+      ones, or shared from the terrain cache)
+
+   Returns
+   -------
+   tuple
+      As for static_terrain
+   """
+   key = (hgtFile, geoFile, lapseFile, precision)
+   if key not in _terrain:
+      if cacheDir:
+         import Terrain_Cache
+         _terrain[key] = Terrain_Cache.load(hgtFile, geoFile, lapseFile,
+                                            cacheDir, precision)
+      else:
+         terrain = static_terrain(hgtFile, geoFile, lapseFile)
+         if precision == 'single':
+            terrain = tuple([t.astype(np.float32, copy=False)
+                             for t in terrain])
+         _terrain[key] = terrain
+   return _terrain[key]
+
+#----------------------------------------------------------------------------
+def saturation_mixing_ratio(t, p, out=None, work=None):
+   """Saturation mixing ratio (kg/kg) as in NCL's mixhum_ptrh
+
+   Parameters
+   ----------
+   t: numpy.ndarray
+      Temperature (K)
+   p: numpy.ndarray
+      Pressure (hPa)
+   out: numpy.ndarray
+      float64 (or float32) array of the shape of t to hold the result,
+      None to allocate a float64 one; may be p itself
+   work: numpy.ndarray
+      Scratch array of the shape and type of out, None to allocate one
+
+   Returns
+   -------
+   numpy.ndarray
+      out
+   """
+   if out is None:
+      out = np.empty(np.shape(t))
+   if work is None:
+      work = np.empty(np.shape(t))
+   # est = ES0*exp(A*(t - T0)/(t - B)), with A*(t - T0)/(t - B) written
+   # as A + A*(B - T0)/(t - B) to need a single scratch array
+   np.subtract(t, _B, out=work)
+   np.divide(_A*(_B - _T0), work, out=work)
+   np.add(work, _A, out=work)
+   np.exp(work, out=work)
+   np.multiply(work, _ES0, out=work)
+   # EP*est/(p - ONEMEP*est) = EP/(p/est - ONEMEP)
+   np.divide(p, work, out=out)
+   np.subtract(out, _ONEMEP, out=out)
+   np.divide(_EP, out, out=out)
+   return out
+
+#----------------------------------------------------------------------------
+def relhum(t, w, p, out=None, work=None):
+   """Relative humidity (%) from temperature (K), mixing ratio (kg/kg) and
+   pressure (Pa), NCL relhum arguments; out and work as for
+   saturation_mixing_ratio"""
+   if out is None:
+      out = np.empty(np.shape(t))
+   np.multiply(p, 0.01, out=out)
+   saturation_mixing_ratio(t, out, out, work)
+   np.divide(w, out, out=out)
+   np.multiply(out, 100.0, out=out)
+   return out
+
+#----------------------------------------------------------------------------
+def mixhum_ptrh(p, t, rh, iswit=2, out=None, work=None):
+   """Mixing ratio (iswit 1) or specific humidity (iswit 2), kg/kg, from
+   pressure (hPa), temperature (K) and relative humidity (%), as NCL's
+   mixhum_ptrh; out and work as for saturation_mixing_ratio"""
+   qw = saturation_mixing_ratio(t, p, out, work)
+   np.multiply(qw, rh, out=qw)
+   np.multiply(qw, 0.01, out=qw)
+   if iswit == 2:
+      if work is None:
+         work = np.empty(np.shape(qw))
+      np.add(qw, 1.0, out=work)
+      np.divide(qw, work, out=qw)
+   return qw
+
+#----------------------------------------------------------------------------
+def downscale(fields, tIncrement, pFactor, dtype=np.float64):
+   """Height correction of regridded fields
+
+   The correction runs in dtype (float64 by default) with in-place ufuncs
+   on four arrays allocated once per call (T2D, PSFC, Q2D and a scratch
+   array, besides the relative humidity), whatever the grid size.
+
+   Parameters
+   ----------
+   fields: dict
+      name -> regridded 2D field (FILL_VALUE where missing); T2D, Q2D
+      and PSFC are corrected, the others pass through
+   tIncrement: numpy.ndarray
+      DHGT*lapse/1000 (K), see static_terrain
+   pFactor: numpy.ndarray
+      DHGT*GRAVITY/RD (K), see static_terrain
+   dtype: numpy.dtype
+      Type of the computation, float32 with the terms in float32 as well
+      to keep it all single precision
+
+   Returns
+   -------
+   dict
+      name -> downscaled float32 field
+   """
+   t2d = np.array(fields['T2D'], dtype=dtype)
+   q2d = np.array(fields['Q2D'], dtype=dtype)
+   psfc = np.array(fields['PSFC'], dtype=dtype)
+   missing = (fields['T2D'] == FILL_VALUE) | (fields['Q2D'] == FILL_VALUE) | \
+             (fields['PSFC'] == FILL_VALUE)
+   work = np.empty(t2d.shape, dtype)
+   rh = np.empty(t2d.shape, dtype)
+
+   # Missing cells give meaningless values, overwritten below
+   with np.errstate(all='ignore'):
+      # RH = relhum(T2D, Q2D/(1 - Q2D), PSFC) < 100; the mixing ratio
+      # is kept in q2d, which is not needed any more
+      np.subtract(1.0, q2d, out=work)
+      np.divide(q2d, work, out=q2d)
+      relhum(t2d, q2d, psfc, rh, work)
+      np.minimum(rh, 100.0, out=rh)
+      # T2D += DHGT*lapse/1000
+      np.add(t2d, tIncrement, out=t2d)
+      # PSFC += DHGT*PSFC/287.05/T2D*9.8, as PSFC*(DHGT*9.8/287.05)/T2D
+      np.multiply(psfc, pFactor, out=work)
+      np.divide(work, t2d, out=work)
+      np.add(psfc, work, out=psfc)
+      # Q2D = mixhum_ptrh(PSFC/100, T2D, RH, 2)
+      np.multiply(psfc, 0.01, out=q2d)
+      mixhum_ptrh(q2d, t2d, rh, 2, q2d, work)
+
+   out = dict(fields)
+   for (name, values) in [('T2D', t2d), ('Q2D', q2d), ('PSFC', psfc)]:
+      values = values.astype(np.float32, copy=False)
+      values[missing] = FILL_VALUE
+      out[name] = values
+   return out
+
+#----------------------------------------------------------------------------
+def geometry_terms(geoFile):
+   """Static terrain terms of the shortwave adjustment of topo_adj.f90
+
+   cal_slope gives the slope and the slope azimuth (rotated to the
+   lat-lon grid) of each cell; TOPO_RAD_ADJ's cosine of the solar zenith
+   angle over the slope expands to
+
+      cos(declin)*(termCos*cos(hrang) - termSin*sin(hrang))
+         + sin(declin)*termDecl
+
+   with hrang the hour angle at the cell (hour angle at longitude 0 plus
+   the longitude), so only these terms and the sine and cosine of the
+   latitude and longitude are kept.
+
+   Parameters
+   ----------
+   geoFile: str
+      Geo file: HGT_M, XLAT_M, XLONG_M, COSALPHA, SINALPHA and the DX
+      and DY attributes
+
+   Returns
+   -------
+   dict
+      name -> float64 array for each of GEOMETRY_TERMS, 'flat' is 1
+      where the slope is zero (no adjustment) and 0 elsewhere
+   """
+   hgt = _read_2d(geoFile, 'HGT_M').astype(np.float64)
+   lat = _read_2d(geoFile, 'XLAT_M').astype(np.float64)*(math.pi/180.0)
+   lon = _read_2d(geoFile, 'XLONG_M').astype(np.float64)*(math.pi/180.0)
+   cosa = _read_2d(geoFile, 'COSALPHA')
+   sina = _read_2d(geoFile, 'SINALPHA').astype(np.float64)
+   nc = Dataset(geoFile, 'r')
+   try:
+      dx = float(nc.DX)
+      dy = float(nc.DY)
+   finally:
+      nc.close()
+
+   # cal_slope: centred differences, one sided on the edges
+   hx = np.empty_like(hgt)
+   hy = np.empty_like(hgt)
+   hx[:, 1:-1] = (hgt[:, 2:] - hgt[:, :-2])/(2.0*dx)
+   hx[:, 0] = (hgt[:, 1] - hgt[:, 0])/dx
+   hx[:, -1] = (hgt[:, -1] - hgt[:, -2])/dx
+   hy[1:-1, :] = (hgt[2:, :] - hgt[:-2, :])/(2.0*dy)
+   hy[0, :] = (hgt[1, :] - hgt[0, :])/dy
+   hy[-1, :] = (hgt[-1, :] - hgt[-2, :])/dy
+   slope = np.arctan(np.sqrt(hx*hx + hy*hy))
+   azimuth = np.arctan2(hx, hy) + math.pi
+   azimuth -= np.where(cosa >= 0, np.arcsin(sina), math.pi - np.arcsin(sina))
+   flat = slope < 1.e-4
+   slope[flat] = 0.0
+   azimuth[flat] = 0.0
+
+   terms = {}
+   terms['sin_lat'] = np.sin(lat)
+   terms['cos_lat'] = np.cos(lat)
+   terms['sin_lon'] = np.sin(lon)
+   terms['cos_lon'] = np.cos(lon)
+   sinSlope = np.sin(slope)
+   cosSlope = np.cos(slope)
+   terms['term_cos'] = terms['cos_lat']*cosSlope - \
+                       terms['sin_lat']*np.cos(azimuth)*sinSlope
+   terms['term_sin'] = np.sin(azimuth)*sinSlope
+   terms['term_decl'] = terms['cos_lat']*np.cos(azimuth)*sinSlope + \
+                        terms['sin_lat']*cosSlope
+   terms['flat'] = flat.astype(np.float64)
+   return terms
+
+#----------------------------------------------------------------------------
+def solar_position(validTime):
+   """Solar declination and hour angle at longitude 0, as radconst and
+   calc_coszen of topo_adj.f90 compute them for the time topo_adj.ncl
+   passes (day of year, whole hours)
+
+   Parameters
+   ----------
+   validTime: datetime.datetime
+      Valid time (UTC)
+
+   Returns
+   -------
+   tuple
+      (declination, hour angle at longitude 0), radians
+   """
+   julian = float(validTime.timetuple().tm_yday)
+   xtime = validTime.hour*60.0
+   degrad = math.pi/180.0
+
+   # radconst: solar declination
+   if julian >= 80.0:
+      sxlong = 360.0/365.0*(julian - 80.0)
+   else:
+      sxlong = 360.0/365.0*(julian + 285.0)
+   declin = math.asin(math.sin(23.5*degrad)*math.sin(sxlong*degrad))
+
+   # calc_coszen, with the equation of time correction
+   da = 6.2831853071795862*(julian - 1)/365.0
+   eot = (0.000075 + 0.001868*math.cos(da) - 0.032077*math.sin(da) -
+          0.014615*math.cos(2*da) - 0.04089*math.sin(2*da))*229.18
+   xt24 = math.fmod(xtime, 1440.0) + eot
+   return (declin, 15.0*(xt24/60.0 - 12.0)*degrad)
+
+#----------------------------------------------------------------------------
+class TerrainGeometry:
+   """Static terrain terms of the shortwave adjustment of topo_adj.f90
+
+   The adjustment at a time is a correction factor per cell, which
+   depends on the day of year and the hour only: with a table directory
+   the factors of each (day of year, hour) are computed once and kept
+   there (Terrain_Cache), so adjusting SWDOWN is a lookup and a multiply.
+
+   Attributes
+   ----------
+   _geoFile: str
+      Geo file the terms come from
+   _terms: dict
+      name -> array for each of GEOMETRY_TERMS, see geometry_terms
+   _tableDir: str
+      Directory of the correction factor tables, None to compute the
+      factors at each call
+   """
+
+   #--------------------------------------------------------------------------
+   def __init__(self, geoFile, terms=None, tableDir=None):
+      """Initialization
+
+      Parameters
+      ----------
+      geoFile: str
+         WRF-Hydro geo file
+      terms: dict
+         geometry_terms of the geo file, None to compute them
+      tableDir: str
+         Directory of the correction factor tables, None for none
+      """
+      self._geoFile = geoFile
+      if terms is None:
+         terms = geometry_terms(geoFile)
+      self._terms = terms
+      self._tableDir = tableDir
+
+   #--------------------------------------------------------------------------
+   def debugPrint(self):
+      """ Debug logging of content
+      """
+      flat = self._terms['flat']
+      WhfLog.debug("Terrain geometry of %s %s, %d sloped cells, tables in %s",
+                   self._geoFile, str(flat.shape),
+                   flat.size - np.count_nonzero(flat), self._tableDir)
+
+   #--------------------------------------------------------------------------
+   def computeFactor(self, validTime):
+      """Shortwave correction factor of each cell at a time
+
+      Parameters
+      ----------
+      validTime: datetime.datetime
+         Valid time (UTC)
+
+      Returns
+      -------
+      numpy.ndarray
+         float32 factor: cosine of the zenith angle over the slope over
+         the cosine of the zenith angle, capped at 1.3; 1 on flat cells
+         and at night
+      """
+      t = self._terms
+      (declin, hour0) = solar_position(validTime)
+      (sinDecl, cosDecl) = (math.sin(declin), math.cos(declin))
+      (sinH0, cosH0) = (math.sin(hour0), math.cos(hour0))
+      # cosine and sine of the hour angle of each cell
+      cosH = cosH0*t['cos_lon'] - sinH0*t['sin_lon']
+      sinH = sinH0*t['cos_lon'] + cosH0*t['sin_lon']
+      coszen = t['sin_lat']*sinDecl + t['cos_lat']*cosDecl*cosH
+
+      cszaSlope = cosDecl*(t['term_cos']*cosH - t['term_sin']*sinH) + \
+                  sinDecl*t['term_decl']
+      cszaSlope[cszaSlope <= 1.e-4] = 0.0
+      day = coszen > 1.e-4
+      corr = np.ones(coszen.shape)
+      corr[day] = cszaSlope[day]/coszen[day]
+      corr[t['flat'] != 0] = 1.0
+      np.minimum(corr, 1.3, corr)
+      return corr.astype(np.float32)
+
+   #--------------------------------------------------------------------------
+   def factor(self, validTime):
+      """Shortwave correction factor at a time, from the table directory
+      if there is one (see computeFactor)"""
+      if self._tableDir is None:
+         return self.computeFactor(validTime)
+      import Terrain_Cache
+      return Terrain_Cache.load_factor(self, validTime)
+
+   #--------------------------------------------------------------------------
+   def adjust(self, swdown, validTime):
+      """Terrain adjusted shortwave radiation
+
+      Parameters
+      ----------
+      swdown: numpy.ndarray
+         SWDOWN (W/m2), FILL_VALUE where missing
+      validTime: datetime.datetime
+         Valid time (UTC)
+
+      Returns
+      -------
+      numpy.ndarray
+         Adjusted float32 SWDOWN
+      """
+      corr = self.factor(validTime)
+      adjust = (swdown > 1.e-3) & (swdown != FILL_VALUE)
+      out = swdown.astype(np.float32)
+      out[adjust] *= corr[adjust]
+      return out
+
+#----------------------------------------------------------------------------
+def get_geometry(geoFile, cacheDir=None):
+   """TerrainGeometry of a geo file, computed once per process.  With a
+   cache directory its terms come from the terrain cache (Terrain_Cache),
+   computed once for all processes, and so do its correction factor
+   tables."""
+   if geoFile not in _geometry:
+      if cacheDir:
+         import Terrain_Cache
+         _geometry[geoFile] = Terrain_Cache.load_geometry(geoFile, cacheDir)
+      else:
+         _geometry[geoFile] = TerrainGeometry(geoFile)
+      _geometry[geoFile].debugPrint()
+   return _geometry[geoFile]
+
+#----------------------------------------------------------------------------
+def valid_time(ldasinFile):
+   """Valid time of a YYYYMMDDhh00.LDASIN_DOMAIN1 file"""
+   match = re.match(r'([0-9]{10})00\.LDASIN_DOMAIN1', os.path.basename(ldasinFile))
+   if not match:
+      WhfLog.error("%s has an unexpected name.", ldasinFile)
+      raise FilenameMatchError('%s has unexpected filename format'%ldasinFile)
+   return datetime.datetime.strptime(match.group(1), '%Y%m%d%H')
+
+#----------------------------------------------------------------------------
+def downscale_regridded(regridded, hgtFile, geoFile, lapseFile, validTime=None,
+                        cacheDir=None, swAdjust=None, precision='double'):
+   """Downscale regridded fields (and adjust SWDOWN)
+
+   Parameters
+   ----------
+   regridded: list
+      (name, numpy.ndarray, units, description) regridded fields
+   hgtFile, geoFile, lapseFile: str
+      As for get_terrain
+   validTime: datetime.datetime
+      Valid time of the fields, to apply the terrain shortwave
+      adjustment at; None for no shortwave adjustment
+   cacheDir: str
+      Terrain cache directory, as for get_terrain
+   swAdjust: object
+      Shortwave adjustment with the adjust method of TerrainGeometry
+      (Topo_Adj.TopoAdj), None for the TerrainGeometry of the geo file
+   precision: str
+      Precision of the height correction, see Regrid_Engine.PRECISIONS
+
+   Returns
+   -------
+   list
+      (name, numpy.ndarray, units, description) downscaled fields, in
+      the order of DOWNSCALED_FIELDS
+   """
+   (dhgt, tIncrement, pFactor) = get_terrain(hgtFile, geoFile, lapseFile,
+                                             cacheDir, precision)
+   fields = dict([(r[0], r[1]) for r in regridded])
+   out = downscale(fields, tIncrement, pFactor, rge.PRECISIONS[precision])
+   if validTime is not None and 'SWDOWN' in out:
+      if swAdjust is None:
+         swAdjust = get_geometry(geoFile, cacheDir)
+      out['SWDOWN'] = swAdjust.adjust(out['SWDOWN'], validTime)
+   attrs = dict([(r[0], (r[2], r[3])) for r in regridded])
+   return [(name, out[name]) + attrs[name]
+           for name in DOWNSCALED_FIELDS if name in out]
+
+#----------------------------------------------------------------------------
+def downscale_fields(regridded, hgtFile, geoFile, lapseFile, outFile,
+                     shortwave=False, cacheDir=None, swAdjust=None,
+                     precision='double'):
+   """Downscale regridded fields (and adjust SWDOWN) and write them
+
+   Parameters
+   ----------
+   regridded: list
+      (name, numpy.ndarray, units, description) regridded fields
+   hgtFile, geoFile, lapseFile: str
+      As for get_terrain
+   outFile: str
+      Downscaled file, YYYYMMDDhh00.LDASIN_DOMAIN1.nc
+   shortwave: bool
+      True to apply the terrain shortwave adjustment
+   cacheDir: str
+      Terrain cache directory, as for get_terrain
+   swAdjust, precision:
+      As for downscale_regridded
+
+   Returns
+   -------
+   None
+   """
+   validTime = None
+   if shortwave:
+      validTime = valid_time(outFile)
+   written = downscale_regridded(regridded, hgtFile, geoFile, lapseFile,
+                                 validTime, cacheDir, swAdjust, precision)
+   rge.write_ldasin(outFile, written, written[0][1].shape)
+
+#----------------------------------------------------------------------------
+def read_regridded(ncFile):
+   """Fields of a regridded file to downscale
+
+   Parameters
+   ----------
+   ncFile: str
+      Regridded file, of the NCL scripts or Regrid_Engine
+
+   Returns
+   -------
+   list
+      (name, float32 numpy.ndarray with FILL_VALUE where missing, units,
+      description) for each of DOWNSCALED_FIELDS in the file
+   """
+   if not os.path.exists(ncFile):
+      WhfLog.error('File: ' + ncFile + ' not found.')
+      raise MissingFileError('File %s not found'%ncFile)
+   regridded = []
+   nc = Dataset(ncFile, 'r')
+   try:
+      for name in DOWNSCALED_FIELDS:
+         if name not in nc.variables:
+            continue
+         var = nc.variables[name]
+         values = np.ma.filled(np.ma.asarray(var[:]).astype(np.float32),
+                               FILL_VALUE)
+         desc = getattr(var, 'description', getattr(var, 'long_name', name))
+         regridded.append((name, values.reshape(values.shape[-2:]),
+                           getattr(var, 'units', ''), desc))
+   finally:
+      nc.close()
+   return regridded
+
+#----------------------------------------------------------------------------
+def downscale_file(inFile, hgtFile, geoFile, lapseFile, outFile,
+                   shortwave=False, cacheDir=None, swAdjust=None,
+                   precision='double'):
+   """Downscale a regridded file, the equivalent of
+   All_WRF_Hydro_downscale.ncl (or its 0hr version, for a file without
+   the flux and precipitation fields) followed by topo_adj.ncl
+
+   Parameters
+   ----------
+   inFile: str
+      Regridded file
+   hgtFile, geoFile, lapseFile, outFile, shortwave, cacheDir, swAdjust,
+   precision:
+      As for downscale_fields
+
+   Returns
+   -------
+   None
+   """
+   downscale_fields(read_regridded(inFile), hgtFile, geoFile, lapseFile,
+                    outFile, shortwave, cacheDir, swAdjust, precision)
+
+#----------------------------------------------------------------------------
+def downscale_cfs(inFile, hgtFile, geoFile, lapseFile, outFile, validTime,
+                  cacheDir=None, swAdjust=None, precision='double'):
+   """Downscale a regridded bias corrected CFSv2 file and adjust its
+   shortwave radiation, the equivalent of CFSv2_downscale_conus.ncl
+
+   Parameters
+   ----------
+   inFile: str
+      Regridded, bias corrected CFSv2 file
+   hgtFile, geoFile, lapseFile:
+      As for get_terrain
+   outFile: str
+      Output LDASIN file
+   validTime: datetime.datetime
+      Valid time of the data
+   cacheDir: str
+      Terrain cache directory, as for get_terrain
+   swAdjust, precision:
+      As for downscale_regridded; in single precision the output
+      variables are float instead of double
+
+   Returns
+   -------
+   None
+   """
+   written = downscale_regridded(read_regridded(inFile), hgtFile, geoFile,
+                                 lapseFile, validTime, cacheDir, swAdjust,
+                                 precision)
+   write_cfs(outFile, dict([(w[0], w[1]) for w in written]), precision)
+
+#----------------------------------------------------------------------------
+def write_cfs(outFile, fields, precision='double'):
+   """Write downscaled CFSv2 fields as CFSv2_downscale_conus.ncl does
+
+   Parameters
+   ----------
+   outFile: str
+      Output file
+   fields: dict
+      name -> 2D field (FILL_VALUE where missing) for each CFS_FIELDS entry
+   precision: str
+      'double' for double variables, as the NCL script, 'single' for float
+
+   Returns
+   -------
+   None
+   """
+   dtype = rge.PRECISIONS[precision]
+   fill = dtype(CFS_FILL)
+   (ny, nx) = fields['T2D'].shape
+   if os.path.exists(outFile):
+      os.remove(outFile)
+   nc = Dataset(outFile, 'w', format='NETCDF3_64BIT_OFFSET')
+   try:
+      nc.title = "Fully downscaled CFSv2 data for long-range WRF-Hydro conus configuration"
+      nc.creation_date = time.strftime('%a %b %d %H:%M:%S %Z %Y')
+      nc.author = "National Center for Atmospheric Research"
+      nc.Conventions = "None"
+      nc.createDimension('Time', None)
+      nc.createDimension('south_north', ny)
+      nc.createDimension('west_east', nx)
+      for (name, units, longName) in CFS_FIELDS:
+         var = nc.createVariable(name, dtype, ('Time', 'south_north', 'west_east'),
+                                 fill_value=fill)
+         var.missing_value = fill
+         var.remap = "remapped via ESMF_regrid_with_weights: Bilinear"
+         var.units = units
+         var.long_name = longName
+         if name == 'RAINRATE':
+            var.description = "RAINRATE"
+         values = np.ma.masked_equal(fields[name], FILL_VALUE)
+         var[0, :, :] = values.astype(dtype).filled(fill)
+   finally:
+      nc.close()
@@ -0,0 +1,233 @@
+"""Field_Cache
+Local disk cache of decoded GRIB2 fields, shared by all the consumers of
+one input file.  An HRRR or RAP 0hr file is regridded twice, for the
+short range forcing and for the analysis and assimilation forcing; with
+the cache the second (and any later) consumer loads the decoded fields
+instead of decoding the GRIB2 messages again.
+
+Each input file has one entry directory holding one raw float32 .npy
+array per field (plus <name>.mask.npy for fields with a bitmap), in the
+units of the Grib2_Reader variable tables and on the whole source grid,
+so consumers with different weight footprints share it.  Arrays are
+memory mapped on load, and only the footprint of a consumer is copied
+out of the page cache.
+
+Entries are keyed by the input file path, size and modification time,
+so a file rewritten in place is decoded again.  The cache is kept under
+[data_dir] field_cache_mb megabytes by removing the least recently used
+entries (by entry directory modification time, updated on each hit)
+whenever a field is added.
+"""
+
+import os
+import shutil
+import hashlib
+import tempfile
+import numpy as np
+import WhfLog
+
+# Bump when the on-disk layout changes so old entries are not reused
+CACHE_VERSION = 1
+
+# Default cache size limit, MB
+DEFAULT_MAX_MB = 4096
+
+#----------------------------------------------------------------------------
+class FieldCache:
+   """Decoded field cache in one directory
+
+   Attributes
+   ----------
+   _cacheDir: str
+      Cache directory (preferably on a local disk)
+   _maxBytes: int
+      Size limit of the cache
+   """
+
+   #--------------------------------------------------------------------------
+   def __init__(self, cacheDir, maxBytes):
+      """Initialization using input args
+
+      Parameters
+      ----------
+      One to one with attributes
+      """
+      self._cacheDir = cacheDir
+      self._maxBytes = maxBytes
+
+   #--------------------------------------------------------------------------
+   def debugPrint(self):
+      """ Debug logging of content
+      """
+      WhfLog.debug("Field cache %s, %d MB", self._cacheDir,
+                   self._maxBytes/(1024*1024))
+
+   #--------------------------------------------------------------------------
+   def entryDir(self, srcFile):
+      """Entry directory of an input file
+
+      Parameters
+      ----------
+      srcFile: str
+         GRIB2 input file
+
+      Returns
+      -------
+      str
+         <cache dir>/<file name>.<sha1 of version, path, size and mtime>
+      """
+      st = os.stat(srcFile)
+      h = hashlib.sha1()
+      h.update('%d:%s:%d:%d'%(CACHE_VERSION, os.path.abspath(srcFile),
+                              st.st_size, int(st.st_mtime)))
+      return os.path.join(self._cacheDir,
+                          os.path.basename(srcFile) + '.' + h.hexdigest())
+
+   #--------------------------------------------------------------------------
+   def get(self, srcFile, name):
+      """Cached decoded field, None if not cached
+
+      Parameters
+      ----------
+      srcFile: str
+         GRIB2 input file
+      name: str
+         Output name of the field (Grib2_Reader variable table)
+
+      Returns
+      -------
+      numpy.ndarray
+         Read only memory mapped float32 field (numpy.ma.MaskedArray if
+         the message has a bitmap), or None
+      """
+      entry = self.entryDir(srcFile)
+      path = os.path.join(entry, name + '.npy')
+      if not os.path.exists(path):
+         return None
+      try:
+         values = np.load(path, mmap_mode='r')
+         maskPath = os.path.join(entry, name + '.mask.npy')
+         if os.path.exists(maskPath):
+            values = np.ma.array(values, mask=np.load(maskPath))
+         # most recently used
+         os.utime(entry, None)
+      except (IOError, OSError, ValueError) as e:
+         # evicted by another process while reading
+         WhfLog.debug("Cannot load %s from %s: %s", name, entry, e)
+         return None
+      return values
+
+   #--------------------------------------------------------------------------
+   def put(self, srcFile, name, values):
+      """Add a decoded field, then evict down to the size limit
+
+      Parameters
+      ----------
+      srcFile: str
+         GRIB2 input file
+      name: str
+         Output name of the field
+      values: numpy.ndarray
+         Decoded field, whole source grid
+
+      Returns
+      -------
+      numpy.ndarray
+         The field as stored (float32), to be used by the caller so that
+         the first consumer sees the same values as the later ones
+      """
+      data = np.array(np.ma.getdata(values), dtype=np.float32)
+      mask = None
+      if np.ma.is_masked(values):
+         mask = np.ma.getmaskarray(values)
+         data[mask] = 0.0
+      entry = self.entryDir(srcFile)
+      try:
+         if not os.path.exists(entry):
+            try:
+               os.makedirs(entry)
+            except OSError:
+               # created by another consumer meanwhile
+               if not os.path.isdir(entry):
+                  raise
+         if mask is not None:
+            _save(entry, name + '.mask', mask)
+         _save(entry, name, data)
+      except (IOError, OSError) as e:
+         WhfLog.debug("Cannot cache %s of %s: %s", name, srcFile, e)
+      else:
+         self.evict(entry)
+      if mask is not None:
+         return np.ma.array(data, mask=mask)
+      return data
+
+   #--------------------------------------------------------------------------
+   def evict(self, keep=None):
+      """Remove the least recently used entries until the cache is under
+      its size limit
+
+      Parameters
+      ----------
+      keep: str
+         Entry directory never to remove (the one being filled)
+
+      Returns
+      -------
+      int
+         Number of entries removed
+      """
+      entries = []
+      total = 0
+      for d in os.listdir(self._cacheDir):
+         path = os.path.join(self._cacheDir, d)
+         if d.startswith('.') or not os.path.isdir(path):
+            continue
+         try:
+            size = sum([os.path.getsize(os.path.join(path, f))
+                        for f in os.listdir(path)])
+            entries.append((os.path.getmtime(path), path, size))
+         except OSError:
+            # removed by another process
+            continue
+         total += size
+      entries.sort()
+      removed = 0
+      for (mtime, path, size) in entries:
+         if total <= self._maxBytes:
+            break
+         if path == keep:
+            continue
+         WhfLog.debug("Evicting field cache entry %s", path)
+         shutil.rmtree(path, ignore_errors=True)
+         total -= size
+         removed += 1
+      return removed
+
+#----------------------------------------------------------------------------
+def _save(entry, name, values):
+   """Write an array into an entry, atomically"""
+   fd, tmpName = tempfile.mkstemp(dir=entry, prefix='.' + name, suffix='.npy')
+   os.close(fd)
+   np.save(tmpName, values)
+   os.rename(tmpName, os.path.join(entry, name + '.npy'))
+
+#----------------------------------------------------------------------------
+def get_field_cache(parser):
+   """Field cache from the [data_dir] section, None if field_cache_dir is
+   not set"""
+   if not parser.has_option('data_dir', 'field_cache_dir'):
+      return None
+   cacheDir = parser.get('data_dir', 'field_cache_dir').strip()
+   if not cacheDir:
+      return None
+   maxMb = DEFAULT_MAX_MB
+   if parser.has_option('data_dir', 'field_cache_mb'):
+      maxMb = parser.getint('data_dir', 'field_cache_mb')
+   if not os.path.exists(cacheDir):
+      try:
+         os.makedirs(cacheDir)
+      except OSError:
+         if not os.path.isdir(cacheDir):
+            WhfLog.warning("Cannot create field cache %s, not caching", cacheDir)
+            return None
+   return FieldCache(cacheDir, maxMb*1024*1024)
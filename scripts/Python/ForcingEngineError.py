@@ -109,3 +109,25 @@ class InvalidArgumentError(ForcingEngineError):
     def __str__(self):
         return repr(self.parameter)
     
+
+class RegridError(ForcingEngineError):
+    '''Used when the in-process (Python)
+       regridding cannot be performed,
+       e.g. a required input field is
+       missing or the weight file does
+       not match the input grid.
+    '''
+    def __init__(self, value):
+        self.parameter = value
+    def __str__(self):
+        return repr(self.parameter)
+
+class GribError(ForcingEngineError):
+    '''Used when a GRIB2 input file cannot
+       be read selectively, e.g. a required
+       field is missing from the file.
+    '''
+    def __init__(self, value):
+        self.parameter = value
+    def __str__(self):
+        return repr(self.parameter)
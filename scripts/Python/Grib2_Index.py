@@ -0,0 +1,350 @@
+"""Grib2_Index
+Message inventory of GRIB2 input files, kept in a sidecar index so a
+file is scanned only once and readers fetch just the byte ranges of the
+messages they need.  The scan reads the section 0 and product
+definition (section 4) headers of each message and seeks over
+everything else, so building the inventory of a large pressure level
+file reads a few hundred bytes per message.
+
+The index is a text file <GRIB2 file name>.whf.idx, written to the
+[data_dir] grib_index_dir directory, or next to the GRIB2 file when
+that is not set (silently kept in memory only if that directory is not
+writable).  It holds the size and modification time of the GRIB2 file
+and is rebuilt when they change.  Indexes can be built ahead of time
+with:
+
+   python Grib2_Index.py <GRIB2 file> [<GRIB2 file> ...]
+"""
+
+import os
+import sys
+import struct
+import tempfile
+import WhfLog
+from ForcingEngineError import MissingFileError
+from ForcingEngineError import GribError
+
+# First line of an index file: tag, format version, GRIB2 file size, mtime
+INDEX_TAG = '# whf-grib2-index'
+INDEX_VERSION = 1
+
+# Sidecar suffix, distinct from the wgrib2 style .idx files NCEP
+# distributes with its GRIB2 files
+INDEX_SUFFIX = '.whf.idx'
+
+# Octet offset of the statistical processing part in the product
+# definition templates that have one, relative to template 4.8
+_STAT_TEMPLATE_SHIFT = {8: 0, 9: 13, 10: 1, 11: 3, 12: 2}
+
+# Level types whose level is given in Pa but used in hPa (as ecCodes)
+_PA_LEVEL_TYPES = [100, 108]
+
+#----------------------------------------------------------------------------
+class Message:
+   """Inventory entry of one GRIB2 message (its first field)
+
+   Attributes
+   ----------
+   _number: int
+      1-based message number
+   _offset: int
+      Byte offset of the message in the file
+   _length: int
+      Message length in bytes
+   _header: tuple
+      (discipline, parameterCategory, parameterNumber,
+      typeOfFirstFixedSurface, level, lengthOfTimeRange), the last
+      0 for a message without statistical processing
+   _forecastTime: int
+      Forecast time, in the units of the message
+   """
+
+   #--------------------------------------------------------------------------
+   def __init__(self, number, offset, length, header, forecastTime):
+      """Initialization using input args
+
+      Parameters
+      ----------
+      One to one with attributes
+      """
+      self._number = number
+      self._offset = offset
+      self._length = length
+      self._header = tuple(header)
+      self._forecastTime = forecastTime
+
+   #--------------------------------------------------------------------------
+   def toLine(self):
+      """Index file line for the message"""
+      return ' '.join([str(v) for v in [self._number, self._offset, self._length] +
+                       list(self._header) + [self._forecastTime]])
+
+   #--------------------------------------------------------------------------
+   def debugPrint(self):
+      """ Debug logging of content
+      """
+      WhfLog.debug("Message %d at %d (%d bytes): %s fcst %d", self._number,
+                   self._offset, self._length, str(self._header),
+                   self._forecastTime)
+
+#----------------------------------------------------------------------------
+def _message_from_line(line):
+   """Message from an index file line"""
+   v = [int(f) for f in line.split()]
+   return Message(v[0], v[1], v[2], v[3:9], v[9])
+
+#----------------------------------------------------------------------------
+def _signed(value, nbytes):
+   """GRIB2 sign and magnitude integer to int"""
+   sign = 1 << (8*nbytes - 1)
+   if value & sign:
+      return -(value & (sign - 1))
+   return value
+
+#----------------------------------------------------------------------------
+def _parse_section4(discipline, sec):
+   """Header and forecast time from a product definition section
+
+   Parameters
+   ----------
+   discipline: int
+      Discipline from section 0
+   sec: bytearray
+      The whole section 4
+
+   Returns
+   -------
+   tuple
+      (header, forecast time), header as for Message._header
+   """
+   (template,) = struct.unpack('>H', bytes(sec[7:9]))
+   category = sec[9]
+   number = sec[10]
+   if template > 15:
+      # level and time are elsewhere in other templates; such a
+      # message is listed but never selected (level type -1)
+      return ((discipline, category, number, -1, 0, 0), 0)
+   (forecastTime,) = struct.unpack('>I', bytes(sec[18:22]))
+   levelType = sec[22]
+   factor = sec[23]
+   (scaled,) = struct.unpack('>I', bytes(sec[24:28]))
+   if levelType == 255 or factor == 255 or scaled == 0xFFFFFFFF:
+      level = 0
+   else:
+      level = _signed(scaled, 4)*10.0**(-_signed(factor, 1))
+      if levelType in _PA_LEVEL_TYPES:
+         level = level/100.0
+      level = int(round(level))
+   timeRange = 0
+   if template in _STAT_TEMPLATE_SHIFT:
+      start = 49 + _STAT_TEMPLATE_SHIFT[template]
+      if len(sec) >= start + 4:
+         (timeRange,) = struct.unpack('>I', bytes(sec[start:start + 4]))
+   return ((discipline, category, number, levelType, level, timeRange),
+           forecastTime)
+
+#----------------------------------------------------------------------------
+def scan_file(srcFile, complete=True, start=0, firstNumber=1):
+   """Inventory of a GRIB2 file from its message headers
+
+   Parameters
+   ----------
+   srcFile: str
+      GRIB2 file
+   complete: bool
+      If True the file must end with a whole message, otherwise a
+      trailing partial message (file still being written) is ignored
+   start: int
+      Byte offset of the first message to scan, to scan only what was
+      added to a growing file since the last scan
+   firstNumber: int
+      Message number of the message at start
+
+   Returns
+   -------
+   list
+      Message per message in the file (from start)
+   """
+   if not os.path.exists(srcFile):
+      WhfLog.error('GRIB2 file: ' + srcFile + ' not found.')
+      raise MissingFileError('GRIB2 file %s not found'%srcFile)
+   size = os.path.getsize(srcFile)
+   messages = []
+   f = open(srcFile, 'rb')
+   try:
+      offset = start
+      while offset + 16 <= size:
+         f.seek(offset)
+         sec0 = bytearray(f.read(16))
+         if bytes(sec0[0:4]) != b'GRIB':
+            if not any(sec0):
+               # zero padding at the end of the file
+               break
+            raise GribError('No GRIB message at byte %d of %s'%(offset, srcFile))
+         if sec0[7] != 2:
+            raise GribError('GRIB edition %d message in %s'%(sec0[7], srcFile))
+         (length,) = struct.unpack('>Q', bytes(sec0[8:16]))
+         if offset + length > size:
+            if complete:
+               raise GribError('Truncated message at byte %d of %s'%(offset, srcFile))
+            break
+
+         # walk the section headers up to the first product definition
+         pos = offset + 16
+         parsed = None
+         while pos + 5 <= offset + length - 4:
+            f.seek(pos)
+            (secLen, secNum) = struct.unpack('>IB', f.read(5))
+            if secNum == 4:
+               sec = bytearray(struct.pack('>IB', secLen, secNum) + f.read(secLen - 5))
+               parsed = _parse_section4(sec0[6], sec)
+               break
+            if secLen < 5:
+               break
+            pos += secLen
+         if parsed is None:
+            raise GribError('No product definition in message at byte %d of %s'
+                            %(offset, srcFile))
+         messages.append(Message(firstNumber + len(messages), offset, length,
+                                 parsed[0], parsed[1]))
+         offset += length
+   finally:
+      f.close()
+   return messages
+
+#----------------------------------------------------------------------------
+def index_path(srcFile, indexDir=None):
+   """Name of the index file of a GRIB2 file"""
+   if indexDir:
+      return os.path.join(indexDir, os.path.basename(srcFile) + INDEX_SUFFIX)
+   return srcFile + INDEX_SUFFIX
+
+#----------------------------------------------------------------------------
+def _signature(srcFile):
+   """'size mtime' of a GRIB2 file"""
+   st = os.stat(srcFile)
+   return '%d %d'%(st.st_size, int(st.st_mtime))
+
+#----------------------------------------------------------------------------
+def read_index(srcFile, indexDir=None):
+   """Messages from the index of a GRIB2 file, None if there is no up to
+   date index"""
+   path = index_path(srcFile, indexDir)
+   if not os.path.exists(path):
+      return None
+   f = open(path, 'r')
+   try:
+      lines = f.read().splitlines()
+   finally:
+      f.close()
+   if not lines or lines[0] != '%s %d %s'%(INDEX_TAG, INDEX_VERSION,
+                                             _signature(srcFile)):
+      WhfLog.debug("Index %s is out of date", path)
+      return None
+   return [_message_from_line(line) for line in lines[1:] if line.strip()]
+
+#----------------------------------------------------------------------------
+def write_index(srcFile, messages, indexDir=None):
+   """Write the index of a GRIB2 file, atomically
+
+   Returns
+   -------
+   bool
+      True if written, False if the index directory is not writable
+   """
+   path = index_path(srcFile, indexDir)
+   lines = ['%s %d %s'%(INDEX_TAG, INDEX_VERSION, _signature(srcFile))]
+   lines.extend([m.toLine() for m in messages])
+   try:
+      if indexDir and not os.path.exists(indexDir):
+         os.makedirs(indexDir)
+      fd, tmpName = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)),
+                                     prefix='.' + os.path.basename(path))
+      os.write(fd, ('\n'.join(lines) + '\n').encode('ascii'))
+      os.close(fd)
+      os.rename(tmpName, path)
+   except (IOError, OSError) as e:
+      WhfLog.debug("Cannot write index %s: %s", path, e)
+      return False
+   return True
+
+#----------------------------------------------------------------------------
+def get_inventory(srcFile, indexDir=None):
+   """Messages of a GRIB2 file, from its index or by scanning it (once,
+   the index is then written)
+
+   Parameters
+   ----------
+   srcFile: str
+      GRIB2 file
+   indexDir: str
+      Index directory, None to keep the index next to the GRIB2 file
+
+   Returns
+   -------
+   list
+      Message per message in the file
+   """
+   messages = read_index(srcFile, indexDir)
+   if messages is None:
+      messages = scan_file(srcFile)
+      write_index(srcFile, messages, indexDir)
+   return messages
+
+#----------------------------------------------------------------------------
+def read_message(f, message):
+   """Bytes of one message
+
+   Parameters
+   ----------
+   f: file
+      GRIB2 file opened 'rb'
+   message: Message
+      Its inventory entry
+
+   Returns
+   -------
+   bytes
+   """
+   f.seek(message._offset)
+   buf = f.read(message._length)
+   if len(buf) != message._length:
+      raise GribError('Short read of message %d at byte %d'%(message._number,
+                                                                message._offset))
+   return buf
+
+#----------------------------------------------------------------------------
+def get_index_dir(parser):
+   """GRIB2 index directory from the [data_dir] section, None if not set"""
+   if parser.has_option('data_dir', 'grib_index_dir'):
+      indexDir = parser.get('data_dir', 'grib_index_dir').strip()
+      if indexDir:
+         return indexDir
+   return None
+
+#----------------------------------------------------------------------------
+def main(argv):
+   """Index the GRIB2 files given as arguments, next to the files
+
+   Parameters
+   ----------
+   argv: list
+      GRIB2 files
+
+   Returns
+   -------
+   1 for error, 0 for success
+   """
+   if len(argv) < 1:
+      print 'Usage: python Grib2_Index.py <GRIB2 file> [<GRIB2 file> ...]'
+      return 1
+   for srcFile in argv:
+      messages = scan_file(srcFile)
+      write_index(srcFile, messages)
+      print srcFile, len(messages), 'messages'
+   return 0
+
+#----------------------------------------------
+
+if __name__ == "__main__":
+   sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,273 @@
+"""Grib2_Reader
+Selective GRIB2 ingest of the forcing inputs.  The NCL scripts open a
+whole GRIB2 file and build every variable in it to use about eight of
+them; here the messages a product needs are picked from its variable
+table using the file's message inventory (Grib2_Index), only their byte
+ranges are read, and only those are decoded (with pygrib, on top of
+ecCodes) straight into NumPy arrays.  Decoded fields can be shared with
+the other consumers of the same file through a Field_Cache.
+
+Products: HRRR, RAP, GFS, MRMS, MRMS_RATE (MRMS 2-minute PrecipRate) and
+CFS (CFSv2 6-hourly flxf files).
+"""
+
+import os
+import time
+import WhfLog
+import Grib2_Index as gi
+from ForcingEngineError import GribError
+
+# Per product variable tables, in output order:
+#   (output name, GRIB2 selection keys, scale, required, units, description)
+# The selection keys are GRIB2 header keys: discipline, parameterCategory,
+# parameterNumber, typeOfFirstFixedSurface and (optionally, None matches
+# any) level.  The NCL name of each field is given in the comments.
+_CONUS_FIELDS = [
+   # TMP_P0_L103_GLC0, SPFH_P0_L103_GLC0, UGRD_P0_L103_GLC0, VGRD_P0_L103_GLC0
+   ('T2D',  (0, 0, 0, 103, 2),  1.0, True,  'K', 'Temperature'),
+   ('Q2D',  (0, 1, 0, 103, 2),  1.0, True,  'kg kg-1', 'Specific humidity'),
+   ('U2D',  (0, 2, 2, 103, 10), 1.0, True,  'm s-1', 'U-component of wind'),
+   ('V2D',  (0, 2, 3, 103, 10), 1.0, True,  'm s-1', 'V-component of wind'),
+   # PRES_P0_L1_GLC0, APCP_P8_L1_GLC0_acc[1h]
+   ('PSFC', (0, 3, 0, 1, None), 1.0, True,  'Pa', 'Pressure'),
+   ('RAINRATE', (0, 1, 8, 1, None), 1.0/3600.0, False, 'mm s^-1', 'RAINRATE'),
+   # DSWRF_P0_L1_GLC0, ULWRF_P0_L8_GLC0
+   ('SWDOWN', (0, 4, 7, 1, None), 1.0, True,  'W m-2', 'Downward short-wave radiation flux'),
+   ('LWDOWN', (0, 5, 4, 8, None), 1.0, True,  'W m-2', 'Upward long-wave radiation flux'),
+]
+
+_GFS_FIELDS = [
+   ('T2D',  (0, 0, 0, 103, 2),  1.0, True,  'K', 'Temperature'),
+   ('Q2D',  (0, 1, 0, 103, 2),  1.0, True,  'kg kg-1', 'Specific humidity'),
+   ('U2D',  (0, 2, 2, 103, 10), 1.0, True,  'm s-1', 'U-component of wind'),
+   ('V2D',  (0, 2, 3, 103, 10), 1.0, True,  'm s-1', 'V-component of wind'),
+   ('PSFC', (0, 3, 0, 1, None), 1.0, True,  'Pa', 'Pressure'),
+   # PRATE_P8_L1_GLL0_avg*, DSWRF_P8_L1_GLL0_avg*, DLWRF_P8_L1_GLL0_avg*
+   ('RAINRATE', (0, 1, 7, 1, None), 1.0, False, 'mm s^-1', 'RAINRATE'),
+   ('SWDOWN', (0, 4, 7, 1, None), 1.0, False, 'W m-2', 'Downward short-wave radiation flux'),
+   ('LWDOWN', (0, 5, 3, 1, None), 1.0, False, 'W m-2', 'Downward long-wave radiation flux'),
+]
+
+_MRMS_FIELDS = [
+   # VAR_209_6_9_P0_L102_GLL0
+   ('precip_rate', (209, 6, 9, 102, None), 1.0/3600.0, True, 'mm s^-1', 'RAINRATE'),
+]
+
+# MRMS PrecipRate, the 2-minute instantaneous rate (Mrms_Accumulator)
+_MRMS_RATE_FIELDS = [
+   # VAR_209_6_1_P0_L102_GLL0
+   ('precip_rate', (209, 6, 1, 102, None), 1.0, True, 'mm hr^-1', 'PrecipRate'),
+]
+
+# CFSv2 flxf files, the variables read by CFSv2_bias_correct.ncl
+_CFS_FIELDS = [
+   # TMP_P0_L103_GGA0, SPFH_P0_L103_GGA0, UGRD_P0_L103_GGA0, VGRD_P0_L103_GGA0
+   ('T2D',  (0, 0, 0, 103, 2),  1.0, True,  'K', 'Temperature'),
+   ('Q2D',  (0, 1, 0, 103, 2),  1.0, True,  'kg kg-1', 'Specific humidity'),
+   ('U2D',  (0, 2, 2, 103, 10), 1.0, True,  'm s-1', 'U-component of wind'),
+   ('V2D',  (0, 2, 3, 103, 10), 1.0, True,  'm s-1', 'V-component of wind'),
+   # PRES_P0_L1_GGA0, PRATE_P0_L1_GGA0, DSWRF_P0_L1_GGA0, DLWRF_P0_L1_GGA0
+   ('PSFC', (0, 3, 0, 1, None), 1.0, True,  'Pa', 'Pressure'),
+   ('RAINRATE', (0, 1, 7, 1, None), 1.0, True, 'mm s^-1', 'RAINRATE'),
+   ('SWDOWN', (0, 4, 7, 1, None), 1.0, True,  'W m-2', 'Downward short-wave radiation flux'),
+   ('LWDOWN', (0, 5, 3, 1, None), 1.0, True,  'W m-2', 'Downward long-wave radiation flux'),
+]
+
+PRODUCT_FIELDS = {'HRRR': _CONUS_FIELDS, 'RAP': _CONUS_FIELDS,
+                  'GFS': _GFS_FIELDS, 'MRMS': _MRMS_FIELDS,
+                  'MRMS_RATE': _MRMS_RATE_FIELDS, 'CFS': _CFS_FIELDS}
+
+# Number of fields used for the 0hr files (T2D, Q2D, U2D, V2D, PSFC)
+ZERO_HOUR_NUM_FIELDS = 5
+
+#----------------------------------------------------------------------------
+def field_table(product, zero_process=False, names=None):
+   """Variable table entries wanted for a product
+
+   Parameters
+   ----------
+   product: str
+      'HRRR', 'RAP', 'GFS', 'MRMS' or 'CFS'
+   zero_process: bool
+      True for the 0hr (analysis and assimilation) variable set
+   names: list
+      Output names to restrict the table to, None for all
+
+   Returns
+   -------
+   list
+      Entries of PRODUCT_FIELDS[product]
+   """
+   if product not in PRODUCT_FIELDS:
+      WhfLog.error("No GRIB2 variable table for %s", product)
+      raise GribError('No GRIB2 variable table for %s'%product)
+   fields = PRODUCT_FIELDS[product]
+   if zero_process:
+      fields = fields[:ZERO_HOUR_NUM_FIELDS]
+   if names is not None:
+      fields = [f for f in fields if f[0] in names]
+   return fields
+
+#----------------------------------------------------------------------------
+def select(inventory, fields):
+   """Pick the message for each variable table entry
+
+   When more than one message matches (e.g. HRRR APCP accumulated since
+   initialization and over the last hour, or GFS 3h and 6h averages), the
+   one with the shortest statistical time range is used.
+
+   Parameters
+   ----------
+   inventory: list
+      Grib2_Index.Message per message of the file
+   fields: list
+      Variable table entries
+
+   Returns
+   -------
+   dict
+      Output name -> Grib2_Index.Message, for the entries found
+   """
+   chosen = {}
+   for (name, keys, scale, required, units, desc) in fields:
+      (discipline, category, number, levelType, level) = keys
+      best = None
+      for message in inventory:
+         header = message._header
+         if header[0:4] != (discipline, category, number, levelType):
+            continue
+         if level is not None and header[4] != level:
+            continue
+         if best is None or header[5] < best._header[5]:
+            best = message
+      if best is not None:
+         chosen[name] = best
+   return chosen
+
+#----------------------------------------------------------------------------
+def decode_message(f, message, scale=1.0):
+   """Decode one message of a GRIB2 file
+
+   Parameters
+   ----------
+   f: file
+      GRIB2 file opened 'rb'
+   message: Grib2_Index.Message
+      Its inventory entry
+   scale: float
+      Scale factor to the variable table units
+
+   Returns
+   -------
+   numpy.ndarray
+      Whole field (numpy.ma.MaskedArray where the message has a bitmap)
+   """
+   import pygrib
+
+   values = pygrib.fromstring(gi.read_message(f, message)).values
+   if scale != 1.0:
+      values = values*scale
+   return values
+
+#----------------------------------------------------------------------------
+def clip(values, footprint):
+   """Copy of the footprint (j0, j1, i0, i1) of a field, the field itself
+   if footprint is None"""
+   if footprint is None:
+      return values
+   (j0, j1, i0, i1) = footprint
+   return values[j0:j1, i0:i1].copy()
+
+#----------------------------------------------------------------------------
+def read_fields(product, srcFile, zero_process=False, footprint=None, names=None,
+                indexDir=None, fieldCache=None):
+   """Decode the fields a product needs from a GRIB2 file
+
+   Parameters
+   ----------
+   product: str
+      'HRRR', 'RAP', 'GFS', 'MRMS' or 'CFS'
+   srcFile: str
+      Full path to the GRIB2 input file
+   zero_process: bool
+      True for the 0hr (analysis and assimilation) variable set
+   footprint: tuple
+      (j0, j1, i0, i1) source box to keep, None for the whole field.
+      GRIB2 messages are decoded whole, the rest is dropped immediately.
+   names: list
+      Output names to read, None for the whole variable table
+   indexDir: str
+      GRIB2 index directory (see Grib2_Index), None for next to the file
+   fieldCache: Field_Cache.FieldCache
+      Decoded field cache: fields found there are not decoded again, the
+      fields decoded are added to it.  None for no caching.
+
+   Returns
+   -------
+   list
+      (name, numpy.ndarray, units, description) per field that was found,
+      in variable table order
+   """
+   start = time.time()
+   fields = field_table(product, zero_process, names)
+   decoded = {}
+   if fieldCache is not None:
+      for field in fields:
+         values = fieldCache.get(srcFile, field[0])
+         if values is not None:
+            decoded[field[0]] = values
+   ncached = len(decoded)
+   missing = [field for field in fields if field[0] not in decoded]
+
+   nbytes = 0
+   nmessages = 0
+   if missing:
+      inventory = gi.get_inventory(srcFile, indexDir)
+      nmessages = len(inventory)
+      chosen = select(inventory, missing)
+      f = open(srcFile, 'rb')
+      try:
+         for (name, keys, scale, required, units, desc) in missing:
+            if name not in chosen:
+               if required:
+                  WhfLog.error("%s missing from %s", name, srcFile)
+                  raise GribError('Required field %s not found in %s'%(name, srcFile))
+               WhfLog.debug("Optional field %s not in %s", name, srcFile)
+               continue
+            values = decode_message(f, chosen[name], scale)
+            nbytes += chosen[name]._length
+            if fieldCache is not None:
+               values = fieldCache.put(srcFile, name, values)
+            decoded[name] = values
+      finally:
+         f.close()
+
+   ret = []
+   for (name, keys, scale, required, units, desc) in fields:
+      if name not in decoded:
+         continue
+      ret.append((name, clip(decoded[name], footprint), units, desc))
+   WhfLog.debug("Time(sec) to decode %d of %d messages (%d of %d bytes, "
+                "%d fields cached) of %s: %s", len(ret) - ncached, nmessages,
+                nbytes, os.path.getsize(srcFile), ncached, srcFile,
+                time.time() - start)
+   return ret
+
+#----------------------------------------------------------------------------
+def read_arrays(product, srcFile, zero_process=False, names=None, indexDir=None,
+                fieldCache=None):
+   """Decoded fields of a GRIB2 file by output name
+
+   Returns
+   -------
+   dict
+      Output name -> numpy.ndarray (numpy.ma.MaskedArray where the
+      message has a bitmap), scaled to the table units; read only when
+      loaded from the field cache
+   """
+   ret = {}
+   for (name, values, units, desc) in read_fields(product, srcFile, zero_process,
+                                                  None, names, indexDir,
+                                                  fieldCache):
+      ret[name] = values
+   return ret
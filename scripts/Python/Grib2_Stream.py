@@ -0,0 +1,284 @@
+"""Grib2_Stream
+Ingest of GRIB2 files while they are still being written.  HRRR and GFS
+files grow on disk for minutes, and a file found by name may be
+partial.  A GrowingFile tails the file: each poll scans only the bytes
+added since the last one, a message counts once its whole length (from
+its section 0 header) is on disk, and the messages a product needs are
+decoded as soon as they land.  The file is complete for the product
+once the expected message set (Grib2_Reader variable table) is present,
+with no need to wait for the file to stop growing.
+
+The expected set is the required fields, plus the optional ones
+(accumulations and averages) when the file is a forecast (forecast
+time > 0) and not a 0hr (zero_process) read.  An HRRR or RAP file has
+precipitation accumulated since initialization as well as over the
+last hour; RAINRATE is the last hour and its field only counts as
+present once a message with that time range is seen.
+
+Streaming is configured per product with [triggering]
+<product>_stream_timeout, the number of seconds to wait for a file to
+be complete (not set or 0: files are read as they are found).
+"""
+
+import time
+import WhfLog
+import Grib2_Index as gi
+import Grib2_Reader as gr
+from ForcingEngineError import GribError
+
+# Seconds between polls of a growing file
+POLL_SECONDS = 2.0
+
+# Time range (hours) the statistically processed fields must have for a
+# product, fields not listed take the shortest one seen
+_FIELD_TIME_RANGE = {'HRRR': {'RAINRATE': 1}, 'RAP': {'RAINRATE': 1}}
+
+#----------------------------------------------------------------------------
+class GrowingFile:
+   """A GRIB2 file being written, with the fields decoded so far
+
+   Attributes
+   ----------
+   _product: str
+      'HRRR', 'RAP', 'GFS', 'MRMS' or 'CFS'
+   _srcFile: str
+      GRIB2 file
+   _fields: list
+      Grib2_Reader variable table entries wanted
+   _zeroProcess: bool
+      True for the 0hr (analysis and assimilation) variable set
+   _messages: list
+      Grib2_Index.Message per complete message so far
+   _offset: int
+      Byte offset just past the last complete message
+   _decoded: dict
+      Output name -> (Grib2_Index.Message, whole field) of the fields
+      decoded so far
+   """
+
+   #--------------------------------------------------------------------------
+   def __init__(self, product, srcFile, zero_process=False):
+      """Initialization using input args
+
+      Parameters
+      ----------
+      product: str
+         'HRRR', 'RAP', 'GFS', 'MRMS' or 'CFS'
+      srcFile: str
+         GRIB2 file
+      zero_process: bool
+         True for the 0hr (analysis and assimilation) variable set
+      """
+      self._product = product
+      self._srcFile = srcFile
+      self._fields = gr.field_table(product, zero_process)
+      self._zeroProcess = zero_process
+      self._messages = []
+      self._offset = 0
+      self._decoded = {}
+
+   #--------------------------------------------------------------------------
+   def debugPrint(self):
+      """ Debug logging of content
+      """
+      WhfLog.debug("%s: %d messages, %d bytes, decoded %s", self._srcFile,
+                   len(self._messages), self._offset,
+                   str(sorted(self._decoded.keys())))
+
+   #--------------------------------------------------------------------------
+   def poll(self):
+      """Add the messages completed since the last poll
+
+      Returns
+      -------
+      int
+         Number of messages added
+      """
+      new = gi.scan_file(self._srcFile, False, self._offset,
+                         len(self._messages) + 1)
+      if new:
+         self._messages.extend(new)
+         self._offset = new[-1]._offset + new[-1]._length
+      return len(new)
+
+   #--------------------------------------------------------------------------
+   def _chosen(self):
+      """Output name -> message, of the fields present and usable"""
+      chosen = gr.select(self._messages, self._fields)
+      timeRanges = _FIELD_TIME_RANGE.get(self._product, {})
+      for name in chosen.keys():
+         if name in timeRanges and \
+            chosen[name]._header[5] > timeRanges[name]:
+            del chosen[name]
+      return chosen
+
+   #--------------------------------------------------------------------------
+   def _expected(self):
+      """Output names of the expected message set"""
+      names = [f[0] for f in self._fields if f[3]]
+      if self._zeroProcess:
+         return names
+      # the optional fields are there in forecasts, known from the
+      # forecast time of the first required field
+      first = gr.select(self._messages, self._fields[:1])
+      if not first:
+         return [f[0] for f in self._fields]
+      if first.values()[0]._forecastTime > 0:
+         return [f[0] for f in self._fields]
+      return names
+
+   #--------------------------------------------------------------------------
+   def decodeReady(self):
+      """Decode the wanted fields whose message has landed (again if a
+      better message landed since)
+
+      Returns
+      -------
+      int
+         Number of messages decoded
+      """
+      chosen = self._chosen()
+      todo = [f for f in self._fields if f[0] in chosen and
+              (f[0] not in self._decoded or
+               self._decoded[f[0]][0] is not chosen[f[0]])]
+      if not todo:
+         return 0
+      f = open(self._srcFile, 'rb')
+      try:
+         for (name, keys, scale, required, units, desc) in todo:
+            self._decoded[name] = (chosen[name],
+                                   gr.decode_message(f, chosen[name], scale))
+      finally:
+         f.close()
+      return len(todo)
+
+   #--------------------------------------------------------------------------
+   def isComplete(self):
+      """True once the expected message set is present"""
+      chosen = self._chosen()
+      for name in self._expected():
+         if name not in chosen:
+            return False
+      return True
+
+   #--------------------------------------------------------------------------
+   def missing(self):
+      """Output names of the expected set not present yet"""
+      chosen = self._chosen()
+      return [name for name in self._expected() if name not in chosen]
+
+   #--------------------------------------------------------------------------
+   def fields(self, footprint=None):
+      """Decoded fields, as Grib2_Reader.read_fields
+
+      Parameters
+      ----------
+      footprint: tuple
+         (j0, j1, i0, i1) source box to keep, None for the whole field
+
+      Returns
+      -------
+      list
+         (name, numpy.ndarray, units, description) per decoded field, in
+         variable table order
+      """
+      ret = []
+      for (name, keys, scale, required, units, desc) in self._fields:
+         if name in self._decoded:
+            ret.append((name, gr.clip(self._decoded[name][1], footprint),
+                        units, desc))
+      return ret
+
+#----------------------------------------------------------------------------
+def _follow(growing, timeout, decode):
+   """Poll a GrowingFile until it is complete
+
+   Parameters
+   ----------
+   growing: GrowingFile
+      The file
+   timeout: float
+      Seconds to wait for the expected message set
+   decode: bool
+      True to decode the fields as their messages land
+
+   Returns
+   -------
+   None
+   """
+   start = time.time()
+   while True:
+      growing.poll()
+      if decode:
+         growing.decodeReady()
+      if growing.isComplete():
+         break
+      if time.time() - start > timeout:
+         growing.debugPrint()
+         WhfLog.error("%s incomplete after %d seconds, missing %s",
+                      growing._srcFile, timeout, str(growing.missing()))
+         raise GribError('%s incomplete after %d seconds'%(growing._srcFile,
+                                                          timeout))
+      time.sleep(POLL_SECONDS)
+   WhfLog.debug("%s complete for %s after %s seconds, %d messages",
+                growing._srcFile, growing._product, time.time() - start,
+                len(growing._messages))
+
+#----------------------------------------------------------------------------
+def stream_fields(product, srcFile, zero_process=False, footprint=None,
+                  timeout=600):
+   """Decode the fields a product needs from a GRIB2 file that may still
+   be being written, as their messages land
+
+   Parameters
+   ----------
+   product: str
+      'HRRR', 'RAP', 'GFS', 'MRMS' or 'CFS'
+   srcFile: str
+      GRIB2 file
+   zero_process: bool
+      True for the 0hr (analysis and assimilation) variable set
+   footprint: tuple
+      (j0, j1, i0, i1) source box to keep, None for the whole field
+   timeout: float
+      Seconds to wait for the expected message set
+
+   Returns
+   -------
+   list
+      As Grib2_Reader.read_fields
+   """
+   growing = GrowingFile(product, srcFile, zero_process)
+   _follow(growing, timeout, True)
+   return growing.fields(footprint)
+
+#----------------------------------------------------------------------------
+def wait_complete(product, srcFile, zero_process=False, timeout=600):
+   """Wait until a GRIB2 file that may still be being written holds the
+   messages a product needs (before it is handed to an NCL script)
+
+   Parameters
+   ----------
+   As stream_fields
+
+   Returns
+   -------
+   None
+   """
+   _follow(GrowingFile(product, srcFile, zero_process), timeout, False)
+
+#----------------------------------------------------------------------------
+def is_complete(product, srcFile, zero_process=False):
+   """True if a GRIB2 file already holds the messages a product needs"""
+   growing = GrowingFile(product, srcFile, zero_process)
+   growing.poll()
+   return growing.isComplete()
+
+#----------------------------------------------------------------------------
+def get_stream_timeout(parser, product):
+   """Seconds to wait for a growing file of a product, from the
+   [triggering] section, 0 if the product is not streamed"""
+   option = product.upper() + '_stream_timeout'
+   if not parser.has_option('triggering', option):
+      return 0
+   return max(0, parser.getint('triggering', option))
@@ -0,0 +1,407 @@
+"""Mrms_Accumulator
+Sub-hourly MRMS ingest.  The gauge corrected 1 hour QPE (the MRMS_data
+files regridded by Regrid_Driver) is only available well after its
+hour closes.  MRMS also issues an instantaneous precipitation rate
+(PrecipRate) every 2 minutes; each of those files is decoded as soon as
+it is found, on the source footprint of the MRMS weights only, and
+added to a running accumulation of the hour it belongs to, so the hour
+is ready to regrid as soon as its last step lands.
+
+A step file valid at t covers the step_minutes before t and belongs to
+the hour ending at t rounded up to the hour (HH:00 closes hour HH).  The
+accumulation of each hour (mm, with the number of valid steps per cell
+and the steps already added) is kept in one .npz file in the
+[data_dir] MRMS_subhourly_buffer directory, replaced atomically after
+each pass, so a pass that dies adds its steps again on the next one.
+
+An hour is closed when all its steps are in, or once data LATE_MINUTES
+past the hour is found with at least MIN_FRACTION of the steps in; the
+accumulation is then scaled up by the missing steps, per cell (cells
+with fewer valid steps than that are missing).  Hours that cannot be
+closed are left to the 1 hour product.  A closed hour is regridded
+in-process as a MRMS file (precip_rate, mm s^-1) and moved to the MRMS
+finished area; the regridded gauge corrected file of the same hour
+replaces it when it comes in.
+
+Usage: python Mrms_Accumulator.py <config file>, run every minute or so
+like Regrid_Driver.
+"""
+
+import os
+import re
+import sys
+import math
+import time
+import datetime
+import tempfile
+from ConfigParser import SafeConfigParser
+import numpy as np
+import WhfLog
+import WRF_Hydro_forcing as whf
+import Grib2_Index as gi
+import Grib2_Reader as gr
+import Regrid_Engine as rge
+import Weight_Cache as wc
+from ForcingEngineError import GribError
+
+# Minutes between the MRMS PrecipRate files
+DEFAULT_STEP_MINUTES = 2
+
+# Minutes past the end of an hour after which it is closed with the steps
+# it has (if enough)
+LATE_MINUTES = 10
+
+# Fraction of the steps of an hour needed to close it, also per cell
+MIN_FRACTION = 0.75
+
+# Valid time of a PrecipRate file: YYYYMMDD-HHMMSS
+_FILE_TIME = re.compile(r'.*([0-9]{8})[-_]([0-9]{2})([0-9]{2})([0-9]{2})')
+
+#----------------------------------------------------------------------------
+def step_time(fileName):
+   """Valid time of a PrecipRate file, None if its name has none"""
+   match = _FILE_TIME.match(os.path.basename(fileName))
+   if not match:
+      return None
+   return datetime.datetime.strptime(''.join(match.groups()), '%Y%m%d%H%M%S')
+
+#----------------------------------------------------------------------------
+def hour_ending(t):
+   """End of the hour a step valid at t belongs to"""
+   hour = t.replace(minute=0, second=0, microsecond=0)
+   if hour == t:
+      return hour
+   return hour + datetime.timedelta(hours=1)
+
+#----------------------------------------------------------------------------
+class HourBuffer:
+   """Running accumulation of one hour
+
+   Attributes
+   ----------
+   _path: str
+      The .npz file of the hour
+   _hour: datetime.datetime
+      End of the hour
+   _stepMinutes: int
+      Minutes per step
+   _sum: numpy.ndarray
+      float32 accumulation (mm) over the valid steps, None before the
+      first step
+   _valid: numpy.ndarray
+      uint8 number of valid steps per cell
+   _steps: list
+      Minutes into the hour of the steps added
+   """
+
+   #--------------------------------------------------------------------------
+   def __init__(self, bufferDir, hour, stepMinutes):
+      """Initialization using input args, with the steps saved so far
+
+      Parameters
+      ----------
+      bufferDir: str
+         Buffer directory
+      hour: datetime.datetime
+         End of the hour
+      stepMinutes: int
+         Minutes per step
+      """
+      self._path = os.path.join(bufferDir, hour.strftime('%Y%m%d%H') + '.npz')
+      self._hour = hour
+      self._stepMinutes = stepMinutes
+      self._sum = None
+      self._valid = None
+      self._steps = []
+      if os.path.exists(self._path):
+         saved = np.load(self._path)
+         try:
+            self._sum = saved['sum']
+            self._valid = saved['valid']
+            self._steps = saved['steps'].tolist()
+         finally:
+            saved.close()
+
+   #--------------------------------------------------------------------------
+   def debugPrint(self):
+      """ Debug logging of content
+      """
+      WhfLog.debug("MRMS hour ending %s: %d of %d steps", str(self._hour),
+                   len(self._steps), self.numExpected())
+
+   #--------------------------------------------------------------------------
+   def numExpected(self):
+      """Number of steps in a full hour"""
+      return 60/self._stepMinutes
+
+   #--------------------------------------------------------------------------
+   def hasStep(self, minute):
+      """True if the step ending minute minutes into the hour is in"""
+      return minute in self._steps
+
+   #--------------------------------------------------------------------------
+   def add(self, minute, rate):
+      """Add one step
+
+      Parameters
+      ----------
+      minute: int
+         Minutes into the hour at the end of the step
+      rate: numpy.ndarray
+         Precipitation rate (mm hr^-1), masked or negative where missing
+
+      Returns
+      -------
+      None
+      """
+      data = np.ma.getdata(rate)
+      missing = np.ma.getmaskarray(rate) | (data < 0.0)
+      if self._sum is not None and self._sum.shape != data.shape:
+         # the weights (footprint) changed, start the hour over
+         WhfLog.warning("MRMS hour ending %s restarted, grid changed", str(self._hour))
+         self._sum = None
+         self._steps = []
+      if self._sum is None:
+         self._sum = np.zeros(data.shape, dtype=np.float32)
+         self._valid = np.zeros(data.shape, dtype=np.uint8)
+      self._sum += np.where(missing, 0.0, data*(self._stepMinutes/60.0)).astype(np.float32)
+      self._valid += ~missing
+      self._steps.append(minute)
+
+   #--------------------------------------------------------------------------
+   def save(self):
+      """Write the accumulation, atomically"""
+      fd, tmpName = tempfile.mkstemp(dir=os.path.dirname(self._path),
+                                     prefix='.' + os.path.basename(self._path))
+      try:
+         f = os.fdopen(fd, 'wb')
+         try:
+            np.savez(f, sum=self._sum, valid=self._valid,
+                     steps=np.array(self._steps, dtype=np.int32))
+         finally:
+            f.close()
+         os.rename(tmpName, self._path)
+      except:
+         if os.path.exists(tmpName):
+            os.remove(tmpName)
+         raise
+
+   #--------------------------------------------------------------------------
+   def canClose(self, late):
+      """True if the hour is complete, or late with enough steps"""
+      if len(self._steps) >= self.numExpected():
+         return True
+      return late and len(self._steps) >= MIN_FRACTION*self.numExpected()
+
+   #--------------------------------------------------------------------------
+   def accumulation(self):
+      """Hourly accumulation (mm), scaled up per cell by the steps missing
+      there
+
+      Returns
+      -------
+      numpy.ma.MaskedArray
+         float32, masked where less than MIN_FRACTION of the steps are
+         valid
+      """
+      n = self.numExpected()
+      valid = self._valid.astype(np.float32)
+      ok = valid >= math.ceil(MIN_FRACTION*n)
+      acc = np.where(ok, self._sum*(n/np.maximum(valid, 1.0)), 0.0)
+      return np.ma.array(acc.astype(np.float32), mask=~ok)
+
+   #--------------------------------------------------------------------------
+   def close(self):
+      """Replace the accumulation by a marker that the hour is done"""
+      open(self.donePath(), 'w').close()
+      if os.path.exists(self._path):
+         os.remove(self._path)
+
+   #--------------------------------------------------------------------------
+   def donePath(self):
+      """Marker file of a closed hour"""
+      return self._path[:-len('.npz')] + '.done'
+
+   #--------------------------------------------------------------------------
+   def isClosed(self):
+      """True if the hour was closed already"""
+      return os.path.exists(self.donePath())
+
+#----------------------------------------------------------------------------
+def find_steps(dataDir, oldestHour):
+   """PrecipRate files by hour
+
+   Parameters
+   ----------
+   dataDir: str
+      PrecipRate directory
+   oldestHour: datetime.datetime
+      End of the oldest hour to look at, None for all
+
+   Returns
+   -------
+   dict
+      End of hour -> [(valid time, file)] in time order
+   """
+   steps = {}
+   for f in os.listdir(dataDir):
+      t = step_time(f)
+      if t is None or f.startswith('.') or f.endswith(gi.INDEX_SUFFIX):
+         continue
+      hour = hour_ending(t)
+      if oldestHour is not None and hour < oldestHour:
+         continue
+      steps.setdefault(hour, []).append((t, os.path.join(dataDir, f)))
+   for hour in steps.keys():
+      steps[hour].sort()
+   return steps
+
+#----------------------------------------------------------------------------
+def output_file(parser, hour):
+   """Regridded file of an hour, named as Regrid_Driver names the MRMS
+   1 hour files"""
+   ymdh = hour.strftime('%Y%m%d%H')
+   return os.path.join(parser.get('regridding', 'MRMS_output_dir'), ymdh,
+                       ymdh + '00.LDASIN_DOMAIN1.nc')
+
+#----------------------------------------------------------------------------
+def regrid_hour(parser, buf):
+   """Regrid the accumulation of an hour and move it to the finished area
+
+   Parameters
+   ----------
+   parser: ConfigParser
+      Parser to the config/parm file
+   buf: HourBuffer
+      The hour
+
+   Returns
+   -------
+   None
+   """
+   outFile = output_file(parser, buf._hour)
+   whf.mkdir_p(os.path.dirname(outFile))
+   rate = buf.accumulation()/np.float32(3600.0)
+   rge.regrid_fields('MRMS', [('precip_rate', rate, 'mm s^-1', 'RAINRATE')],
+                     parser.get('regridding', 'MRMS_wgt_bilinear'),
+                     parser.get('regridding', 'MRMS_dst_grid_name'), outFile,
+                     wc.get_cache_dir(parser), whf.get_regrid_threads(parser),
+                     whf.get_regrid_kernel(parser, 'MRMS'),
+                     wc.get_weight_order(parser), rge.get_precision(parser))
+   whf.move_to_finished_area(parser, 'MRMS', outFile)
+
+#----------------------------------------------------------------------------
+def accumulate(parser):
+   """Add the new PrecipRate files to their hours, and regrid the hours
+   that can be closed
+
+   Parameters
+   ----------
+   parser: ConfigParser
+      Parser to the config/parm file
+
+   Returns
+   -------
+   list
+      End of hour of the hours regridded
+   """
+   dataDir = parser.get('data_dir', 'MRMS_subhourly_data')
+   bufferDir = parser.get('data_dir', 'MRMS_subhourly_buffer')
+   stepMinutes = DEFAULT_STEP_MINUTES
+   if parser.has_option('data_dir', 'MRMS_subhourly_minutes'):
+      stepMinutes = parser.getint('data_dir', 'MRMS_subhourly_minutes')
+   hoursBack = parser.getint('triggering', 'MRMS_hours_back')
+   whf.mkdir_p(bufferDir)
+
+   # the newest step found is "now", so archive data closes hours as
+   # real time data does
+   steps = find_steps(dataDir, None)
+   if not steps:
+      return []
+   newest = max([s[-1][0] for s in steps.values()])
+   oldestHour = hour_ending(newest) - datetime.timedelta(hours=hoursBack)
+   purge(bufferDir, oldestHour)
+
+   weights = rge.get_weights(parser.get('regridding', 'MRMS_wgt_bilinear'),
+                             parser.get('regridding', 'MRMS_dst_grid_name'),
+                             wc.get_cache_dir(parser),
+                             whf.get_regrid_kernel(parser, 'MRMS'),
+                             wc.get_weight_order(parser),
+                             rge.get_precision(parser))
+   indexDir = gi.get_index_dir(parser)
+   closed = []
+   for hour in sorted(steps.keys()):
+      if hour < oldestHour:
+         continue
+      buf = HourBuffer(bufferDir, hour, stepMinutes)
+      if buf.isClosed():
+         continue
+      start = time.time()
+      added = 0
+      for (t, srcFile) in steps[hour]:
+         minute = 60 - int((hour - t).total_seconds())/60
+         if buf.hasStep(minute):
+            continue
+         try:
+            fields = gr.read_fields('MRMS_RATE', srcFile, False,
+                                    weights.footprint(), None, indexDir)
+         except GribError as e:
+            # most likely still being written, next pass
+            WhfLog.warning("Cannot read %s yet: %s", srcFile, e)
+            continue
+         buf.add(minute, fields[0][1])
+         added += 1
+      if added:
+         buf.save()
+         WhfLog.info("Time(sec) to add %d MRMS steps to hour ending %s: %s",
+                     added, str(hour), time.time() - start)
+      buf.debugPrint()
+      late = newest >= hour + datetime.timedelta(minutes=LATE_MINUTES)
+      if buf.canClose(late):
+         regrid_hour(parser, buf)
+         buf.close()
+         closed.append(hour)
+      elif late:
+         WhfLog.warning("MRMS hour ending %s has %d of %d steps, left to the 1 hour product",
+                        str(hour), len(buf._steps), buf.numExpected())
+         buf.close()
+   return closed
+
+#----------------------------------------------------------------------------
+def purge(bufferDir, oldestHour):
+   """Remove the buffer files (and left over temporary files) of the
+   hours ending before oldestHour"""
+   for f in os.listdir(bufferDir):
+      try:
+         hour = datetime.datetime.strptime(f.lstrip('.')[:10], '%Y%m%d%H')
+      except ValueError:
+         continue
+      if hour < oldestHour:
+         os.remove(os.path.join(bufferDir, f))
+
+#----------------------------------------------------------------------------
+def main(argv):
+   """Accumulate the sub-hourly MRMS files configured in a config file
+
+   Parameters
+   ----------
+   argv: list
+      [config file]
+
+   Returns
+   -------
+   1 for error, 0 for success
+   """
+   if len(argv) != 1 or not os.path.exists(argv[0]):
+      print 'Usage: python Mrms_Accumulator.py <config file>'
+      return 1
+   parser = SafeConfigParser()
+   parser.read(argv[0])
+   WhfLog.init(parser, 'RegridMRMS', False)
+   accumulate(parser)
+   return 0
+
+#----------------------------------------------
+
+if __name__ == "__main__":
+   sys.exit(main(sys.argv[1:]))
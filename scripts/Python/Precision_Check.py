@@ -0,0 +1,163 @@
+"""Precision_Check
+Runs one GRIB2 file of a product through the in-process decoding,
+regridding and downscaling in double and in single precision
+([precision] mode), with the weight, kernel and terrain settings of a
+config file, and compares the results field by field.  Reports the time
+and process RSS of each stage in each precision, and fails if a field
+differs by more than its TOLERANCES.  Run on real data before switching
+a product to single precision:
+
+   python Precision_Check.py <config file> <product> <GRIB2 file> [YYYYMMDDhh]
+
+With a valid time, SWDOWN is terrain adjusted as in the downscaling.
+"""
+
+import os
+import sys
+import time
+import datetime
+import numpy as np
+from ConfigParser import SafeConfigParser
+import WhfLog
+import WRF_Hydro_forcing as whf
+import Grib2_Reader as gr
+import Regrid_Engine as rge
+import Downscale_Engine as dse
+import Stage_Pipeline as sp
+import Weight_Cache as wc
+import Terrain_Cache as tc
+from Regrid_Engine import FILL_VALUE
+
+# Largest relative difference between the single and the double precision
+# results, per field, over the cells that are not missing
+TOLERANCES = {'T2D': 1.0e-6, 'Q2D': 1.0e-5, 'U2D': 1.0e-5, 'V2D': 1.0e-5,
+              'PSFC': 1.0e-6, 'RAINRATE': 1.0e-5, 'SWDOWN': 1.0e-5,
+              'LWDOWN': 1.0e-5}
+
+# Denominator floor of the relative differences, so that near zero values
+# (winds, precipitation) are compared in absolute terms
+_REL_FLOOR = 1.0e-3
+
+#----------------------------------------------------------------------------
+def run(parser, product, srcFile, validTime, precision):
+   """Regrid (and downscale) one file in one precision
+
+   Returns
+   -------
+   tuple
+      (dict of the final fields by name, list of (stage, seconds, RSS MB))
+   """
+   stages = []
+   start = time.time()
+   fields = gr.read_fields(product, srcFile)
+   stages.append(('decode', time.time() - start, sp.rss_mb()))
+
+   start = time.time()
+   regridded = rge.regrid_fields(product, fields,
+                                 parser.get('regridding',
+                                            product + '_wgt_bilinear'),
+                                 parser.get('regridding',
+                                            product + '_dst_grid_name'),
+                                 None, wc.get_cache_dir(parser),
+                                 whf.get_regrid_threads(parser),
+                                 whf.get_regrid_kernel(parser, product),
+                                 wc.get_weight_order(parser), precision)
+   stages.append(('regrid', time.time() - start, sp.rss_mb()))
+   if product == 'MRMS':
+      return (dict([(r[0], r[1]) for r in regridded]), stages)
+
+   geoFile = parser.get('downscaling', product + '_geo_data')
+   start = time.time()
+   downscaled = dse.downscale_regridded(regridded,
+                                        parser.get('downscaling',
+                                                   product + '_hgt_data'),
+                                        geoFile,
+                                        parser.get('downscaling',
+                                                   'lapse_rate_file'),
+                                        validTime, tc.get_cache_dir(parser),
+                                        whf.get_shortwave_adjust(parser,
+                                                                 geoFile),
+                                        precision)
+   stages.append(('downscale', time.time() - start, sp.rss_mb()))
+   return (dict([(d[0], d[1]) for d in downscaled]), stages)
+
+#----------------------------------------------------------------------------
+def compare(double, single):
+   """Differences of the single precision fields to the double ones
+
+   Returns
+   -------
+   list
+      (name, max abs difference, max relative difference, within
+      TOLERANCES) per field
+   """
+   results = []
+   for name in sorted(double.keys()):
+      ref = np.asarray(double[name], dtype=np.float64)
+      values = np.asarray(single[name], dtype=np.float64)
+      ok = ref != FILL_VALUE
+      if not np.array_equal(ok, values != FILL_VALUE):
+         # missing cells moved, no tolerance covers that
+         results.append((name, np.inf, np.inf, False))
+         continue
+      if not ok.any():
+         results.append((name, 0.0, 0.0, True))
+         continue
+      diff = np.abs(values[ok] - ref[ok])
+      rel = diff/np.maximum(np.abs(ref[ok]), _REL_FLOOR)
+      results.append((name, diff.max(), rel.max(),
+                      rel.max() <= TOLERANCES.get(name, 0.0)))
+   return results
+
+#----------------------------------------------------------------------------
+def main(argv):
+   """Check the single precision results of one file
+
+   Parameters
+   ----------
+   argv: list
+      [config file, product, GRIB2 file, optional valid time YYYYMMDDhh]
+
+   Returns
+   -------
+   1 for error or a field out of tolerance, 0 for success
+   """
+   if len(argv) < 3 or len(argv) > 4 or not os.path.exists(argv[0]) or \
+      argv[1] not in rge.SUPPORTED_PRODUCTS or not os.path.exists(argv[2]):
+      print 'Usage: python Precision_Check.py <config file> <product> ' \
+            '<GRIB2 file> [YYYYMMDDhh]'
+      return 1
+   parser = SafeConfigParser()
+   parser.read(argv[0])
+   (product, srcFile) = (argv[1], argv[2])
+   validTime = None
+   if len(argv) == 4:
+      validTime = datetime.datetime.strptime(argv[3], '%Y%m%d%H')
+
+   (double, doubleStages) = run(parser, product, srcFile, validTime, 'double')
+   (single, singleStages) = run(parser, product, srcFile, validTime, 'single')
+
+   print '%-10s %10s %10s %10s %10s'%('stage', 'double s', 'single s',
+                                      'double MB', 'single MB')
+   for (d, s) in zip(doubleStages, singleStages):
+      print '%-10s %10.3f %10.3f %10.1f %10.1f'%(d[0], d[1], s[1], d[2], s[2])
+   print 'peak RSS %.1f MB'%sp.peak_rss_mb()
+
+   print '%-10s %12s %12s %12s'%('field', 'max abs', 'max rel', 'tolerance')
+   failed = 0
+   for (name, absDiff, relDiff, within) in compare(double, single):
+      print '%-10s %12.3e %12.3e %12.1e %s'%(name, absDiff, relDiff,
+                                             TOLERANCES.get(name, 0.0),
+                                             '' if within else 'EXCEEDED')
+      if not within:
+         WhfLog.error("%s single precision difference %s above tolerance",
+                      name, relDiff)
+         failed += 1
+   if failed:
+      return 1
+   return 0
+
+#----------------------------------------------------------------------------
+
+if __name__ == "__main__":
+   sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,129 @@
+"""Regrid_Benchmark
+Times the in-process regridding of each product with the weight cache
+layouts and kernels available (sparse matrix in native and tile order,
+4-point gather), using random fields on the source grid.  Run on the
+target nodes to choose [regridding] weight_order and regrid_kernel:
+
+   python Regrid_Benchmark.py <config file> [repeats]
+
+Regrid_Check checks that the kernels give the same results.
+"""
+
+import os
+import sys
+import time
+import numpy as np
+from ConfigParser import SafeConfigParser
+import WhfLog
+import Grib2_Reader as gr
+import Regrid_Engine as rge
+import Weight_Cache as wc
+
+# (kernel, weight order) combinations timed, the first is the reference
+LAYOUTS = [('csr', 'native'), ('csr', 'tile'), ('gather', 'native')]
+
+#----------------------------------------------------------------------------
+def time_layout(weights, fields, numThreads, repeats):
+   """Best wall time of applyBatch over repeats runs
+
+   Parameters
+   ----------
+   weights: Regrid_Engine.RegridWeights
+      Weights to time
+   fields: list
+      Source fields
+   numThreads: int
+      Threads for applyBatch
+   repeats: int
+      Number of timed runs (after one untimed warm up run)
+
+   Returns
+   -------
+   tuple
+      (best time in seconds, regridded fields)
+   """
+   out = weights.applyBatch(fields, numThreads)
+   best = None
+   for r in range(repeats):
+      start = time.time()
+      weights.applyBatch(fields, numThreads)
+      elapsed = time.time() - start
+      if best is None or elapsed < best:
+         best = elapsed
+   return (best, out)
+
+#----------------------------------------------------------------------------
+def benchmark(product, wgtFile, dstGridName, cacheDir, numThreads, repeats):
+   """Time and cross check all LAYOUTS for one product
+
+   Returns
+   -------
+   list
+      (kernel, order, seconds, speedup, max abs difference) per layout
+   """
+   results = []
+   reference = None
+   fields = None
+   for (kernel, order) in LAYOUTS:
+      weights = wc.load(wgtFile, dstGridName, cacheDir, kernel, order)
+      if kernel == 'gather' and not isinstance(weights, rge.GatherWeights):
+         # not 4-point bilinear, nothing to time
+         continue
+      if fields is None:
+         np.random.seed(0)
+         fields = [np.random.rand(*weights._srcShape).astype(np.float32)
+                   for f in gr.PRODUCT_FIELDS[product]]
+      (seconds, out) = time_layout(weights, fields, numThreads, repeats)
+      if reference is None:
+         reference = (seconds, out)
+      diff = max([np.abs(a - b).max() for (a, b) in zip(reference[1], out)])
+      results.append((kernel, order, seconds, reference[0]/seconds, diff))
+   return results
+
+#----------------------------------------------------------------------------
+def main(argv):
+   """Benchmark every product configured in a config file
+
+   Parameters
+   ----------
+   argv: list
+      [config file, optional number of repeats]
+
+   Returns
+   -------
+   1 for error, 0 for success
+   """
+   if len(argv) < 1 or len(argv) > 2 or not os.path.exists(argv[0]):
+      print 'Usage: python Regrid_Benchmark.py <config file> [repeats]'
+      return 1
+   repeats = 3
+   if len(argv) == 2:
+      repeats = int(argv[1])
+   parser = SafeConfigParser()
+   parser.read(argv[0])
+   cacheDir = wc.get_cache_dir(parser)
+   if cacheDir is None:
+      print 'ERROR weight_cache_dir not set in [regridding] of', argv[0]
+      return 1
+   numThreads = 1
+   if parser.has_option('regridding', 'regrid_threads'):
+      numThreads = parser.getint('regridding', 'regrid_threads')
+
+   print '%-7s %-7s %-7s %10s %8s %10s'%('product', 'kernel', 'order',
+                                         'seconds', 'speedup', 'max diff')
+   for product in rge.SUPPORTED_PRODUCTS:
+      wgtFile = parser.get('regridding', product + '_wgt_bilinear')
+      dstGridName = parser.get('regridding', product + '_dst_grid_name')
+      if not os.path.exists(wgtFile):
+         WhfLog.warning("Weight file %s not found, skipping %s", wgtFile, product)
+         continue
+      for (kernel, order, seconds, speedup, diff) in \
+          benchmark(product, wgtFile, dstGridName, cacheDir, numThreads, repeats):
+         print '%-7s %-7s %-7s %10.3f %8.2f %10.2e'%(product, kernel, order,
+                                                      seconds, speedup, diff)
+   return 0
+
+#----------------------------------------------------------------------------
+
+if __name__ == "__main__":
+   sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,218 @@
+"""Regrid_Check
+Checks that every regridding kernel and weight layout gives the results
+of the reference, the sparse matrix read straight from the ESMF weight
+file (Regrid_Engine.read_esmf_weights): the sparse matrix in native and
+tile order, the 4-point gather and the sparse (transposed) kernel, all
+loaded through the weight cache.  The values must agree to float32
+rounding (TOLERANCE) and the missing (FILL_VALUE) cells exactly, on
+random fields with and without missing source cells and on a mostly
+zero field.
+
+   python Regrid_Check.py <config file>
+
+checks the weight files of every product configured, and
+
+   python Regrid_Check.py
+
+checks weights made by Weight_Generator from synthetic curvilinear
+(Lambert like) and regular latitude-longitude source grids onto a
+destination grid they only partly cover.  Exits with 1 if a kernel does
+not match.
+"""
+
+import os
+import sys
+import shutil
+import tempfile
+import numpy as np
+from ConfigParser import SafeConfigParser
+import WhfLog
+import Regrid_Engine as rge
+import Weight_Cache as wc
+import Weight_Generator as wg
+from Regrid_Engine import FILL_VALUE
+
+# (kernel, weight order) combinations checked against the reference
+KERNELS = [('csr', 'native'), ('csr', 'tile'), ('gather', 'native'),
+           ('sparse', 'native'), ('sparse', 'tile')]
+
+# Largest difference to the reference, relative to the reference value
+# (to 1 below 1)
+TOLERANCE = 1.0e-5
+
+#----------------------------------------------------------------------------
+def check_fields(srcShape):
+   """Source fields of the check: smooth values, the same with missing
+   cells, and a mostly zero field with missing cells (as MRMS)"""
+   rng = np.random.RandomState(0)
+   (ny, nx) = srcShape
+   (y, x) = np.mgrid[0:ny, 0:nx]
+   smooth = (280.0 + 20.0*np.sin(y/7.0)*np.cos(x/11.0) +
+             rng.rand(ny, nx)).astype(np.float32)
+   missing = np.ma.array(smooth, mask=rng.rand(ny, nx) < 0.02)
+   sparse = rng.rand(ny, nx).astype(np.float32)
+   sparse[rng.rand(ny, nx) < 0.9] = 0.0
+   sparse = np.ma.array(sparse, mask=rng.rand(ny, nx) < 0.01)
+   return [smooth, missing, sparse]
+
+#----------------------------------------------------------------------------
+def regrid(weights, kernel, fields):
+   """Regridded fields with one kernel, dense with FILL_VALUE"""
+   if kernel == 'sparse':
+      return [weights.applySparse(rge.sparse_from_dense(weights.subset(f))).dense()
+              for f in fields]
+   return weights.applyBatch(fields)
+
+#----------------------------------------------------------------------------
+def compare(reference, values):
+   """Largest relative difference over the cells with data, and True if
+   the FILL_VALUE cells are the same"""
+   diff = 0.0
+   sameFill = True
+   for (ref, out) in zip(reference, values):
+      ok = ref != FILL_VALUE
+      if not np.array_equal(ok, out != FILL_VALUE):
+         sameFill = False
+      both = ok & (out != FILL_VALUE)
+      if both.any():
+         ref64 = ref[both].astype(np.float64)
+         rel = np.abs(out[both] - ref64)/np.maximum(np.abs(ref64), 1.0)
+         diff = max(diff, rel.max())
+   return (diff, sameFill)
+
+#----------------------------------------------------------------------------
+def check(wgtFile, dstGridName, cacheDir):
+   """Check all KERNELS for one weight file
+
+   Returns
+   -------
+   list
+      (kernel, order, max relative difference, same FILL_VALUE cells,
+      within TOLERANCE) per kernel; the gather kernel is left out for
+      weights that are not 4-point bilinear
+   """
+   reference = rge.read_esmf_weights(wgtFile)
+   fields = check_fields(reference._srcShape)
+   expected = reference.applyBatch(fields)
+   results = []
+   for (kernel, order) in KERNELS:
+      weights = wc.load(wgtFile, dstGridName, cacheDir, kernel, order)
+      if kernel == 'gather' and not isinstance(weights, rge.GatherWeights):
+         WhfLog.warning("%s is not 4-point bilinear, gather not checked",
+                        wgtFile)
+         continue
+      (diff, sameFill) = compare(expected, regrid(weights, kernel, fields))
+      results.append((kernel, order, diff, sameFill,
+                      sameFill and diff <= TOLERANCE))
+   return results
+
+#----------------------------------------------------------------------------
+def synthetic_grids():
+   """(name, source lat, source lon, destination lat, destination lon)
+   of the synthetic cases, the sources covering part of the destination"""
+   (y, x) = np.mgrid[0:150, 0:170].astype(np.float64)
+   dstLat = 35.0 + y*10.0/149 + 0.3*np.sin(x/40.0)
+   dstLon = -105.0 + x*10.0/169 + 0.2*np.cos(y/30.0)
+
+   # rotated grid, curvilinear in latitude/longitude
+   (y, x) = np.mgrid[0:120, 0:140].astype(np.float64)
+   (u, v) = ((x - 70.0)*0.065, (y - 60.0)*0.065)
+   angle = np.radians(20.0)
+   curvLat = 40.0 + u*np.sin(angle) + v*np.cos(angle)
+   curvLon = -100.0 + (u*np.cos(angle) - v*np.sin(angle))/np.cos(np.radians(curvLat))
+
+   (regLon, regLat) = np.meshgrid(np.linspace(-104.0, -96.0, 121),
+                                  np.linspace(36.0, 44.0, 101))
+   return [('curvilinear', curvLat, curvLon, dstLat, dstLon),
+           ('latlon', regLat, regLon, dstLat, dstLon)]
+
+#----------------------------------------------------------------------------
+def add_zero_weights(row, col, S, srcShape):
+   """Triplets with a zero weight added for every destination cell, on
+   the source cell two rows above its first one, as ESMF can write for
+   points on cell edges (corners_to_triplets drops them)"""
+   nx = srcShape[1]
+   first = np.flatnonzero(np.r_[True, np.diff(row) != 0])
+   first = first[col[first] + 2*nx <= srcShape[0]*nx]
+   row = np.concatenate([row, row[first]])
+   col = np.concatenate([col, col[first] + 2*nx])
+   S = np.concatenate([S, np.zeros(len(first))])
+   order = np.argsort(row, kind='mergesort')
+   return (row[order], col[order], S[order])
+
+#----------------------------------------------------------------------------
+def write_synthetic(workDir):
+   """Weight files of the synthetic cases, and of the latitude-longitude
+   case with zero weights, returns (name, weight file)"""
+   wgtFiles = []
+   for (name, srcLat, srcLon, dstLat, dstLon) in synthetic_grids():
+      (j, i, fy, fx, valid, periodic) = wg.bilinear_corners(srcLat, srcLon,
+                                                            dstLat, dstLon)
+      triplets = [(name, wg.corners_to_triplets(j, i, fy, fx, valid,
+                                                srcLat.shape, periodic))]
+      if name == 'latlon':
+         triplets.append(('zeros', add_zero_weights(*(triplets[0][1] +
+                                                      (srcLat.shape,)))))
+      for (case, (row, col, S)) in triplets:
+         wgtFile = os.path.join(workDir, case + '_weight_bilinear.nc')
+         wg.write_esmf_weights(wgtFile, row, col, S, srcLat, srcLon, dstLat,
+                               dstLon)
+         wgtFiles.append((case, wgtFile))
+   return wgtFiles
+
+#----------------------------------------------------------------------------
+def main(argv):
+   """Check the configured weight files, or synthetic ones
+
+   Parameters
+   ----------
+   argv: list
+      [] or [config file]
+
+   Returns
+   -------
+   1 for error or a kernel not matching, 0 for success
+   """
+   if len(argv) > 1 or (len(argv) == 1 and not os.path.exists(argv[0])):
+      print 'Usage: python Regrid_Check.py [config file]'
+      return 1
+   workDir = tempfile.mkdtemp(prefix='regrid_check.')
+   try:
+      cacheDir = os.path.join(workDir, 'weight_cache')
+      if argv:
+         parser = SafeConfigParser()
+         parser.read(argv[0])
+         cases = []
+         for product in rge.SUPPORTED_PRODUCTS:
+            wgtFile = parser.get('regridding', product + '_wgt_bilinear')
+            if not os.path.exists(wgtFile):
+               WhfLog.warning("Weight file %s not found, skipping %s",
+                              wgtFile, product)
+               continue
+            cases.append((product, wgtFile,
+                          parser.get('regridding', product + '_dst_grid_name')))
+      else:
+         cases = [(name, wgtFile, '')
+                  for (name, wgtFile) in write_synthetic(workDir)]
+
+      print '%-12s %-7s %-7s %10s %5s'%('weights', 'kernel', 'order',
+                                        'max rel', 'fill')
+      failed = 0
+      for (name, wgtFile, dstGridName) in cases:
+         for (kernel, order, diff, sameFill, ok) in \
+             check(wgtFile, dstGridName, cacheDir):
+            print '%-12s %-7s %-7s %10.2e %5s %s'%(name, kernel, order, diff,
+                                                   'same' if sameFill else 'DIFF',
+                                                   '' if ok else 'FAILED')
+            if not ok:
+               failed += 1
+   finally:
+      shutil.rmtree(workDir, ignore_errors=True)
+   if failed:
+      return 1
+   return 0
+
+#----------------------------------------------------------------------------
+
+if __name__ == "__main__":
+   sys.exit(main(sys.argv[1:]))
@@ -14,8 +14,12 @@ import logging
 import datetime
 import time
 from ConfigParser import SafeConfigParser
+from multiprocessing.pool import ThreadPool
 import DataFiles as df
 import WhfLog
+import WRF_Hydro_forcing as whf
+import Staging_Cache as sc
+import Domain_Config as dcfg
 import Short_Range_Forcing as srf
 import Analysis_Assimilation_Forcing as aaf
 import Medium_Range_Forcing as mrf
@@ -56,8 +60,11 @@ def parmRead(fname, fileType, realtime):
    maxFcstHour = int(parser.get('fcsthr_max', fileType + '_fcsthr_max'))
    hoursBack = int(parser.get('triggering', fileType + '_hours_back'))
    stateFile = parser.get('triggering', fileType + '_regrid_state_file')
+   batch = False
+   if parser.has_option('triggering', fileType + '_regrid_batch'):
+      batch = parser.getint('triggering', fileType + '_regrid_batch') != 0
    
-   parms = Parms(dataDir, maxFcstHour, hoursBack, stateFile)
+   parms = Parms(dataDir, maxFcstHour, hoursBack, stateFile, batch)
    return parms
 
 #----------------------------------------------------------------------------
@@ -136,6 +143,115 @@ def regrid(fname, fileType, configFile):
 
    WhfLog.info("DONE REGRIDDING %s DATA, file=%s", fileType, fname)
     
+#----------------------------------------------------------------------------
+def regridDomains(fname, fileType, configFiles):
+   """Invoke regridding/downscaling of one file for several domains
+
+   The file is decoded once and regridded to all the domains that use
+   the python regrid engine, then regrid() runs for each domain (in
+   parallel), picking up its regridded output and doing the rest.
+
+   Parameters
+   ----------
+   fname: str
+      name of file to regrid and downscale, with yyyymmdd parent dir
+   fileType: str
+      HRRR, RAP, ... string
+   configFiles : list[str]
+      configuration file of each domain (Domain_Config.domain_configs)
+
+   Returns
+   -------
+   None
+   """
+   parsers = []
+   for configFile in configFiles:
+      parser = SafeConfigParser()
+      parser.read(configFile)
+      parsers.append(parser)
+   try:
+      (date, modelrun, fcsthr) = whf.extract_file_info(fname[9:])
+   except FilenameMatchError as fe:
+      WhfLog.debug("Not regridding %s for all domains due to %s", fname, fe)
+      fcsthr = None
+   if fcsthr is not None and whf.is_in_fcst_range(fileType, fcsthr, parsers[0]):
+      try:
+         # 0 hour RAP and GFS forecasts are replaced, not regridded; 0 hour
+         # RAP and HRRR forecasts are also regridded with the 0hr fields
+         if not (fcsthr == 0 and fileType in ['RAP', 'GFS']):
+            whf.regrid_data_domains(fileType, fname[9:], parsers)
+         if fcsthr == 0 and fileType in ['RAP', 'HRRR']:
+            whf.regrid_data_domains(fileType, fname[9:], parsers, True)
+      except:
+         # left to regrid() for each domain
+         WhfLog.error("Regridding %s for all domains failed", fname)
+
+   pool = ThreadPool(len(configFiles))
+   try:
+      pool.map(lambda configFile: regrid(fname, fileType, configFile),
+               configFiles)
+   finally:
+      pool.close()
+
+#----------------------------------------------------------------------------
+def regridBatch(fnames, fileType, configFile, downscaleShortwave=True):
+   """Regrid new files in batches, one NCL invocation per issue time
+   (with the python regrid engine, one pipeline of decode, regrid and
+   write stages per issue time)
+
+   The files are only regridded here; the regrid() that follows for
+   each file picks up the regridded output and does the rest.  Files
+   that are treated specially (0 hour RAP and GFS forecasts, forecast
+   hours beyond the maximum) are left to regrid().
+
+   Parameters
+   ----------
+   fnames: list[str]
+      names of files to regrid, with yyyymmdd parent dir
+   fileType: str
+      HRRR, RAP, ... string
+   configFile : str
+      configuration file with all settings
+   downscaleShortwave: bool
+      Shortwave adjustment of the downscaling done with the regridding
+      by the fused pipeline: True, as the short and medium range
+      forcing that regrid() runs
+
+   Returns
+   -------
+   None
+   """
+   parser = SafeConfigParser()
+   parser.read(configFile)
+   batches = {}
+   for fname in fnames:
+      try:
+         (date, modelrun, fcsthr) = whf.extract_file_info(fname[9:])
+      except FilenameMatchError as fe:
+         WhfLog.debug("Not batching %s due to %s", fname, fe)
+         continue
+      if (fcsthr == 0 and fileType in ['RAP', 'GFS']):
+         continue
+      if (not whf.is_in_fcst_range(fileType, fcsthr, parser)):
+         continue
+      issue = date + str(modelrun)
+      if (issue not in batches):
+         batches[issue] = []
+      batches[issue].append(fname[9:])
+
+   for issue in sorted(batches.keys()):
+      WhfLog.info("BATCH REGRIDDING %d %s files issued %s", len(batches[issue]),
+                  fileType, issue)
+      try:
+         regridded = whf.regrid_data_batch(fileType, batches[issue], parser,
+                                           downscaleShortwave)
+      except:
+         WhfLog.error("Batch regridding of %s issued %s failed", fileType, issue)
+         continue
+      nGood = len([r for r in regridded if r[1] is not None])
+      WhfLog.info("DONE BATCH REGRIDDING %s issued %s, %d of %d files regridded",
+                  fileType, issue, nGood, len(regridded))
+
 #----------------------------------------------------------------------------
 class Parms:
    """Parameters from the main wrf_hydro param file that are needed 
@@ -150,10 +266,12 @@ class Parms:
       Hours back to maintain state
    _stateFile: str
       Name of file with state information that is read/written
+   _batch: bool
+      True to regrid new files of an issue time in one batch
    """
 
    #--------------------------------------------------------------------------
-   def __init__(self, dataDir, maxFcstHour, hoursBack, stateFile):
+   def __init__(self, dataDir, maxFcstHour, hoursBack, stateFile, batch=False):
       """Initialization using input args
 
       Parameters
@@ -164,6 +282,7 @@ class Parms:
       self._maxFcstHour = maxFcstHour
       self._hoursBack = hoursBack
       self._stateFile = stateFile
+      self._batch = batch
 
    #--------------------------------------------------------------------------
    def debugPrint(self):
@@ -172,6 +291,7 @@ class Parms:
       WhfLog.debug("Parms: data = %s", self._dataDir)
       WhfLog.debug("Parms: MaxFcstHour = %d", self._maxFcstHour)
       WhfLog.debug("Parms: StateFile = %s", self._stateFile)
+      WhfLog.debug("Parms: Batch = %d", int(self._batch))
 
 
 #----------------------------------------------------------------------------
@@ -508,9 +628,32 @@ def run(fileType, configFile, realtime):
    # Update the state to reflect changes, returning those files to regrid
    # Regrid 'em
    toProcess = state.lookForNew(data, parms._hoursBack, fileType)
+
+   # Copy the new files to local disk in the background (if staging is
+   # configured), the regridding reads them from there
+   parser = SafeConfigParser()
+   parser.read(configFile)
+   sc.prefetch(parser, [os.path.join(parms._dataDir, f) for f in toProcess])
+
+   # One config file per WRF-Hydro domain
+   configFiles = dcfg.domain_configs(configFile)
+
+   if (parms._batch and len(toProcess) > 1):
+      for domainConfigFile in configFiles:
+         domainParser = SafeConfigParser()
+         domainParser.read(domainConfigFile)
+         # with several domains, files regridded in-process are decoded
+         # once for all of them by regridDomains() instead
+         if (len(configFiles) > 1 and
+             whf.get_regrid_engine(domainParser, fileType) == 'python'):
+            continue
+         regridBatch(toProcess, fileType, domainConfigFile)
    for f in toProcess:
       try:
-         regrid(f, fileType, configFile);
+         if (len(configFiles) > 1):
+            regridDomains(f, fileType, configFiles)
+         else:
+            regrid(f, fileType, configFile);
       except:
          WhfLog.error("Could not regrid/downscale %s", f)
       else:
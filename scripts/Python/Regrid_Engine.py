@@ -0,0 +1,1147 @@
+"""Regrid_Engine
+In-process replacement for the ESMF_regrid_with_weights calls made by
+the NCL regridding scripts (HRRR, RAP, GFS and MRMS).  Each ESMF weight
+file (row/col/S triplets) is read once per process into a sparse CSR
+matrix, which is then applied to every field of every input file.  The
+output follows the YYYYMMDDhh00.LDASIN_DOMAIN1.nc layout written by the
+NCL scripts, so downscaling and layering are unaffected.
+"""
+
+import os
+import time
+from multiprocessing.pool import ThreadPool
+import numpy as np
+import scipy.sparse as sp
+from netCDF4 import Dataset
+import WhfLog
+import Grib2_Reader as gr
+import Grib2_Stream as gs
+from ForcingEngineError import MissingFileError
+from ForcingEngineError import RegridError
+from ForcingEngineError import UnrecognizedCommandError
+
+# Fill value used by NCL for float data, assigned to destination cells
+# that no source cell maps to and to cells touched by missing source data.
+FILL_VALUE = np.float32(9.96921e+36)
+
+# Products that can be regridded in-process.
+SUPPORTED_PRODUCTS = ['HRRR', 'RAP', 'GFS', 'MRMS']
+
+# Weights already loaded by this process, keyed by weight file name
+_loadedWeights = {}
+
+# Thread pools used for the batched regridding, keyed by number of threads
+_threadPools = {}
+
+# Destination cells interpolated at a time by the gather kernel
+GATHER_CHUNK = 65536
+
+# Floating point type of the in-process computations for each [precision]
+# mode: 'double' as the NCL scripts compute, 'single' float32 throughout
+PRECISIONS = {'double': np.float64, 'single': np.float32}
+
+#----------------------------------------------------------------------------
+class RegridWeights:
+   """ESMF bilinear weights held as a sparse CSR matrix
+
+   Attributes
+   ----------
+   _wgtFile: str
+      Name of the ESMF weight file the weights were read from
+   _matrix: scipy.sparse.csr_matrix
+      (number of destination cells) x (number of source cells) weights
+   _srcShape: tuple
+      (ny, nx) of the source grid
+   _dstShape: tuple
+      (ny, nx) of the destination grid
+   _footprint: tuple
+      (j0, j1, i0, i1) bounding box of the source cells the weights use;
+      the matrix columns are numbered within this box
+   _unmapped: numpy.ndarray
+      True for matrix rows that no source cell maps to
+   _tile: int
+      Tile size when the matrix rows are in tile order (the destination
+      grid padded to whole tiles, tile by tile), None for grid order
+   _colOrder: numpy.ndarray
+      Footprint cell of each matrix column, None if the columns are in
+      footprint order
+   _blocks: dict
+      Destination row blocks of _matrix, keyed by number of blocks
+   _transposed: tuple
+      (footprint cells x destination grid cells csr_matrix, flat indices
+      of the unmapped destination cells) for applySparse, None until
+      needed
+   """
+
+   #--------------------------------------------------------------------------
+   def __init__(self, wgtFile, matrix, srcShape, dstShape, footprint=None,
+                tile=None, colOrder=None):
+      """Initialization using input args
+
+      Parameters
+      ----------
+      wgtFile: str
+         ESMF weight file the weights came from
+      matrix: scipy.sparse.csr_matrix
+         Destination x source (footprint) weights
+      srcShape: tuple
+         (ny, nx) of the source grid
+      dstShape: tuple
+         (ny, nx) of the destination grid
+      footprint: tuple
+         (j0, j1, i0, i1) source box the matrix columns refer to,
+         None for the full source grid
+      tile: int
+         Tile size of a matrix with rows in tile order (see
+         Weight_Cache.reorder), None for rows in grid order
+      colOrder: numpy.ndarray
+         Footprint cell of each column of a reordered matrix, None for
+         columns in footprint order
+      """
+      self._wgtFile = wgtFile
+      self._matrix = matrix
+      self._tile = tile
+      self._colOrder = colOrder
+      self._srcShape = tuple(srcShape)
+      self._dstShape = tuple(dstShape)
+      if footprint is None:
+         footprint = (0, self._srcShape[0], 0, self._srcShape[1])
+      self._footprint = tuple([int(f) for f in footprint])
+      self._unmapped = (np.diff(self._matrix.indptr) == 0)
+      self._blocks = {}
+      self._transposed = None
+
+   #--------------------------------------------------------------------------
+   def numSrc(self):
+      """Returns number of source cells in the footprint"""
+      return self._matrix.shape[1]
+
+   #--------------------------------------------------------------------------
+   def footprint(self):
+      """Returns (j0, j1, i0, i1), the source box used by the weights"""
+      return self._footprint
+
+   #--------------------------------------------------------------------------
+   def subset(self, field):
+      """Restrict a source field to the footprint
+
+      Parameters
+      ----------
+      field: numpy.ndarray or numpy.ma.MaskedArray
+         Field on the full source grid, or already on the footprint
+
+      Returns
+      -------
+      numpy.ndarray or numpy.ma.MaskedArray
+         The field on the footprint (a view when possible)
+      """
+      if np.size(field) == self.numSrc():
+         return field
+      if np.size(field) != self._srcShape[0]*self._srcShape[1]:
+         raise RegridError('Field of size %d does not match %d source cells in %s'
+                           %(np.size(field), self.numSrc(), self._wgtFile))
+      (j0, j1, i0, i1) = self._footprint
+      return field.reshape(self._srcShape)[j0:j1, i0:i1]
+
+   #--------------------------------------------------------------------------
+   def numDst(self):
+      """Returns number of destination cells"""
+      return self._matrix.shape[0]
+
+   #--------------------------------------------------------------------------
+   def dstShape(self):
+      """Returns (ny, nx) of the destination grid"""
+      return self._dstShape
+
+   #--------------------------------------------------------------------------
+   def naturalMatrix(self):
+      """Returns the weights as a matrix with rows in destination grid
+      order and columns in footprint order"""
+      if self._tile is None and self._colOrder is None:
+         return self._matrix
+      coo = self._matrix.tocoo()
+      row = coo.row
+      col = coo.col
+      nDst = self._dstShape[0]*self._dstShape[1]
+      if self._tile is not None:
+         # padding rows are empty, so every weight lands in the grid
+         row = tile_rows(self._dstShape, self._tile, inverse=True)[row]
+      if self._colOrder is not None:
+         col = np.asarray(self._colOrder)[col]
+      return sp.csr_matrix((coo.data, (row, col)), shape=(nDst, self.numSrc()))
+
+   #--------------------------------------------------------------------------
+   def _toColumns(self, values):
+      """Footprint values (first axis) in matrix column order"""
+      if self._colOrder is None:
+         return values
+      return values.take(self._colOrder, axis=0)
+
+   #--------------------------------------------------------------------------
+   def _toGrid(self, out):
+      """Result in matrix row order (first axis) on the destination grid"""
+      extra = out.shape[1:]
+      if self._tile is None:
+         return out.reshape(self._dstShape + extra)
+      (ny, nx) = self._dstShape
+      t = self._tile
+      (nty, ntx) = (-(-ny // t), -(-nx // t))
+      grid = out.reshape((nty, ntx, t, t) + extra).swapaxes(1, 2)
+      return np.ascontiguousarray(grid.reshape((nty*t, ntx*t) + extra)[:ny, :nx])
+
+   #--------------------------------------------------------------------------
+   def apply(self, field):
+      """Regrid one source field
+
+      Parameters
+      ----------
+      field: numpy.ndarray or numpy.ma.MaskedArray
+         Source field on the source grid; masked cells are missing data
+
+      Returns
+      -------
+      numpy.ndarray
+         float32 field on the destination grid, FILL_VALUE where there
+         is no valid data (same convention as ESMF_regrid_with_weights)
+      """
+      field = self.subset(field)
+      mask = self._toColumns(np.ma.getmaskarray(field).reshape(-1))
+      data = self._toColumns(np.ma.getdata(field).reshape(-1))
+      if mask.any():
+         data = np.where(mask, 0.0, data)
+      out = self._matrix.dot(data).astype(np.float32)
+      if mask.any():
+         # any destination cell touched by a missing source cell is missing
+         out[self._matrix.dot(mask.astype(np.float64)) > 0.0] = FILL_VALUE
+      out[self._unmapped] = FILL_VALUE
+      return self._toGrid(out)
+
+   #--------------------------------------------------------------------------
+   def singlePrecision(self):
+      """Returns the weights with float32 values, sharing the indices:
+      the multiply reads half the weight bytes and accumulates in
+      float32 instead of into a float64 result.  Values already float32
+      (the memory mapped weight cache) are shared as well."""
+      m = self._matrix
+      matrix = sp.csr_matrix((m.data.astype(np.float32, copy=False),
+                              m.indices, m.indptr),
+                             shape=m.shape, copy=False)
+      single = RegridWeights(self._wgtFile, matrix, self._srcShape,
+                             self._dstShape, self._footprint, self._tile,
+                             self._colOrder)
+      if self._transposed is not None:
+         (t, unmapped) = self._transposed
+         single._transposed = (sp.csr_matrix((t.data.astype(np.float32,
+                                                            copy=False),
+                                              t.indices, t.indptr),
+                                             shape=t.shape, copy=False),
+                               unmapped)
+      return single
+
+   #--------------------------------------------------------------------------
+   def rowBlocks(self, numBlocks):
+      """Split the weights into contiguous destination row blocks
+
+      Blocks hold about the same number of weights and share the index
+      and weight arrays of the full matrix (no copy, so memory mapped
+      weights stay shared).
+
+      Parameters
+      ----------
+      numBlocks: int
+         Number of blocks wanted
+
+      Returns
+      -------
+      list
+         (first row, last row + 1, csr_matrix) per block
+      """
+      if numBlocks not in self._blocks:
+         indptr = self._matrix.indptr
+         nnz = indptr[-1]
+         bounds = np.searchsorted(indptr, np.linspace(0, nnz, numBlocks + 1))
+         bounds[0] = 0
+         bounds[-1] = self.numDst()
+         blocks = []
+         for (r0, r1) in zip(bounds[:-1], bounds[1:]):
+            if r1 <= r0:
+               continue
+            i0 = indptr[r0]
+            i1 = indptr[r1]
+            block = sp.csr_matrix((self._matrix.data[i0:i1],
+                                   self._matrix.indices[i0:i1],
+                                   indptr[r0:r1+1] - i0),
+                                  shape=(r1 - r0, self.numSrc()), copy=False)
+            blocks.append((r0, r1, block))
+         self._blocks[numBlocks] = blocks
+      return self._blocks[numBlocks]
+
+   #--------------------------------------------------------------------------
+   def applyBatch(self, fields, numThreads=1):
+      """Regrid several source fields with one sparse x dense multiply
+
+      The fields are stacked into a (number of source cells) x (number
+      of fields) array.  With more than one thread the multiply is split
+      into destination row blocks run concurrently (the scipy sparse
+      kernels release the GIL).
+
+      Parameters
+      ----------
+      fields: list
+         numpy.ndarray or numpy.ma.MaskedArray fields on the source grid
+      numThreads: int
+         Number of threads
+
+      Returns
+      -------
+      list
+         float32 fields on the destination grid, same order as the input,
+         FILL_VALUE where there is no valid data
+      """
+      nvars = len(fields)
+      if nvars == 0:
+         return []
+      fields = [self.subset(field) for field in fields]
+
+      # Missing source data is carried as extra indicator columns, for
+      # only the fields that have any.
+      masked = []
+      for (i, field) in enumerate(fields):
+         mask = np.ma.getmaskarray(field).reshape(-1)
+         if mask.any():
+            masked.append((i, mask))
+      src = np.empty((self.numSrc(), nvars + len(masked)), dtype=np.float32)
+      for (i, field) in enumerate(fields):
+         src[:, i] = np.ma.getdata(field).reshape(-1)
+      for (k, (i, mask)) in enumerate(masked):
+         src[mask, i] = 0.0
+         src[:, nvars + k] = mask
+      src = self._toColumns(src)
+
+      out = np.empty((self.numDst(), src.shape[1]), dtype=np.float32)
+      if numThreads <= 1:
+         out[:] = self._matrix.dot(src)
+      else:
+         def _multiply(block):
+            (r0, r1, matrix) = block
+            out[r0:r1] = matrix.dot(src)
+         _get_thread_pool(numThreads).map(_multiply, self.rowBlocks(numThreads))
+
+      for (k, (i, mask)) in enumerate(masked):
+         out[out[:, nvars + k] > 0.0, i] = FILL_VALUE
+      out[self._unmapped] = FILL_VALUE
+      grid = self._toGrid(out[:, :nvars])
+      return [grid[:, :, i] for i in range(nvars)]
+
+   #--------------------------------------------------------------------------
+   def transposed(self):
+      """Returns (footprint cells x destination cells csr_matrix, flat
+      indices of the unmapped destination cells), in grid order, built
+      on first use unless set by the weight cache"""
+      if self._transposed is None:
+         natural = self.naturalMatrix()
+         unmapped = np.flatnonzero(np.diff(natural.indptr) == 0)
+         self._transposed = (natural.T.tocsr(), unmapped)
+      return self._transposed
+
+   #--------------------------------------------------------------------------
+   def applySparse(self, field):
+      """Regrid a source field given by its nonzero and missing cells
+
+      Only the rows of the transposed weights of those cells are used,
+      so the cost is proportional to the number of nonzero cells (none
+      for an all zero field), not to the grid size.
+
+      Parameters
+      ----------
+      field: SparseField
+         Source field on the footprint
+
+      Returns
+      -------
+      SparseField
+         Field on the destination grid, the same values and missing
+         cells as apply() on the dense field
+      """
+      (j0, j1, i0, i1) = self._footprint
+      if field._shape != (j1 - j0, i1 - i0):
+         raise RegridError('Sparse field of shape %s does not match footprint %s of %s'
+                           %(str(field._shape), str(self._footprint), self._wgtFile))
+      (transposed, unmapped) = self.transposed()
+      (dst, weight, counts) = _csr_rows(transposed, field._index)
+      contrib = weight*np.repeat(field._values.astype(np.float64), counts)
+      (cells, inverse) = np.unique(dst, return_inverse=True)
+      values = np.bincount(inverse, weights=contrib,
+                           minlength=len(cells)).astype(np.float32)
+      # any destination cell with a positive weight on a missing source
+      # cell is missing, as in apply() (ESMF files can hold zero weights;
+      # unmapped cells are never touched)
+      (missDst, missWeight, _) = _csr_rows(transposed, field._missing)
+      touched = np.unique(missDst[missWeight > 0.0])
+      keep = ~np.in1d(cells, touched)
+      return SparseField(self._dstShape, cells[keep], values[keep],
+                         np.concatenate([unmapped, touched]))
+
+#----------------------------------------------------------------------------
+def _csr_rows(matrix, rows):
+   """Entries of some rows of a csr_matrix
+
+   Gathers the entries straight from indptr, the cost is proportional to
+   the number of entries (csr_matrix row indexing is proportional to the
+   number of rows of the matrix).
+
+   Returns
+   -------
+   tuple
+      (column indices, values, number of entries per row)
+   """
+   indptr = matrix.indptr
+   starts = np.asarray(indptr[rows], dtype=np.int64)
+   counts = np.asarray(indptr[rows + 1], dtype=np.int64) - starts
+   pos = np.repeat(starts - (np.cumsum(counts) - counts), counts) + \
+         np.arange(counts.sum(), dtype=np.int64)
+   return (np.asarray(matrix.indices[pos]), np.asarray(matrix.data[pos]), counts)
+
+#----------------------------------------------------------------------------
+class SparseField:
+   """Field held as its nonzero and its missing cells only
+
+   Attributes
+   ----------
+   _shape: tuple
+      (ny, nx) of the grid
+   _index: numpy.ndarray
+      Flat indices of the nonzero (not missing) cells
+   _values: numpy.ndarray
+      float32 values of those cells
+   _missing: numpy.ndarray
+      Flat indices of the missing cells
+   """
+
+   #--------------------------------------------------------------------------
+   def __init__(self, shape, index, values, missing):
+      """Initialization using input args
+
+      Parameters
+      ----------
+      One to one with attributes
+      """
+      self._shape = tuple(shape)
+      self._index = np.asarray(index, dtype=np.int64)
+      self._values = np.asarray(values, dtype=np.float32)
+      self._missing = np.asarray(missing, dtype=np.int64)
+
+   #--------------------------------------------------------------------------
+   def debugPrint(self):
+      """ Debug logging of content
+      """
+      WhfLog.debug("Sparse %s field: %d nonzero, %d missing cells",
+                   str(self._shape), len(self._index), len(self._missing))
+
+   #--------------------------------------------------------------------------
+   def numCells(self):
+      """Returns number of nonzero and missing cells"""
+      return len(self._index) + len(self._missing)
+
+   #--------------------------------------------------------------------------
+   def dense(self, fill=FILL_VALUE):
+      """Returns the float32 field, fill in the missing cells"""
+      out = np.zeros(self._shape[0]*self._shape[1], dtype=np.float32)
+      out[self._index] = self._values
+      out[self._missing] = fill
+      return out.reshape(self._shape)
+
+#----------------------------------------------------------------------------
+def sparse_from_dense(field):
+   """SparseField of a field
+
+   Parameters
+   ----------
+   field: numpy.ndarray or numpy.ma.MaskedArray
+      2D field, masked cells are missing
+
+   Returns
+   -------
+   SparseField
+   """
+   mask = np.ma.getmaskarray(field).reshape(-1)
+   data = np.ma.getdata(field).reshape(-1)
+   index = np.flatnonzero((data != 0.0) & ~mask)
+   return SparseField(np.shape(field), index, data[index], np.flatnonzero(mask))
+
+#----------------------------------------------------------------------------
+class GatherWeights(RegridWeights):
+   """Bilinear weights on a logically rectangular source grid held as the
+   lower-left source corner and two fractional offsets per destination
+   cell.  Regridding is a 4-point gather and interpolation instead of
+   a sparse matrix product, using 12 bytes per destination cell.
+
+   Attributes
+   ----------
+   _index: numpy.ndarray
+      int32 footprint index of the (j, i) corner for each destination
+      cell, 0 for unmapped cells
+   _fy: numpy.ndarray
+      float32 offset towards row j+1
+   _fx: numpy.ndarray
+      float32 offset towards column i+1
+   (others as in RegridWeights, there is no _matrix)
+   """
+
+   #--------------------------------------------------------------------------
+   def __init__(self, wgtFile, index, fy, fx, unmapped, srcShape, dstShape,
+                footprint=None):
+      """Initialization using input args
+
+      Parameters
+      ----------
+      wgtFile: str
+         ESMF weight file the weights came from
+      index, fy, fx: numpy.ndarray
+         Corner index (within the footprint) and offsets per destination cell
+      unmapped: numpy.ndarray
+         True for destination cells with no source data
+      srcShape, dstShape, footprint:
+         As for RegridWeights
+      """
+      self._wgtFile = wgtFile
+      self._index = index
+      self._fy = fy
+      self._fx = fx
+      self._srcShape = tuple(srcShape)
+      self._dstShape = tuple(dstShape)
+      if footprint is None:
+         footprint = (0, self._srcShape[0], 0, self._srcShape[1])
+      self._footprint = tuple([int(f) for f in footprint])
+      self._unmapped = unmapped
+      self._tile = None
+      self._colOrder = None
+      self._blocks = {}
+
+   #--------------------------------------------------------------------------
+   def numSrc(self):
+      """Returns number of source cells in the footprint"""
+      (j0, j1, i0, i1) = self._footprint
+      return (j1 - j0)*(i1 - i0)
+
+   #--------------------------------------------------------------------------
+   def numDst(self):
+      """Returns number of destination cells"""
+      return self._index.size
+
+   #--------------------------------------------------------------------------
+   def singlePrecision(self):
+      """Returns the weights themselves, already float32"""
+      return self
+
+   #--------------------------------------------------------------------------
+   def _interpolate(self, srcs, outs, d0, d1):
+      """Bilinear interpolation of destination cells d0 to d1-1, in chunks
+      small enough for the stencil and temporaries to stay in cache
+
+      Parameters
+      ----------
+      srcs: list
+         Flattened float32 footprint fields
+      outs: list
+         Flattened destination fields written to
+      d0, d1: int
+         Destination cell range
+      """
+      nx = self._footprint[3] - self._footprint[2]
+      for c0 in range(d0, d1, GATHER_CHUNK):
+         c1 = min(d1, c0 + GATHER_CHUNK)
+         # take() wants native integers, convert the int32 index once per chunk
+         k00 = self._index[c0:c1].astype(np.intp)
+         k01 = k00 + 1
+         k10 = k00 + nx
+         k11 = k10 + 1
+         fy = self._fy[c0:c1]
+         fx = self._fx[c0:c1]
+         for (src, out) in zip(srcs, outs):
+            top = src.take(k00)
+            right = src.take(k01)
+            right -= top
+            right *= fx
+            top += right
+            bottom = src.take(k10)
+            right = src.take(k11)
+            right -= bottom
+            right *= fx
+            bottom += right
+            bottom -= top
+            bottom *= fy
+            np.add(top, bottom, out=out[c0:c1])
+
+   #--------------------------------------------------------------------------
+   def apply(self, field):
+      """Regrid one source field, see RegridWeights.apply"""
+      return self.applyBatch([field])[0]
+
+   #--------------------------------------------------------------------------
+   def applyBatch(self, fields, numThreads=1):
+      """Regrid several source fields, see RegridWeights.applyBatch
+
+      Missing source data is carried as extra indicator fields, as for
+      the sparse matrix.  With more than one thread each thread
+      interpolates a contiguous block of destination cells.
+      """
+      nvars = len(fields)
+      if nvars == 0:
+         return []
+      fields = [self.subset(field) for field in fields]
+      srcs = []
+      masked = []
+      for (i, field) in enumerate(fields):
+         src = np.array(np.ma.getdata(field), dtype=np.float32).reshape(-1)
+         mask = np.ma.getmaskarray(field).reshape(-1)
+         if mask.any():
+            src[mask] = 0.0
+            masked.append((i, mask.astype(np.float32)))
+         srcs.append(src)
+      srcs.extend([m[1] for m in masked])
+      outs = [np.empty(self.numDst(), dtype=np.float32) for src in srcs]
+
+      def _gather(block):
+         (d0, d1) = block
+         self._interpolate(srcs, outs, d0, d1)
+
+      n = self.numDst()
+      if numThreads <= 1:
+         _gather((0, n))
+      else:
+         bounds = np.linspace(0, n, numThreads + 1).astype(np.int64)
+         _get_thread_pool(numThreads).map(_gather, zip(bounds[:-1], bounds[1:]))
+
+      ret = outs[:nvars]
+      for (k, (i, mask)) in enumerate(masked):
+         ret[i][outs[nvars + k] > 0.0] = FILL_VALUE
+      for i in range(nvars):
+         ret[i][self._unmapped] = FILL_VALUE
+         ret[i] = ret[i].reshape(self._dstShape)
+      return ret
+
+#----------------------------------------------------------------------------
+def _get_thread_pool(numThreads):
+   """Thread pool with numThreads threads, created once per process"""
+   if numThreads not in _threadPools:
+      _threadPools[numThreads] = ThreadPool(numThreads)
+   return _threadPools[numThreads]
+
+#----------------------------------------------------------------------------
+def tile_rows(dstShape, tile, inverse=False):
+   """Matrix row of each destination cell when the rows are in tile order
+
+   The destination grid is padded to whole tile x tile tiles; rows go
+   tile by tile (tiles in row major order) and row major within a tile.
+
+   Parameters
+   ----------
+   dstShape: tuple
+      (ny, nx) of the destination grid
+   tile: int
+      Tile size
+   inverse: bool
+      If True return instead the destination cell of each matrix row,
+      -1 for padding rows
+
+   Returns
+   -------
+   numpy.ndarray
+   """
+   (ny, nx) = dstShape
+   ntx = -(-nx // tile)
+   (j, i) = np.divmod(np.arange(ny*nx, dtype=np.int64), nx)
+   rows = ((j // tile)*ntx + i // tile)*tile*tile + (j % tile)*tile + i % tile
+   if not inverse:
+      return rows
+   cells = np.full(-(-ny // tile)*ntx*tile*tile, -1, dtype=np.int64)
+   cells[rows] = np.arange(ny*nx)
+   return cells
+
+#----------------------------------------------------------------------------
+def gather_from_corners(wgtFile, j, i, fy, fx, valid, srcShape):
+   """GatherWeights from per destination corner indices and offsets, as
+   computed from grid coordinates by Weight_Generator.bilinear_corners
+
+   Parameters
+   ----------
+   wgtFile: str
+      Name to associate with the weights
+   j, i: numpy.ndarray
+      (ny, nx) destination grid of lower-left source corners
+   fy, fx: numpy.ndarray
+      Offsets towards row j+1 and column i+1
+   valid: numpy.ndarray
+      True where the destination cell is inside the source grid
+   srcShape: tuple
+      (ny, nx) of the source grid
+
+   Returns
+   -------
+   GatherWeights
+   """
+   dstShape = j.shape
+   valid = valid.reshape(-1)
+   j = j.reshape(-1)
+   i = i.reshape(-1)
+   if valid.any():
+      footprint = (int(j[valid].min()), int(j[valid].max()) + 2,
+                   int(i[valid].min()), int(i[valid].max()) + 2)
+   else:
+      footprint = (0, srcShape[0], 0, srcShape[1])
+   nx = footprint[3] - footprint[2]
+   index = np.where(valid, (j - footprint[0])*nx + (i - footprint[2]), 0)
+   return GatherWeights(wgtFile, index.astype(np.int32),
+                        np.where(valid, fy.reshape(-1), 0.0).astype(np.float32),
+                        np.where(valid, fx.reshape(-1), 0.0).astype(np.float32),
+                        ~valid, srcShape, dstShape, footprint)
+
+#----------------------------------------------------------------------------
+def gather_from_csr(weights, tolerance=1.0e-4):
+   """Convert sparse matrix weights to GatherWeights, if every destination
+   cell is bilinear in one 2x2 block of source cells
+
+   Parameters
+   ----------
+   weights: RegridWeights
+      The sparse matrix weights, in any row and column order
+   tolerance: float
+      Allowed difference between a weight and its bilinear value
+
+   Returns
+   -------
+   GatherWeights, or None if the weights are not 4-point bilinear (e.g.
+   a global grid wrapping around the footprint)
+   """
+   matrix = weights.naturalMatrix()
+   nDst = matrix.shape[0]
+   (j0, j1, i0, i1) = weights.footprint()
+   (nyb, nxb) = (j1 - j0, i1 - i0)
+   counts = np.diff(matrix.indptr)
+   if nyb < 2 or nxb < 2 or counts.max() > 4:
+      return None
+   rows = np.repeat(np.arange(nDst), counts)
+   (jj, ii) = np.divmod(matrix.indices.astype(np.int64), nxb)
+   S = np.asarray(matrix.data, dtype=np.float64)
+   mapped = counts > 0
+
+   # lower-left corner per row, kept inside the footprint
+   big = np.iinfo(np.int64).max
+   jc = np.full(nDst, big, dtype=np.int64)
+   ic = np.full(nDst, big, dtype=np.int64)
+   np.minimum.at(jc, rows, jj)
+   np.minimum.at(ic, rows, ii)
+   jc = np.where(mapped, np.minimum(jc, nyb - 2), 0)
+   ic = np.where(mapped, np.minimum(ic, nxb - 2), 0)
+   dj = jj - jc[rows]
+   di = ii - ic[rows]
+   if dj.min() < 0 or dj.max() > 1 or di.min() < 0 or di.max() > 1:
+      return None
+
+   fy = np.bincount(rows, weights=S*dj, minlength=nDst)
+   fx = np.bincount(rows, weights=S*di, minlength=nDst)
+   total = np.bincount(rows, weights=S, minlength=nDst)
+   expected = np.where(dj == 1, fy[rows], 1.0 - fy[rows]) * \
+              np.where(di == 1, fx[rows], 1.0 - fx[rows])
+   if np.abs(expected - S).max() > tolerance or \
+      np.abs(total[mapped] - 1.0).max() > tolerance:
+      return None
+   index = (jc*nxb + ic).astype(np.int32)
+   return GatherWeights(weights._wgtFile, index, fy.astype(np.float32),
+                        fx.astype(np.float32), ~mapped, weights._srcShape,
+                        weights._dstShape, weights.footprint())
+
+#----------------------------------------------------------------------------
+def read_esmf_weights(wgtFile):
+   """Read the row/col/S triplets from an ESMF weight file
+
+   Parameters
+   ----------
+   wgtFile: str
+      ESMF weight file, e.g. HRRR2HYDRO_d01_weight_bilinear.nc
+
+   Returns
+   -------
+   RegridWeights
+   """
+   if not os.path.exists(wgtFile):
+      WhfLog.error('Weight file: ' + wgtFile + ' not found.')
+      raise MissingFileError('Weight file %s not found'%wgtFile)
+   start = time.time()
+   nc = Dataset(wgtFile, 'r')
+   try:
+      # ESMF indices are 1-based
+      row = np.asarray(nc.variables['row'][:], dtype=np.int32) - 1
+      col = np.asarray(nc.variables['col'][:], dtype=np.int32) - 1
+      S = np.asarray(nc.variables['S'][:], dtype=np.float64)
+      nSrc = len(nc.dimensions['n_a'])
+      nDst = len(nc.dimensions['n_b'])
+      # grid dims are stored Fortran order (nx, ny)
+      srcDims = [int(d) for d in nc.variables['src_grid_dims'][:]]
+      dstDims = [int(d) for d in nc.variables['dst_grid_dims'][:]]
+   finally:
+      nc.close()
+   srcShape = tuple(reversed(srcDims))
+   dstShape = tuple(reversed(dstDims))
+   (footprint, col) = _prune_footprint(col, srcShape)
+   nFoot = (footprint[1] - footprint[0])*(footprint[3] - footprint[2])
+   WhfLog.debug("Weights %s use source box %s, %d of %d cells", wgtFile,
+                str(footprint), nFoot, nSrc)
+   matrix = sp.csr_matrix((S, (row, col)), shape=(nDst, nFoot))
+   WhfLog.info("Time(sec) to read weights %s: %s", wgtFile, time.time() - start)
+   return RegridWeights(wgtFile, matrix, srcShape, dstShape, footprint)
+
+#----------------------------------------------------------------------------
+def _prune_footprint(col, srcShape):
+   """Bounding box of the source cells referenced by the weights
+
+   Parameters
+   ----------
+   col: numpy.ndarray
+      0-based source cell index of each weight, full grid numbering
+   srcShape: tuple
+      (ny, nx) of the source grid
+
+   Returns
+   -------
+   tuple
+      ((j0, j1, i0, i1), col renumbered within the box)
+   """
+   nx = srcShape[1]
+   if col.size == 0:
+      return ((0, srcShape[0], 0, nx), col)
+   j = col // nx
+   i = col % nx
+   (j0, j1) = (int(j.min()), int(j.max()) + 1)
+   (i0, i1) = (int(i.min()), int(i.max()) + 1)
+   col = ((j - j0)*(i1 - i0) + (i - i0)).astype(np.int32)
+   return ((j0, j1, i0, i1), col)
+
+#----------------------------------------------------------------------------
+def get_weights(wgtFile, dstGridName=None, cacheDir=None, kernel='csr',
+                order='native', precision='double'):
+   """Return the weights for a weight file, loading them only once per
+   process.  With a cache directory the weights come from the compiled
+   weight cache (Weight_Cache), otherwise from the ESMF netCDF file.
+
+   Parameters
+   ----------
+   wgtFile: str
+      ESMF weight file name
+   dstGridName: str
+      Destination grid file, part of the weight cache key
+   cacheDir: str
+      Weight cache directory, or None to read the ESMF file directly
+   kernel: str
+      'csr' for the sparse matrix, 'gather' for the 4-point gather
+      kernel (falls back to 'csr' if the weights are not 4-point bilinear),
+      'sparse' for the sparse matrix with its transpose for applySparse
+   order: str
+      Matrix ordering of the cached weights, see Weight_Cache.WEIGHT_ORDERS;
+      only used with a cache directory
+   precision: str
+      'double' for the weights as loaded (float64 from the weight file,
+      float32 from the weight cache), 'single' for float32 weights (see
+      PRECISIONS)
+
+   Returns
+   -------
+   RegridWeights or GatherWeights
+   """
+   if precision == 'single':
+      key = (wgtFile, kernel, order, precision)
+      if key not in _loadedWeights:
+         loaded = (wgtFile, kernel, order) in _loadedWeights
+         _loadedWeights[key] = get_weights(wgtFile, dstGridName, cacheDir,
+                                           kernel, order).singlePrecision()
+         if not loaded:
+            # keep one copy of weights read into memory
+            del _loadedWeights[(wgtFile, kernel, order)]
+      return _loadedWeights[key]
+   key = (wgtFile, kernel, order)
+   if key not in _loadedWeights:
+      if cacheDir:
+         import Weight_Cache
+         weights = Weight_Cache.load(wgtFile, dstGridName, cacheDir, kernel, order)
+      else:
+         weights = read_esmf_weights(wgtFile)
+         if kernel == 'gather':
+            gather = gather_from_csr(weights)
+            if gather is None:
+               WhfLog.info("Weights %s are not 4-point bilinear, using sparse matrix",
+                           wgtFile)
+            else:
+               weights = gather
+      _loadedWeights[key] = weights
+   return _loadedWeights[key]
+
+#----------------------------------------------------------------------------
+def write_ldasin(outFile, fields, dstShape, latlon=None):
+   """Write regridded fields to a netCDF file
+
+   Parameters
+   ----------
+   outFile: str
+      Full path of the output file, any existing file is replaced
+   fields: list
+      (name, numpy.ndarray or SparseField, units, description) on the
+      destination grid.  A SparseField is written dense, and its cells
+      also as <name>_cell (flat index) and <name>_cell_value (FILL_VALUE
+      for missing cells) for read_sparse.
+   dstShape: tuple
+      (ny, nx) of the destination grid
+   latlon: tuple or None
+      (lat, lon) destination coordinates to write as well (GFS)
+
+   Returns
+   -------
+   None
+   """
+   if os.path.exists(outFile):
+      os.remove(outFile)
+   nc = Dataset(outFile, 'w', format='NETCDF3_64BIT_OFFSET')
+   try:
+      nc.createDimension('south_north', dstShape[0])
+      nc.createDimension('west_east', dstShape[1])
+      dims = ('south_north', 'west_east')
+      if latlon is not None:
+         for (name, values) in zip(['lat', 'lon'], latlon):
+            var = nc.createVariable(name, 'f4', dims)
+            var[:] = values
+      for (name, values, units, desc) in fields:
+         var = nc.createVariable(name, 'f4', dims, fill_value=FILL_VALUE)
+         var.units = units
+         var.description = desc
+         var.missing_value = FILL_VALUE
+         if isinstance(values, SparseField):
+            _write_cells(nc, name, values)
+            values = values.dense()
+         var[:] = values
+   finally:
+      nc.close()
+
+#----------------------------------------------------------------------------
+def _write_cells(nc, name, field):
+   """Write the cells of a SparseField next to its dense variable"""
+   index = np.concatenate([field._index, field._missing])
+   values = np.concatenate([field._values,
+                            np.repeat(FILL_VALUE, len(field._missing))])
+   # netCDF3 dimensions cannot be empty, there is at least one cell
+   # and num_cells tells how many are used
+   nc.createDimension(name + '_cells', max(1, len(index)))
+   var = nc.createVariable(name + '_cell', 'i4', (name + '_cells',))
+   var.num_cells = len(index)
+   var.description = 'Flat index of the nonzero and missing cells of ' + name
+   if len(index):
+      var[:] = index
+   var = nc.createVariable(name + '_cell_value', 'f4', (name + '_cells',))
+   var.missing_value = FILL_VALUE
+   if len(index):
+      var[:] = values
+
+#----------------------------------------------------------------------------
+def read_sparse(ncFile, name):
+   """SparseField of a field written by write_ldasin from a SparseField
+
+   Parameters
+   ----------
+   ncFile: str
+      netCDF file
+   name: str
+      Variable name
+
+   Returns
+   -------
+   SparseField
+      None if the file has no cells for the variable
+   """
+   nc = Dataset(ncFile, 'r')
+   try:
+      if name + '_cell' not in nc.variables:
+         return None
+      var = nc.variables[name]
+      shape = var.shape[-2:]
+      cellVar = nc.variables[name + '_cell']
+      n = int(cellVar.num_cells)
+      index = np.asarray(cellVar[:n], dtype=np.int64)
+      valueVar = nc.variables[name + '_cell_value']
+      valueVar.set_auto_mask(False)
+      values = np.asarray(valueVar[:n], dtype=np.float32)
+   finally:
+      nc.close()
+   missing = (values == FILL_VALUE)
+   return SparseField(shape, index[~missing], values[~missing], index[missing])
+
+#----------------------------------------------------------------------------
+def regrid_file(product, srcFile, wgtFile, dstGridName, outFile,
+                zero_process=False, cacheDir=None, numThreads=1, kernel='csr',
+                order='native', indexDir=None, fieldCache=None, streamTimeout=0,
+                precision='double'):
+   """Regrid one input file in-process, the equivalent of one NCL
+   regridding script invocation
+
+   Parameters
+   ----------
+   product: str
+      'HRRR', 'RAP', 'GFS' or 'MRMS'
+   srcFile: str
+      Full path to the GRIB2 input file
+   wgtFile: str
+      ESMF weight file
+   dstGridName: str
+      Destination grid (geo_dst.nc) file
+   outFile: str
+      Full path to the regridded output file, None to only return the
+      regridded fields
+   zero_process: bool
+      True to regrid only the fields in a 0hr forecast file
+   cacheDir: str
+      Compiled weight cache directory, None to read the ESMF file
+   numThreads: int
+      Number of threads for the batched regridding of all fields
+   kernel: str
+      'csr' (sparse matrix), 'gather' (4-point gather) or 'sparse'
+      (nonzero source cells only) regridding
+   order: str
+      Weight matrix ordering in the weight cache ('native' or 'tile')
+   indexDir: str
+      GRIB2 index directory (see Grib2_Index), None for next to the file
+   fieldCache: Field_Cache.FieldCache
+      Decoded field cache shared with the other consumers of srcFile,
+      None for no caching
+   streamTimeout: float
+      If > 0, srcFile may still be being written: its fields are decoded
+      as their messages land (Grib2_Stream), waiting up to this many
+      seconds for all of them
+   precision: str
+      Precision of the weights, see get_weights
+
+   Returns
+   -------
+   list
+      (name, regridded field, units, description) per field
+   """
+   if product not in SUPPORTED_PRODUCTS:
+      raise RegridError('In-process regridding not supported for %s'%product)
+   for f in [srcFile, dstGridName]:
+      if not os.path.exists(f):
+         WhfLog.error('File: ' + f + ' not found.')
+         raise MissingFileError('File %s not found'%f)
+
+   start = time.time()
+   weights = get_weights(wgtFile, dstGridName, cacheDir, kernel, order,
+                         precision)
+   if streamTimeout > 0:
+      fields = gs.stream_fields(product, srcFile, zero_process,
+                                weights.footprint(), streamTimeout)
+   else:
+      fields = gr.read_fields(product, srcFile, zero_process, weights.footprint(),
+                              None, indexDir, fieldCache)
+   regridded = _regrid_and_write(product, weights, fields, dstGridName, outFile,
+                                 numThreads, kernel)
+   WhfLog.info("Time(sec) to regrid file in-process %s", time.time() - start)
+   return regridded
+
+#----------------------------------------------------------------------------
+def regrid_fields(product, fields, wgtFile, dstGridName, outFile, cacheDir=None,
+                  numThreads=1, kernel='csr', order='native', precision='double'):
+   """Regrid fields already decoded (e.g. accumulated from several input
+   files) and write them as regrid_file does
+
+   Parameters
+   ----------
+   product: str
+      'HRRR', 'RAP', 'GFS' or 'MRMS', for the output layout
+   fields: list
+      (name, numpy.ndarray, units, description) on the whole source grid
+      or already on the footprint of the weights
+   wgtFile, dstGridName, outFile, cacheDir, numThreads, kernel, order,
+   precision:
+      As for regrid_file
+
+   Returns
+   -------
+   list
+      As for regrid_file
+   """
+   start = time.time()
+   weights = get_weights(wgtFile, dstGridName, cacheDir, kernel, order,
+                         precision)
+   fields = [(name, weights.subset(values), units, desc)
+             for (name, values, units, desc) in fields]
+   regridded = _regrid_and_write(product, weights, fields, dstGridName, outFile,
+                                 numThreads, kernel)
+   WhfLog.info("Time(sec) to regrid fields in-process %s", time.time() - start)
+   return regridded
+
+#----------------------------------------------------------------------------
+def _regrid_and_write(product, weights, fields, dstGridName, outFile, numThreads,
+                      kernel):
+   """Regrid footprint fields and write the output file of a product (if
+   outFile is not None), returns the regridded fields"""
+   if kernel == 'sparse':
+      # mostly zero fields (MRMS): regrid the nonzero cells only, the
+      # destination fields stay sparse until written
+      values = [weights.applySparse(sparse_from_dense(f[1])) for f in fields]
+   else:
+      values = weights.applyBatch([f[1] for f in fields], numThreads)
+   regridded = []
+   for (field, value) in zip(fields, values):
+      regridded.append((field[0], value, field[2], field[3]))
+
+   if product == 'GFS':
+      # As in the GFS NCL script, RAINRATE is zero when there is no
+      # precipitation rate in the file (0hr forecast)
+      if 'RAINRATE' not in [r[0] for r in regridded]:
+         zero = np.zeros(weights.dstShape(), dtype=np.float32)
+         regridded.append(('RAINRATE', zero, 'mm s^-1', 'RAINRATE'))
+   if outFile is not None:
+      write_regridded(product, regridded, dstGridName, outFile,
+                      weights.dstShape())
+   return regridded
+
+#----------------------------------------------------------------------------
+def write_regridded(product, regridded, dstGridName, outFile, dstShape):
+   """Write the regridded fields of a product as its NCL script does
+
+   Parameters
+   ----------
+   product: str
+      'HRRR', 'RAP', 'GFS' or 'MRMS'
+   regridded: list
+      (name, regridded field, units, description) per field, as returned
+      by regrid_file or regrid_fields
+   dstGridName: str
+      Destination grid (geo_dst.nc) file
+   outFile: str
+      Full path to the regridded output file
+   dstShape: tuple
+      (ny, nx) of the destination grid
+
+   Returns
+   -------
+   None
+   """
+   latlon = None
+   if product == 'GFS':
+      # The GFS NCL script writes the destination lat/lon as well
+      dst = Dataset(dstGridName, 'r')
+      try:
+         latlon = (dst.variables['XLAT_M'][0, :, :],
+                   dst.variables['XLONG_M'][0, :, :])
+      finally:
+         dst.close()
+   write_ldasin(outFile, regridded, dstShape, latlon)
+
+#----------------------------------------------------------------------------
+def get_precision(parser):
+   """Precision of the in-process regridding, downscaling and layering,
+   [precision] mode: 'double' (the default) or 'single', see PRECISIONS"""
+   if not parser.has_option('precision', 'mode'):
+      return 'double'
+   precision = parser.get('precision', 'mode').strip().lower()
+   if precision not in PRECISIONS:
+      WhfLog.error("Unrecognized precision %s", precision)
+      raise UnrecognizedCommandError('Unrecognized precision %s'%precision)
+   return precision
@@ -0,0 +1,245 @@
+"""Stage_Pipeline
+Runs the files of one product through a sequence of stages (decode,
+regrid/downscale, write), each stage in its own thread with a bounded
+queue in front of it, so file N+1 is decoded while file N is computed
+and file N-1 written.  A full queue blocks the stage feeding it
+(backpressure): at most depth files wait between two stages, which
+bounds the memory held by decoded and regridded fields.
+
+Each stage reports how long it worked, how long it waited for input
+(starved), how long it waited for room in the next queue (blocked), the
+depth of its input queue and the largest resident set size (RSS) of the
+process when it finished an item.  The bottleneck is the stage whose
+input queue stays full while the stages after it are starved.  Stages
+run outside a pipeline report their time and RSS with log_stage.
+"""
+
+import os
+import time
+import resource
+import threading
+import Queue
+import WhfLog
+
+# Default number of items that can wait between two stages
+DEFAULT_DEPTH = 2
+
+# End of the items, passed down the stages
+_END = object()
+
+#----------------------------------------------------------------------------
+class StageStats:
+   """Timing and queue depth of one stage
+
+   Attributes
+   ----------
+   _name: str
+      Stage name
+   _items: int
+      Items processed
+   _failed: int
+      Items the stage failed on
+   _busy: float
+      Seconds spent processing items
+   _starved: float
+      Seconds spent waiting for an input item
+   _blocked: float
+      Seconds spent waiting for room in the output queue
+   _depthSum: int
+      Sum of the input queue depths seen when taking an item
+   _depthMax: int
+      Largest input queue depth seen when taking an item
+   _rssMax: float
+      Largest process RSS (MB) seen when finishing an item
+   """
+
+   #--------------------------------------------------------------------------
+   def __init__(self, name):
+      """Initialization with nothing measured"""
+      self._name = name
+      self._items = 0
+      self._failed = 0
+      self._busy = 0.0
+      self._starved = 0.0
+      self._blocked = 0.0
+      self._depthSum = 0
+      self._depthMax = 0
+      self._rssMax = 0.0
+
+   #--------------------------------------------------------------------------
+   def debugPrint(self):
+      """WhfLog debug of content"""
+      WhfLog.debug("Stage %s: items=%d failed=%d busy=%.2f starved=%.2f "
+                   "blocked=%.2f queue depth mean=%.2f max=%d rss=%.1f",
+                   self._name, self._items, self._failed, self._busy,
+                   self._starved, self._blocked, self.meanDepth(),
+                   self._depthMax, self._rssMax)
+
+   #--------------------------------------------------------------------------
+   def meanDepth(self):
+      """Mean input queue depth seen when taking an item"""
+      if self._items == 0:
+         return 0.0
+      return float(self._depthSum)/self._items
+
+   #--------------------------------------------------------------------------
+   def report(self):
+      """WhfLog info of the stage timing and queue depth"""
+      WhfLog.info("Stage %s: %d items (%d failed), busy %.2f s, starved "
+                  "%.2f s, blocked %.2f s, input queue depth mean %.2f max %d, "
+                  "RSS max %.1f MB", self._name, self._items, self._failed,
+                  self._busy, self._starved, self._blocked, self.meanDepth(),
+                  self._depthMax, self._rssMax)
+
+#----------------------------------------------------------------------------
+class StagePipeline:
+   """Stages run in their own threads with bounded queues between them
+
+   Attributes
+   ----------
+   _stages: list
+      (name, function) of each stage in order; function(item, value)
+      returns the value passed to the next stage, value being the item
+      itself for the first stage
+   _depth: int
+      Maximum number of items waiting in front of each stage but the
+      first
+   _stats: list
+      StageStats of each stage, of the last run
+   """
+
+   #--------------------------------------------------------------------------
+   def __init__(self, stages, depth=DEFAULT_DEPTH):
+      """Initialization
+
+      Parameters
+      ----------
+      stages: list
+         (name, function) of each stage
+      depth: int
+         Queue depth between two stages, at least 1
+      """
+      self._stages = stages
+      self._depth = max(1, depth)
+      self._stats = [StageStats(name) for (name, function) in stages]
+
+   #--------------------------------------------------------------------------
+   def debugPrint(self):
+      """WhfLog debug of content"""
+      WhfLog.debug("Pipeline: stages=%s depth=%d",
+                   [name for (name, function) in self._stages], self._depth)
+      for stats in self._stats:
+         stats.debugPrint()
+
+   #--------------------------------------------------------------------------
+   def run(self, items):
+      """Run all the items through the stages
+
+      An item a stage fails on (raises an exception) is logged and
+      passed down to the end as failed, the other items go on.
+
+      Parameters
+      ----------
+      items: list
+         Items to process, in order
+
+      Returns
+      -------
+      list
+         (item, value of the last stage) for each item, in order; the
+         value is None for the items that failed
+      """
+      self._stats = [StageStats(name) for (name, function) in self._stages]
+      # input of the first stage, and output of the last, are not bounded
+      queues = [Queue.Queue()]
+      queues += [Queue.Queue(self._depth) for s in self._stages[1:]]
+      queues.append(Queue.Queue())
+      threads = []
+      for (index, stage) in enumerate(self._stages):
+         thread = threading.Thread(target=self._runStage,
+                                   args=(stage, self._stats[index],
+                                         queues[index], queues[index + 1]))
+         thread.daemon = True
+         thread.start()
+         threads.append(thread)
+
+      for item in items:
+         queues[0].put((item, item, True))
+      queues[0].put(_END)
+      done = []
+      while True:
+         entry = queues[-1].get()
+         if entry is _END:
+            break
+         (item, value, ok) = entry
+         done.append((item, value if ok else None))
+      for thread in threads:
+         thread.join()
+      for stats in self._stats:
+         stats.report()
+      return done
+
+   #--------------------------------------------------------------------------
+   def _runStage(self, stage, stats, inQueue, outQueue):
+      """Thread of one stage: take, process and pass on items until the end"""
+      (name, function) = stage
+      while True:
+         depth = inQueue.qsize()
+         start = time.time()
+         entry = inQueue.get()
+         stats._starved += time.time() - start
+         if entry is _END:
+            outQueue.put(_END)
+            return
+         (item, value, ok) = entry
+         stats._items += 1
+         stats._depthSum += depth
+         stats._depthMax = max(stats._depthMax, depth)
+         if ok:
+            start = time.time()
+            try:
+               value = function(item, value)
+            except Exception as e:
+               WhfLog.error("Stage %s failed on %s: %s", name, item, e)
+               stats._failed += 1
+               (value, ok) = (None, False)
+            stats._busy += time.time() - start
+            stats._rssMax = max(stats._rssMax, rss_mb())
+         start = time.time()
+         outQueue.put((item, value, ok))
+         stats._blocked += time.time() - start
+
+#----------------------------------------------------------------------------
+def peak_rss_mb():
+   """Peak resident set size of the process so far, MB"""
+   # kB on Linux
+   return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024.0
+
+#----------------------------------------------------------------------------
+def rss_mb():
+   """Current resident set size of the process, MB (the peak where
+   /proc is not available)"""
+   try:
+      f = open('/proc/self/statm')
+      try:
+         pages = int(f.read().split()[1])
+      finally:
+         f.close()
+   except (IOError, ValueError, IndexError):
+      return peak_rss_mb()
+   return pages*os.sysconf('SC_PAGE_SIZE')/(1024.0*1024.0)
+
+#----------------------------------------------------------------------------
+def log_stage(name, start):
+   """WhfLog info of the wall time of a stage run outside a pipeline,
+   started at start (time.time()), and of the process RSS after it"""
+   WhfLog.info("Stage %s: %.2f s, RSS %.1f MB, peak RSS %.1f MB", name,
+               time.time() - start, rss_mb(), peak_rss_mb())
+
+#----------------------------------------------------------------------------
+def get_queue_depth(parser):
+   """Queue depth between two stages, [regridding] pipeline_queue_depth,
+   DEFAULT_DEPTH if not set"""
+   if not parser.has_option('regridding', 'pipeline_queue_depth'):
+      return DEFAULT_DEPTH
+   return max(1, parser.getint('regridding', 'pipeline_queue_depth'))
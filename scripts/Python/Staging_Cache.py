@@ -0,0 +1,341 @@
+"""Staging_Cache
+Local disk copies of the input files, which live on network (autofs)
+mounts.  Regrid_Driver prefetches the new files it found into the
+staging directory in a background thread while the current file is
+being regridded, and the regridding reads the local copy, so the
+network transfer is off the critical path and replays and retries do
+not read the same file over the network again.
+
+A staged file is <staging dir>/<parent dir name>.<hash of the parent
+dir>/<file name>, so the YYYYMMDD_ihh_fnnn file naming the forcing
+scripts rely on is kept.  Copies keep the modification time of the
+original and are used only while size and modification time match it.
+Files are copied to a temporary name and renamed, so a partial copy is
+never used.  The staging directory is kept under [data_dir] staging_mb
+megabytes by removing the least recently used files (by access time,
+set explicitly on each use) after each copy.
+
+When [data_dir] staging_dir is not set, or a copy fails, the original
+file is used.
+"""
+
+import os
+import time
+import shutil
+import hashlib
+import tempfile
+import threading
+import WhfLog
+
+# Default staging size limit, MB
+DEFAULT_MAX_MB = 20480
+
+# Age (seconds) after which a left over temporary copy is removed
+_STALE_TMP_SECONDS = 3600
+
+# Files used more recently than this (seconds) are not evicted, they may
+# be about to be opened by the regridding
+_IN_USE_SECONDS = 600
+
+# StagingCache per staging directory, shared by everything in a process
+_caches = {}
+_cachesLock = threading.Lock()
+
+#----------------------------------------------------------------------------
+class StagingCache:
+   """Staging directory with its prefetch thread(s)
+
+   Attributes
+   ----------
+   _stageDir: str
+      Staging directory, on a local disk
+   _maxBytes: int
+      Size limit of the staging directory
+   _lock: threading.Lock
+      Protects _pending
+   _pending: dict
+      Local path -> threading.Event set when the copy is done, for
+      the copies in progress
+   """
+
+   #--------------------------------------------------------------------------
+   def __init__(self, stageDir, maxBytes):
+      """Initialization using input args
+
+      Parameters
+      ----------
+      stageDir: str
+         Staging directory
+      maxBytes: int
+         Size limit of the staging directory
+      """
+      self._stageDir = stageDir
+      self._maxBytes = maxBytes
+      self._lock = threading.Lock()
+      self._pending = {}
+
+   #--------------------------------------------------------------------------
+   def debugPrint(self):
+      """ Debug logging of content
+      """
+      WhfLog.debug("Staging %s, %d MB, %d copies in progress", self._stageDir,
+                   self._maxBytes/(1024*1024), len(self._pending))
+
+   #--------------------------------------------------------------------------
+   def localPath(self, srcFile):
+      """Staged path of an original file"""
+      srcDir = os.path.dirname(os.path.abspath(srcFile))
+      h = hashlib.sha1()
+      h.update(srcDir)
+      return os.path.join(self._stageDir,
+                          os.path.basename(srcDir) + '.' + h.hexdigest()[:12],
+                          os.path.basename(srcFile))
+
+   #--------------------------------------------------------------------------
+   def _isCurrent(self, srcFile, local):
+      """True if local is an up to date copy of srcFile (and then mark it
+      as used)"""
+      try:
+         src = os.stat(srcFile)
+         st = os.stat(local)
+      except OSError:
+         return False
+      if st.st_size != src.st_size or int(st.st_mtime) != int(src.st_mtime):
+         return False
+      # the access time orders the eviction, set it whatever the mount
+      # options; keep the modification time of the original
+      os.utime(local, (time.time(), st.st_mtime))
+      return True
+
+   #--------------------------------------------------------------------------
+   def stage(self, srcFile):
+      """Local copy of a file, copying it now if needed (or waiting for
+      the prefetch copy in progress)
+
+      Parameters
+      ----------
+      srcFile: str
+         Original file
+
+      Returns
+      -------
+      str
+         Path of the local copy, srcFile if it could not be staged
+      """
+      local = self.localPath(srcFile)
+      self._lock.acquire()
+      try:
+         # keyed by the local path, the same whatever the formatting of srcFile
+         event = self._pending.get(local)
+         if event is None:
+            if self._isCurrent(srcFile, local):
+               return local
+            event = threading.Event()
+            self._pending[local] = event
+            owner = True
+         else:
+            owner = False
+      finally:
+         self._lock.release()
+
+      if not owner:
+         event.wait()
+         if self._isCurrent(srcFile, local):
+            return local
+         return srcFile
+
+      try:
+         try:
+            start = time.time()
+            self._copy(srcFile, local)
+            WhfLog.debug("Time(sec) to stage %s: %s", srcFile, time.time() - start)
+         except (IOError, OSError) as e:
+            WhfLog.warning("Cannot stage %s, using it in place: %s", srcFile, e)
+            return srcFile
+      finally:
+         self._lock.acquire()
+         try:
+            del self._pending[local]
+         finally:
+            self._lock.release()
+         event.set()
+      self.evict(local)
+      return local
+
+   #--------------------------------------------------------------------------
+   def _copy(self, srcFile, local):
+      """Copy srcFile with its modification time to local, atomically"""
+      localDir = os.path.dirname(local)
+      if not os.path.exists(localDir):
+         try:
+            os.makedirs(localDir)
+         except OSError:
+            if not os.path.isdir(localDir):
+               raise
+      fd, tmpName = tempfile.mkstemp(dir=localDir,
+                                     prefix='.' + os.path.basename(local))
+      os.close(fd)
+      try:
+         shutil.copyfile(srcFile, tmpName)
+         # modification time of the original, access time now (it
+         # is about to be used)
+         os.utime(tmpName, (time.time(), os.stat(srcFile).st_mtime))
+         os.rename(tmpName, local)
+      except:
+         if os.path.exists(tmpName):
+            os.remove(tmpName)
+         raise
+
+   #--------------------------------------------------------------------------
+   def prefetch(self, srcFiles):
+      """Stage files in order in a background thread
+
+      Parameters
+      ----------
+      srcFiles: list
+         Original files
+
+      Returns
+      -------
+      threading.Thread
+         The (started, daemon) prefetch thread
+      """
+      def run():
+         for srcFile in srcFiles:
+            if os.path.exists(srcFile):
+               self.stage(srcFile)
+      thread = threading.Thread(target=run, name='prefetch')
+      thread.setDaemon(True)
+      thread.start()
+      return thread
+
+   #--------------------------------------------------------------------------
+   def evict(self, keep=None):
+      """Remove the least recently used files until the staging directory
+      is under its size limit
+
+      Parameters
+      ----------
+      keep: str
+         Staged file never to remove (the one just copied).  Files used
+         in the last _IN_USE_SECONDS are not removed either, so the limit
+         can be exceeded for a while.
+
+      Returns
+      -------
+      int
+         Number of files removed
+      """
+      now = time.time()
+      files = []
+      total = 0
+      for d in os.listdir(self._stageDir):
+         subdir = os.path.join(self._stageDir, d)
+         if not os.path.isdir(subdir):
+            continue
+         for f in os.listdir(subdir):
+            path = os.path.join(subdir, f)
+            try:
+               st = os.stat(path)
+            except OSError:
+               continue
+            if f.startswith('.'):
+               # temporary copy, left over if older than a copy can take
+               if now - st.st_mtime > _STALE_TMP_SECONDS:
+                  _remove(path)
+               continue
+            files.append((st.st_atime, path, st.st_size))
+            total += st.st_size
+      files.sort()
+      removed = 0
+      for (atime, path, size) in files:
+         if total <= self._maxBytes:
+            break
+         if path == keep or now - atime < _IN_USE_SECONDS:
+            continue
+         WhfLog.debug("Evicting staged file %s", path)
+         if _remove(path):
+            total -= size
+            removed += 1
+      return removed
+
+#----------------------------------------------------------------------------
+def _remove(path):
+   """Remove a file, False if it could not be"""
+   try:
+      os.remove(path)
+   except OSError:
+      return False
+   try:
+      # also its directory once empty
+      os.rmdir(os.path.dirname(path))
+   except OSError:
+      pass
+   return True
+
+#----------------------------------------------------------------------------
+def get_staging_cache(parser):
+   """The StagingCache of the [data_dir] staging_dir, None if not set
+
+   There is one StagingCache per directory in a process, so a file
+   being prefetched is not copied a second time by the regridding.
+   """
+   if not parser.has_option('data_dir', 'staging_dir'):
+      return None
+   stageDir = parser.get('data_dir', 'staging_dir').strip()
+   if not stageDir:
+      return None
+   maxMb = DEFAULT_MAX_MB
+   if parser.has_option('data_dir', 'staging_mb'):
+      maxMb = parser.getint('data_dir', 'staging_mb')
+   _cachesLock.acquire()
+   try:
+      if stageDir not in _caches:
+         if not os.path.exists(stageDir):
+            try:
+               os.makedirs(stageDir)
+            except OSError:
+               if not os.path.isdir(stageDir):
+                  WhfLog.warning("Cannot create staging directory %s", stageDir)
+                  return None
+         _caches[stageDir] = StagingCache(stageDir, maxMb*1024*1024)
+      return _caches[stageDir]
+   finally:
+      _cachesLock.release()
+
+#----------------------------------------------------------------------------
+def stage_file(parser, srcFile):
+   """Local copy of an input file if staging is configured
+
+   Parameters
+   ----------
+   parser: ConfigParser
+      Parser to the config/parm file
+   srcFile: str
+      Input file
+
+   Returns
+   -------
+   str
+      Path to read the input from
+   """
+   cache = get_staging_cache(parser)
+   if cache is None or not os.path.exists(srcFile):
+      return srcFile
+   return cache.stage(srcFile)
+
+#----------------------------------------------------------------------------
+def prefetch(parser, srcFiles):
+   """Start staging input files in the background if staging is
+   configured
+
+   Returns
+   -------
+   threading.Thread
+      The prefetch thread, None if staging is not configured
+   """
+   cache = get_staging_cache(parser)
+   if cache is None or not srcFiles:
+      return None
+   WhfLog.debug("Prefetching %d files into %s", len(srcFiles), cache._stageDir)
+   return cache.prefetch(srcFiles)
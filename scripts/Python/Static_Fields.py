@@ -0,0 +1,236 @@
+"""Static_Fields
+Node-wide shared copies of the static 2D fields of netCDF files, such as
+HGT_M, XLAT_M, XLONG_M, COSALPHA and SINALPHA of the geo files, which
+every worker would otherwise read into its own memory.  The first
+process that needs a field publishes it as a .npy file in the static
+fields directory ([data_dir] static_fields_dir), and all processes
+memory map it read-only, so N workers on a node share one copy.  With
+the directory on /dev/shm (POSIX shared memory on Linux) the fields are
+held in RAM once per node; on disk they are shared through the page
+cache.
+
+The static data derived from these files have caches of the same kind:
+the compiled weights (Weight_Cache) and the terrain terms and shortwave
+geometry of the downscaling (Terrain_Cache).  Their directories can be
+put on /dev/shm as well.
+
+Each source file has one entry, keyed by its fingerprint: the path, size
+and modification time of the file.  A changed file gets a new entry and
+the stale entries of the file are removed.  Fields are added to an entry
+as they are first requested, each atomically, so concurrent workers
+never see a partial array.  The geo files of the downscaled products can
+be published ahead of time with:
+
+   python Static_Fields.py <config file>
+"""
+
+import os
+import sys
+import errno
+import shutil
+import hashlib
+import tempfile
+import numpy as np
+from netCDF4 import Dataset
+from ConfigParser import SafeConfigParser
+import WhfLog
+from ForcingEngineError import MissingFileError
+
+# Bump when the on-disk layout changes so old entries are not reused
+CACHE_VERSION = 1
+
+# Geo file fields published by main
+GEO_FIELDS = ['HGT_M', 'XLAT_M', 'XLONG_M', 'COSALPHA', 'SINALPHA']
+
+# Downscaled products, with the prefix of their [downscaling] options
+_PRODUCTS = ['HRRR', 'RAP', 'GFS', 'CFS']
+
+#----------------------------------------------------------------------------
+def fingerprint(ncFile):
+   """Hex digest of version and path/size/mtime of a file"""
+   if not os.path.exists(ncFile):
+      WhfLog.error('File: ' + ncFile + ' not found.')
+      raise MissingFileError('File %s not found'%ncFile)
+   st = os.stat(ncFile)
+   h = hashlib.sha1()
+   h.update(('v%d|%s:%d:%d'%(CACHE_VERSION, os.path.abspath(ncFile),
+                             st.st_size, int(st.st_mtime))).encode('utf-8'))
+   return h.hexdigest()
+
+#----------------------------------------------------------------------------
+def entry_dir(ncFile, staticDir):
+   """Directory holding the entry of a file,
+   <file basename>.<path hash>.<fingerprint>"""
+   return os.path.join(staticDir, _entry_base(ncFile) + fingerprint(ncFile))
+
+#----------------------------------------------------------------------------
+def _entry_base(ncFile):
+   """Start of the entry directory names of a file; the hash of its
+   absolute path keeps apart the entries of files of the same name in
+   different directories, and of files whose names start the same
+   (geo.nc and geo.d02.nc)"""
+   h = hashlib.sha1()
+   h.update(os.path.abspath(ncFile))
+   return os.path.splitext(os.path.basename(ncFile))[0] + '.' + \
+          h.hexdigest()[:12] + '.'
+
+#----------------------------------------------------------------------------
+def _purge_stale(ncFile, staticDir, keep):
+   """Remove entries of the same file other than keep (workers still
+   mapping their fields keep them until they unmap)"""
+   base = _entry_base(ncFile)
+   for name in os.listdir(staticDir):
+      path = os.path.join(staticDir, name)
+      if name.startswith(base) and path != keep and os.path.isdir(path):
+         WhfLog.info("Removing stale static fields entry %s", path)
+         shutil.rmtree(path, ignore_errors=True)
+
+#----------------------------------------------------------------------------
+def _field_file(entry, name, dtype):
+   """File of a field of an entry, <name>.<type>.npy"""
+   return os.path.join(entry, '%s.%s.npy'%(name, np.dtype(dtype).str[1:]))
+
+#----------------------------------------------------------------------------
+def read_2d(nc, name, dtype=np.float32):
+   """First 2D slice of a variable of an open netCDF file, NaN where
+   missing"""
+   values = np.ma.filled(nc.variables[name][:], np.nan)
+   values = np.ascontiguousarray(values, dtype=dtype)
+   return values.reshape(values.shape[-2:])
+
+#----------------------------------------------------------------------------
+def publish(ncFile, names, staticDir, dtype=np.float32):
+   """Add the fields of a file to its entry, those not already there
+
+   Parameters
+   ----------
+   ncFile: str
+      netCDF file
+   names: list
+      Variable names
+   staticDir: str
+      Static fields directory
+   dtype: numpy.dtype
+      Type the fields are stored as
+
+   Returns
+   -------
+   str
+      The entry directory
+   """
+   entry = entry_dir(ncFile, staticDir)
+   missing = [name for name in names
+              if not os.path.exists(_field_file(entry, name, dtype))]
+   if not missing:
+      return entry
+   created = False
+   try:
+      os.makedirs(entry)
+      created = True
+   except OSError as e:
+      # another worker got there first
+      if e.errno != errno.EEXIST:
+         raise
+
+   WhfLog.info("Publishing %s of %s into %s", missing, ncFile, entry)
+   nc = Dataset(ncFile, 'r')
+   try:
+      for name in missing:
+         fd, tmpName = tempfile.mkstemp(dir=entry, prefix='.' + name,
+                                        suffix='.npy')
+         os.close(fd)
+         try:
+            np.save(tmpName, read_2d(nc, name, dtype))
+            os.rename(tmpName, _field_file(entry, name, dtype))
+         finally:
+            if os.path.exists(tmpName):
+               os.remove(tmpName)
+   finally:
+      nc.close()
+   if created:
+      _purge_stale(ncFile, staticDir, entry)
+   return entry
+
+#----------------------------------------------------------------------------
+def read_fields(ncFile, names, staticDir=None, dtype=np.float32):
+   """Static 2D fields of a file, shared by all processes of the node if
+   there is a static fields directory
+
+   Parameters
+   ----------
+   ncFile: str
+      netCDF file
+   names: list
+      Variable names
+   staticDir: str
+      Static fields directory, None to read the file into memory
+   dtype: numpy.dtype
+      Type of the fields
+
+   Returns
+   -------
+   dict
+      name -> C contiguous 2D field of dtype, NaN where missing;
+      read-only memory mapped with a static fields directory
+   """
+   if not staticDir:
+      if not os.path.exists(ncFile):
+         WhfLog.error('File: ' + ncFile + ' not found.')
+         raise MissingFileError('File %s not found'%ncFile)
+      nc = Dataset(ncFile, 'r')
+      try:
+         return dict([(name, read_2d(nc, name, dtype)) for name in names])
+      finally:
+         nc.close()
+   entry = publish(ncFile, names, staticDir, dtype)
+   fields = {}
+   for name in names:
+      fields[name] = np.load(_field_file(entry, name, dtype), mmap_mode='r')
+   WhfLog.debug("Memory mapped %s of %s from %s", names, ncFile, entry)
+   return fields
+
+#----------------------------------------------------------------------------
+def get_static_dir(parser):
+   """Static fields directory from the [data_dir] section, None if not set"""
+   if parser.has_option('data_dir', 'static_fields_dir'):
+      staticDir = parser.get('data_dir', 'static_fields_dir').strip()
+      if staticDir:
+         return staticDir
+   return None
+
+#----------------------------------------------------------------------------
+def main(argv):
+   """Publish the GEO_FIELDS of the geo files of every downscaled product
+   configured in a config file
+
+   Parameters
+   ----------
+   argv: list
+      [config file]
+
+   Returns
+   -------
+   1 for error, 0 for success
+   """
+   if len(argv) != 1 or not os.path.exists(argv[0]):
+      print 'Usage: python Static_Fields.py <config file>'
+      return 1
+   parser = SafeConfigParser()
+   parser.read(argv[0])
+   staticDir = get_static_dir(parser)
+   if staticDir is None:
+      print 'ERROR static_fields_dir not set in [data_dir] of', argv[0]
+      return 1
+   geoFiles = []
+   for product in _PRODUCTS:
+      geoFile = parser.get('downscaling', product + '_geo_data')
+      if geoFile not in geoFiles:
+         geoFiles.append(geoFile)
+   for geoFile in geoFiles:
+      print geoFile, publish(geoFile, GEO_FIELDS, staticDir)
+   return 0
+
+#----------------------------------------------------------------------------
+
+if __name__ == "__main__":
+   sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,423 @@
+"""Terrain_Cache
+On-disk cache of the static terms of the downscaling height correction.
+For each combination of source terrain (<product>_hgt_data), WRF-Hydro
+geo file (HGT_M) and lapse rate file, which is one per product and
+domain, the terms that do not change between forecasts are computed
+once:
+
+   dhgt        DHGT = HGT - HGT_M (m)
+   t_increment DHGT*lapse/1000, added to T2D (K)
+   p_factor    DHGT*9.8/287.05, PSFC += PSFC*p_factor/T2D (K)
+
+and stored as .npy files that are memory mapped on load, so the
+downscaling of each file only combines them with its dynamic fields,
+and parallel workers share one copy through the page cache.  The
+float32 copies of the single precision mode are added to the entry on
+first use (*_f4.npy) and shared the same way.
+
+The static terrain terms of the shortwave adjustment of each geo file
+(Downscale_Engine.geometry_terms) are kept the same way, together with
+the correction factor tables: the factor of each cell for one day of
+year and hour, computed on first use and memory mapped afterwards, so
+the shortwave adjustment of a file is a lookup and a multiply.  The
+least recently used tables beyond MAX_TABLE_MB are removed.
+
+Entries are keyed by the path, size and modification time of the three
+files (a missing lapse rate file means the constant lapse rate) and are
+rebuilt automatically when any of these change.  The cache can be
+filled ahead of time with:
+
+   python Terrain_Cache.py <config file>
+"""
+
+import os
+import sys
+import shutil
+import hashlib
+import tempfile
+import numpy as np
+from ConfigParser import SafeConfigParser
+import WhfLog
+import Downscale_Engine as dse
+from ForcingEngineError import MissingFileError
+
+# Bump when the on-disk layout changes so old entries are not reused
+CACHE_VERSION = 1
+
+# Files making up one cache entry
+_ARRAYS = ['dhgt', 't_increment', 'p_factor']
+
+# Correction factor tables of a geo file are kept under this size, MB
+MAX_TABLE_MB = 2048
+
+# Downscaled products, with the prefix of their [downscaling] options
+_PRODUCTS = ['HRRR', 'RAP', 'GFS', 'CFS']
+
+#----------------------------------------------------------------------------
+def _file_signature(fname):
+   """Returns 'path:size:mtime' for a file, 'none' if it does not exist"""
+   if not fname or not os.path.exists(fname):
+      return 'none'
+   st = os.stat(fname)
+   return '%s:%d:%d'%(os.path.abspath(fname), st.st_size, int(st.st_mtime))
+
+#----------------------------------------------------------------------------
+def cache_key(hgtFile, geoFile, lapseFile):
+   """Key identifying the static terrain terms
+
+   Parameters
+   ----------
+   hgtFile: str
+      Source model terrain on the WRF-Hydro grid
+   geoFile: str
+      WRF-Hydro geo file
+   lapseFile: str
+      Lapse rate file, possibly missing
+
+   Returns
+   -------
+   str
+      Hex digest of version, path/size/mtime of the three files
+   """
+   for f in [hgtFile, geoFile]:
+      if not os.path.exists(f):
+         WhfLog.error('File: ' + f + ' not found.')
+         raise MissingFileError('File %s not found'%f)
+   h = hashlib.sha1()
+   h.update(('v%d|%s|%s|%s'%(CACHE_VERSION, _file_signature(hgtFile),
+                             _file_signature(geoFile),
+                             _file_signature(lapseFile))).encode('utf-8'))
+   return h.hexdigest()
+
+#----------------------------------------------------------------------------
+def entry_dir(hgtFile, geoFile, lapseFile, cacheDir):
+   """Directory holding the cache entry of a source terrain and domain
+
+   Named <hgt file basename>.<geo file basename>.<paths hash>.<key> so
+   stale entries of the same product and domain are easy to find
+   """
+   return os.path.join(cacheDir, _entry_base(hgtFile, geoFile) +
+                       cache_key(hgtFile, geoFile, lapseFile))
+
+#----------------------------------------------------------------------------
+def _paths_hash(*fnames):
+   """Short hash of the absolute paths of files, keeping apart the
+   entries of files of the same name in different (domain) directories"""
+   h = hashlib.sha1()
+   h.update('|'.join([os.path.abspath(f) for f in fnames]))
+   return h.hexdigest()[:12]
+
+#----------------------------------------------------------------------------
+def _entry_base(hgtFile, geoFile):
+   """Start of the entry directory names of a source terrain and domain"""
+   return os.path.splitext(os.path.basename(hgtFile))[0] + '.' + \
+          os.path.splitext(os.path.basename(geoFile))[0] + '.' + \
+          _paths_hash(hgtFile, geoFile) + '.'
+
+#----------------------------------------------------------------------------
+def _geometry_base(geoFile):
+   """Start of the shortwave geometry entry directory names of a geo file"""
+   return os.path.splitext(os.path.basename(geoFile))[0] + '.' + \
+          _paths_hash(geoFile) + '.geometry.'
+
+#----------------------------------------------------------------------------
+def _purge_stale(hgtFile, geoFile, cacheDir, keep):
+   """Remove entries of the same source terrain and domain other than keep"""
+   base = _entry_base(hgtFile, geoFile)
+   for name in os.listdir(cacheDir):
+      path = os.path.join(cacheDir, name)
+      if name.startswith(base) and path != keep and os.path.isdir(path):
+         WhfLog.info("Removing stale terrain cache entry %s", path)
+         shutil.rmtree(path, ignore_errors=True)
+
+#----------------------------------------------------------------------------
+def build(hgtFile, geoFile, lapseFile, cacheDir):
+   """Compute the static terrain terms into a cache entry, if not there
+
+   The entry is written to a temporary directory which is renamed into
+   place, so concurrent workers never see a partial entry.
+
+   Parameters
+   ----------
+   hgtFile, geoFile, lapseFile: str
+      As for Downscale_Engine.static_terrain
+   cacheDir: str
+      Cache directory
+
+   Returns
+   -------
+   str
+      The entry directory
+   """
+   entry = entry_dir(hgtFile, geoFile, lapseFile, cacheDir)
+   if os.path.isdir(entry):
+      return entry
+   if not os.path.exists(cacheDir):
+      os.makedirs(cacheDir)
+
+   WhfLog.info("Computing static terrain of %s and %s into %s", hgtFile,
+               geoFile, entry)
+   terrain = dse.static_terrain(hgtFile, geoFile, lapseFile)
+   tmpDir = tempfile.mkdtemp(dir=cacheDir, prefix='.build.')
+   try:
+      for (name, values) in zip(_ARRAYS, terrain):
+         np.save(os.path.join(tmpDir, name + '.npy'), values)
+      try:
+         os.rename(tmpDir, entry)
+      except OSError:
+         # another worker got there first
+         if not os.path.isdir(entry):
+            raise
+   finally:
+      if os.path.isdir(tmpDir):
+         shutil.rmtree(tmpDir, ignore_errors=True)
+   _purge_stale(hgtFile, geoFile, cacheDir, entry)
+   return entry
+
+#----------------------------------------------------------------------------
+def _single(entry, name):
+   """Name of the float32 version of an array of an entry, saved into the
+   entry (atomically) on first use"""
+   values = np.load(os.path.join(entry, name + '.npy'), mmap_mode='r')
+   if values.dtype == np.float32:
+      return name
+   single = name + '_f4'
+   path = os.path.join(entry, single + '.npy')
+   if not os.path.exists(path):
+      fd, tmpName = tempfile.mkstemp(dir=entry, prefix='.' + single,
+                                     suffix='.npy')
+      os.close(fd)
+      np.save(tmpName, values.astype(np.float32))
+      os.rename(tmpName, path)
+   return single
+
+#----------------------------------------------------------------------------
+def load(hgtFile, geoFile, lapseFile, cacheDir, precision='double'):
+   """Memory map the static terrain terms, building the entry if needed
+
+   Parameters
+   ----------
+   hgtFile, geoFile, lapseFile: str
+      As for Downscale_Engine.static_terrain
+   cacheDir: str
+      Cache directory
+   precision: str
+      'double', or 'single' for float32 terms
+
+   Returns
+   -------
+   tuple
+      As Downscale_Engine.static_terrain, read-only memory mapped arrays
+   """
+   entry = build(hgtFile, geoFile, lapseFile, cacheDir)
+   names = _ARRAYS
+   if precision == 'single':
+      names = [_single(entry, name) for name in _ARRAYS]
+   terrain = tuple([np.load(os.path.join(entry, name + '.npy'), mmap_mode='r')
+                    for name in names])
+   WhfLog.debug("Memory mapped static terrain of %s and %s from %s",
+                hgtFile, geoFile, entry)
+   return terrain
+
+#----------------------------------------------------------------------------
+def geometry_dir(geoFile, cacheDir):
+   """Directory holding the shortwave geometry entry of a geo file
+
+   Named <geo file basename>.<path hash>.geometry.<key>, the key a hex
+   digest of version and path/size/mtime of the geo file
+   """
+   if not os.path.exists(geoFile):
+      WhfLog.error('File: ' + geoFile + ' not found.')
+      raise MissingFileError('File %s not found'%geoFile)
+   h = hashlib.sha1()
+   h.update(('v%d|geometry|%s'%(CACHE_VERSION,
+                                _file_signature(geoFile))).encode('utf-8'))
+   return os.path.join(cacheDir, _geometry_base(geoFile) + h.hexdigest())
+
+#----------------------------------------------------------------------------
+def build_geometry(geoFile, cacheDir):
+   """Compute the shortwave geometry terms of a geo file into a cache
+   entry, if not already there (atomically, as build)
+
+   Parameters
+   ----------
+   geoFile: str
+      WRF-Hydro geo file
+   cacheDir: str
+      Cache directory
+
+   Returns
+   -------
+   str
+      The entry directory
+   """
+   entry = geometry_dir(geoFile, cacheDir)
+   if os.path.isdir(entry):
+      return entry
+   if not os.path.exists(cacheDir):
+      os.makedirs(cacheDir)
+
+   WhfLog.info("Computing shortwave geometry of %s into %s", geoFile, entry)
+   terms = dse.geometry_terms(geoFile)
+   tmpDir = tempfile.mkdtemp(dir=cacheDir, prefix='.build.')
+   try:
+      for name in dse.GEOMETRY_TERMS:
+         np.save(os.path.join(tmpDir, name + '.npy'), terms[name])
+      try:
+         os.rename(tmpDir, entry)
+      except OSError:
+         # another worker got there first
+         if not os.path.isdir(entry):
+            raise
+   finally:
+      if os.path.isdir(tmpDir):
+         shutil.rmtree(tmpDir, ignore_errors=True)
+   base = _geometry_base(geoFile)
+   for name in os.listdir(cacheDir):
+      path = os.path.join(cacheDir, name)
+      if name.startswith(base) and path != entry and os.path.isdir(path):
+         WhfLog.info("Removing stale shortwave geometry entry %s", path)
+         shutil.rmtree(path, ignore_errors=True)
+   return entry
+
+#----------------------------------------------------------------------------
+def load_geometry(geoFile, cacheDir):
+   """Memory map the shortwave geometry of a geo file, building the entry
+   if needed
+
+   Parameters
+   ----------
+   geoFile: str
+      WRF-Hydro geo file
+   cacheDir: str
+      Cache directory
+
+   Returns
+   -------
+   Downscale_Engine.TerrainGeometry
+      With its correction factor tables in the entry
+   """
+   entry = build_geometry(geoFile, cacheDir)
+   terms = {}
+   for name in dse.GEOMETRY_TERMS:
+      terms[name] = np.load(os.path.join(entry, name + '.npy'), mmap_mode='r')
+   WhfLog.debug("Memory mapped shortwave geometry of %s from %s", geoFile, entry)
+   return dse.TerrainGeometry(geoFile, terms, entry)
+
+#----------------------------------------------------------------------------
+def table_name(validTime):
+   """File name of the correction factor table of a time: day of year
+   and hour, the only parts of the time the factors depend on"""
+   return 'factor_%03d_%02d.npy'%(validTime.timetuple().tm_yday,
+                                  validTime.hour)
+
+#----------------------------------------------------------------------------
+def load_factor(geometry, validTime):
+   """Correction factor table of a time, computed and saved on first use
+
+   Parameters
+   ----------
+   geometry: Downscale_Engine.TerrainGeometry
+      Geometry loaded by load_geometry
+   validTime: datetime.datetime
+      Valid time (UTC)
+
+   Returns
+   -------
+   numpy.ndarray
+      As TerrainGeometry.computeFactor, memory mapped if it was saved
+      before
+   """
+   path = os.path.join(geometry._tableDir, table_name(validTime))
+   if os.path.exists(path):
+      try:
+         # modification time is the last use, for _prune_tables
+         os.utime(path, None)
+         return np.load(path, mmap_mode='r')
+      except (IOError, OSError):
+         # removed meanwhile by another worker's pruning
+         pass
+   factor = geometry.computeFactor(validTime)
+   fd, tmpName = tempfile.mkstemp(dir=geometry._tableDir, prefix='.factor',
+                                  suffix='.npy')
+   os.close(fd)
+   np.save(tmpName, factor)
+   os.rename(tmpName, path)
+   WhfLog.debug("Saved shortwave correction factors %s", path)
+   _prune_tables(geometry._tableDir, path)
+   return factor
+
+#----------------------------------------------------------------------------
+def _prune_tables(tableDir, keep):
+   """Remove the least recently used correction factor tables of a
+   geometry entry beyond MAX_TABLE_MB, never keep"""
+   tables = []
+   for name in os.listdir(tableDir):
+      path = os.path.join(tableDir, name)
+      if not name.startswith('factor_'):
+         continue
+      try:
+         st = os.stat(path)
+      except OSError:
+         continue
+      tables.append((st.st_mtime, st.st_size, path))
+   total = sum([t[1] for t in tables])
+   for (mtime, size, path) in sorted(tables):
+      if total <= MAX_TABLE_MB*1024*1024:
+         break
+      if path == keep:
+         continue
+      try:
+         os.remove(path)
+         total -= size
+      except OSError:
+         pass
+
+#----------------------------------------------------------------------------
+def get_cache_dir(parser):
+   """Terrain cache directory from the [downscaling] section, None if not set"""
+   if parser.has_option('downscaling', 'terrain_cache_dir'):
+      cacheDir = parser.get('downscaling', 'terrain_cache_dir').strip()
+      if cacheDir:
+         return cacheDir
+   return None
+
+#----------------------------------------------------------------------------
+def main(argv):
+   """Compute the static terrain of every downscaled product configured
+   in a config file, and the shortwave geometry of their geo files
+
+   Parameters
+   ----------
+   argv: list
+      [config file]
+
+   Returns
+   -------
+   1 for error, 0 for success
+   """
+   if len(argv) != 1 or not os.path.exists(argv[0]):
+      print 'Usage: python Terrain_Cache.py <config file>'
+      return 1
+   parser = SafeConfigParser()
+   parser.read(argv[0])
+   cacheDir = get_cache_dir(parser)
+   if cacheDir is None:
+      print 'ERROR terrain_cache_dir not set in [downscaling] of', argv[0]
+      return 1
+   lapseFile = parser.get('downscaling', 'lapse_rate_file')
+   geoFiles = []
+   for product in _PRODUCTS:
+      hgtFile = parser.get('downscaling', product + '_hgt_data')
+      geoFile = parser.get('downscaling', product + '_geo_data')
+      print product, build(hgtFile, geoFile, lapseFile, cacheDir)
+      if geoFile not in geoFiles:
+         geoFiles.append(geoFile)
+   for geoFile in geoFiles:
+      print geoFile, build_geometry(geoFile, cacheDir)
+   return 0
+
+#----------------------------------------------------------------------------
+
+if __name__ == "__main__":
+   sys.exit(main(sys.argv[1:]))
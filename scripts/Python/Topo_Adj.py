@@ -0,0 +1,279 @@
+"""Topo_Adj
+In-process call of the Fortran shortwave terrain adjustment (subroutine
+topo_adj of sorc/Fortran/topo_adj.f90) on numpy arrays, in place of
+running topo_adj.ncl, which starts NCL and reopens the downscaled file
+only to rewrite SWDOWN.
+
+The shared object NCL loads (topo_adjf90.so, built with WRAPIT) needs
+NCL's own symbols, so the library called here is the plain shared
+library of the same source.  Built with the compiler and flags WRAPIT
+uses (no optimization), it gives the same values as topo_adj.ncl:
+
+   gfortran -fPIC -shared -o topo_adj_lib.so sorc/Fortran/topo_adj.f90
+
+The domain is split into tiles of rows, each passed with one extra row
+on each side (the halo cal_slope needs for its centred differences), so
+each cell is computed exactly as in one call for the whole domain.  The
+tiles run on a thread pool: ctypes releases the GIL during the call.
+topo_adj keeps about 15 arrays of the tile size on the stack, so the
+tiles are sized to fit the stack of the pool threads (TILE_STACK_MB).
+
+The geo file fields come from Static_Fields, shared by all the workers
+of a node when [data_dir] static_fields_dir is set.
+"""
+
+import os
+import math
+import ctypes
+import threading
+import numpy as np
+from multiprocessing.pool import ThreadPool
+from netCDF4 import Dataset
+import WhfLog
+import Downscale_Engine as dse
+import Static_Fields as sf
+from Regrid_Engine import FILL_VALUE
+from ForcingEngineError import MissingFileError
+
+# Stack size of the threads running the tiles, MB
+TILE_STACK_MB = 256
+
+# Arrays of the tile size topo_adj and cal_slope keep on the stack, with
+# a margin for the compiler's temporaries
+_STACK_ARRAYS = 20
+
+# Float arrays, in the memory order Fortran expects for (nx,ny)
+_ARRAY = np.ctypeslib.ndpointer(dtype=np.float32, ndim=2, flags='C_CONTIGUOUS')
+
+# Loaded libraries, keyed by file, thread pools, keyed by size, and
+# TopoAdj made by get_topo_adj, keyed by its arguments
+_libraries = {}
+_threadPools = {}
+_topoAdj = {}
+
+#----------------------------------------------------------------------------
+def load_library(libFile):
+   """topo_adj of a shared library, loaded once per process
+
+   Parameters
+   ----------
+   libFile: str
+      Shared library built from topo_adj.f90
+
+   Returns
+   -------
+   ctypes function
+      topo_adj(hgt, xlat, xlong, dx, dy, nx, ny, cosa, sina, xtime,
+      julian, swdown_in, swdown_out), scalars by reference
+   """
+   if libFile not in _libraries:
+      if not os.path.exists(libFile):
+         WhfLog.error('File: ' + libFile + ' not found.')
+         raise MissingFileError('File %s not found'%libFile)
+      function = ctypes.CDLL(libFile).topo_adj_
+      real = ctypes.POINTER(ctypes.c_float)
+      integer = ctypes.POINTER(ctypes.c_int)
+      function.argtypes = [_ARRAY, _ARRAY, _ARRAY, real, real, integer,
+                           integer, _ARRAY, _ARRAY, real, real, _ARRAY,
+                           _ARRAY]
+      function.restype = None
+      _libraries[libFile] = function
+   return _libraries[libFile]
+
+#----------------------------------------------------------------------------
+def _get_thread_pool(numThreads):
+   """Thread pool with numThreads threads of TILE_STACK_MB stack, created
+   once per process"""
+   if numThreads not in _threadPools:
+      previous = threading.stack_size(TILE_STACK_MB*1024*1024)
+      try:
+         _threadPools[numThreads] = ThreadPool(numThreads)
+      finally:
+         threading.stack_size(previous)
+   return _threadPools[numThreads]
+
+#----------------------------------------------------------------------------
+def tiles(ny, nx, numThreads, tileRows=0):
+   """Row tiles of a domain
+
+   Parameters
+   ----------
+   ny, nx: int
+      Domain shape
+   numThreads: int
+      Number of threads, at least as many tiles are made
+   tileRows: int
+      Rows per tile, 0 for the most that fit TILE_STACK_MB
+
+   Returns
+   -------
+   list
+      (first, last + 1) row of each tile
+   """
+   if tileRows <= 0:
+      tileRows = TILE_STACK_MB*1024*1024/(_STACK_ARRAYS*4*nx) - 2
+   tileRows = max(1, min(tileRows, int(math.ceil(float(ny)/numThreads))))
+   return [(j, min(j + tileRows, ny)) for j in range(0, ny, tileRows)]
+
+#----------------------------------------------------------------------------
+class TopoAdj:
+   """Shortwave terrain adjustment of a domain by the Fortran topo_adj
+
+   Has the adjust method of Downscale_Engine.TerrainGeometry, so it can
+   replace it in the in-process downscaling.
+
+   Attributes
+   ----------
+   _libFile: str
+      Shared library built from topo_adj.f90
+   _geoFile: str
+      Geo file of the domain
+   _geo: dict
+      HGT_M, XLAT_M, XLONG_M, COSALPHA, SINALPHA float32 arrays (memory
+      mapped from the static fields directory if there is one), and DX
+      and DY float32 values, as topo_adj.ncl reads them
+   _numThreads: int
+      Number of threads running the tiles
+   _tileRows: int
+      Rows per tile, 0 for the most that fit the thread stack
+   """
+
+   #--------------------------------------------------------------------------
+   def __init__(self, libFile, geoFile, numThreads=1, tileRows=0,
+                staticDir=None):
+      """Initialization, reading the geo file
+
+      Parameters
+      ----------
+      libFile: str
+         Shared library built from topo_adj.f90
+      geoFile: str
+         Geo file of the domain
+      numThreads: int
+         Number of threads running the tiles
+      tileRows: int
+         Rows per tile, 0 for the most that fit the thread stack
+      staticDir: str
+         Static fields directory (Static_Fields), None to read the geo
+         file into memory
+      """
+      self._libFile = libFile
+      self._geoFile = geoFile
+      self._numThreads = max(1, numThreads)
+      self._tileRows = tileRows
+      load_library(libFile)
+      if not os.path.exists(geoFile):
+         WhfLog.error('File: ' + geoFile + ' not found.')
+         raise MissingFileError('File %s not found'%geoFile)
+      self._geo = sf.read_fields(geoFile, sf.GEO_FIELDS, staticDir)
+      nc = Dataset(geoFile, 'r')
+      try:
+         self._geo['DX'] = np.float32(nc.DX)
+         self._geo['DY'] = np.float32(nc.DY)
+      finally:
+         nc.close()
+
+   #--------------------------------------------------------------------------
+   def debugPrint(self):
+      """ Debug logging of content
+      """
+      WhfLog.debug("topo_adj %s of %s %s, %d threads, tiles of %d rows",
+                   self._libFile, self._geoFile,
+                   str(self._geo['HGT_M'].shape), self._numThreads,
+                   self._tileRows)
+
+   #--------------------------------------------------------------------------
+   def adjust(self, swdown, validTime):
+      """Terrain adjusted shortwave radiation
+
+      Parameters
+      ----------
+      swdown: numpy.ndarray
+         SWDOWN (W/m2), FILL_VALUE where missing
+      validTime: datetime.datetime
+         Valid time (UTC); as in topo_adj.ncl, the day of year and the
+         hour are passed
+
+      Returns
+      -------
+      numpy.ndarray
+         Adjusted float32 SWDOWN, FILL_VALUE where missing
+      """
+      function = load_library(self._libFile)
+      geo = self._geo
+      swIn = np.ascontiguousarray(swdown, dtype=np.float32)
+      out = np.empty_like(swIn)
+      (ny, nx) = swIn.shape
+      dx = ctypes.c_float(geo['DX'])
+      dy = ctypes.c_float(geo['DY'])
+      xtime = ctypes.c_float(validTime.hour*60.0)
+      julian = ctypes.c_float(validTime.timetuple().tm_yday)
+
+      def run(tile):
+         (first, last) = tile
+         # halo row on each side inside the domain
+         (lo, hi) = (max(0, first - 1), min(ny, last + 1))
+         tileOut = np.empty((hi - lo, nx), dtype=np.float32)
+         function(geo['HGT_M'][lo:hi], geo['XLAT_M'][lo:hi],
+                  geo['XLONG_M'][lo:hi], ctypes.byref(dx), ctypes.byref(dy),
+                  ctypes.byref(ctypes.c_int(nx)),
+                  ctypes.byref(ctypes.c_int(hi - lo)),
+                  geo['COSALPHA'][lo:hi], geo['SINALPHA'][lo:hi],
+                  ctypes.byref(xtime), ctypes.byref(julian), swIn[lo:hi],
+                  tileOut)
+         out[first:last] = tileOut[first - lo:last - lo]
+
+      _get_thread_pool(self._numThreads).map(run, tiles(ny, nx,
+                                                        self._numThreads,
+                                                        self._tileRows))
+      # topo_adj does not know the fill value, keep it missing
+      missing = swIn == FILL_VALUE
+      out[missing] = FILL_VALUE
+      return out
+
+   #--------------------------------------------------------------------------
+   def adjustFile(self, ldasinFile, validTime=None):
+      """Adjust SWDOWN of a downscaled file in place, as topo_adj.ncl
+
+      Parameters
+      ----------
+      ldasinFile: str
+         Downscaled file, YYYYMMDDhh00.LDASIN_DOMAIN1
+      validTime: datetime.datetime
+         Valid time, None for the time in the file name
+      """
+      if validTime is None:
+         validTime = dse.valid_time(ldasinFile)
+      if not os.path.exists(ldasinFile):
+         WhfLog.error('File: ' + ldasinFile + ' not found.')
+         raise MissingFileError('File %s not found'%ldasinFile)
+      nc = Dataset(ldasinFile, 'a')
+      try:
+         var = nc.variables['SWDOWN']
+         var.set_auto_maskandscale(False)
+         values = var[:]
+         adjusted = self.adjust(values.reshape(values.shape[-2:]), validTime)
+         var[:] = adjusted.reshape(values.shape)
+      finally:
+         nc.close()
+
+#----------------------------------------------------------------------------
+def get_topo_adj(parser, geoFile):
+   """TopoAdj of a geo file configured in a config file: [exe]
+   topo_adj_library, [downscaling] shortwave_threads and
+   shortwave_tile_rows (1 thread and tiles fitting the thread stack if
+   not set) and [data_dir] static_fields_dir"""
+   libFile = parser.get('exe', 'topo_adj_library')
+   numThreads = 1
+   if parser.has_option('downscaling', 'shortwave_threads'):
+      numThreads = parser.getint('downscaling', 'shortwave_threads')
+   tileRows = 0
+   if parser.has_option('downscaling', 'shortwave_tile_rows'):
+      tileRows = parser.getint('downscaling', 'shortwave_tile_rows')
+   staticDir = sf.get_static_dir(parser)
+   key = (libFile, geoFile, numThreads, tileRows, staticDir)
+   if key not in _topoAdj:
+      _topoAdj[key] = TopoAdj(libFile, geoFile, numThreads, tileRows,
+                              staticDir)
+      _topoAdj[key].debugPrint()
+   return _topoAdj[key]
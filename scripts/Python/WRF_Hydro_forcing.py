@@ -10,12 +10,17 @@ import sys
 from ConfigParser import SafeConfigParser
 import DataFiles as df
 import NCL_script_run as ncl
+import Staging_Cache as sc
 from ForcingEngineError import NCLError
 from ForcingEngineError import FilenameMatchError
 from ForcingEngineError import MissingDirectoryError
 from ForcingEngineError import MissingFileError
 from ForcingEngineError import ZeroHourReplacementError
 from ForcingEngineError import UnrecognizedCommandError
+from ForcingEngineError import RegridError
+from ForcingEngineError import GribError
+from ForcingEngineError import SystemCommandError
+from ForcingEngineError import InvalidArgumentError
 
 
 # -----------------------------------------------------
@@ -34,6 +39,22 @@ from ForcingEngineError import UnrecognizedCommandError
 #  etc. which are not always conducive in an operational setting.
 
 
+# Files already regridded by regrid_data_batch() or regrid_data_domains(),
+# so that the following regrid_data() call for each file does not
+# regrid it again: (full path of input data file, regridded file)
+_batch_regridded = set()
+
+# Fields regridded in memory for the fused pipeline, picked up by the
+# following downscale_data() call instead of a regridded file:
+# regridded file (never written) -> regridded fields
+_fused_regridded = {}
+
+# Regridded files (never written) already downscaled in memory by
+# regrid_data_pipeline() for the fused pipeline, so that the following
+# downscale_data() call does nothing: regridded file -> downscale_shortwave
+_pipeline_downscaled = {}
+
+
 
 def regrid_data( product_name, file_to_regrid, parser, substitute_fcst = False, \
                  zero_process = False):
@@ -188,7 +209,21 @@ def regrid_data( product_name, file_to_regrid, parser, substitute_fcst = False,
         else:
        	    (date,model,fcsthr) = extract_file_info(file_to_regrid)  
             data_file_to_regrid= data_dir + "/" + date + "/" + file_to_regrid 
-            srcfilename_param =  "'srcfilename=" + '"' + data_file_to_regrid +  \
+            import Grib2_Stream as gs
+            stream_timeout = gs.get_stream_timeout(parser, product)
+            if stream_timeout > 0 and \
+               get_regrid_engine(parser, product) == 'python':
+                # Decoded in place as its messages land
+                src_file = data_file_to_regrid
+            else:
+                if stream_timeout > 0:
+                    # The file may still be being written, wait until
+                    # it holds all the messages the NCL script reads
+                    gs.wait_complete(product, data_file_to_regrid,
+                                     zero_process, stream_timeout)
+                # Read the local copy if input staging is configured
+                src_file = sc.stage_file(parser, data_file_to_regrid)
+            srcfilename_param =  "'srcfilename=" + '"' + src_file +  \
                                      '"' + "' "
             wgtFileName_in_param =  "'wgtFileName_in=" + '"' + wgt_file + \
                                         '"' + "' "
@@ -230,7 +265,35 @@ def regrid_data( product_name, file_to_regrid, parser, substitute_fcst = False,
             regrid_params = srcfilename_param + wgtFileName_in_param + \
                         dstGridName_param + outdir_param + \
                         outFile_param
+
+            if (data_file_to_regrid, regridded_file) in _batch_regridded:
+                _batch_regridded.discard((data_file_to_regrid, regridded_file))
+                if regridded_file in _fused_regridded or \
+                   regridded_file in _pipeline_downscaled or \
+                   os.path.exists(regridded_file):
+                    WhfLog.info("Already regridded in batch: %s", regridded_file)
+                    return regridded_file
       
+        if product != "CFSV2" and \
+           get_regrid_engine(parser, product) == 'python':
+            # Regrid in-process with the sparse weight matrix
+            # instead of launching the NCL script.
+            fused = get_fused_pipeline(parser, product)
+            try:
+                regridded = regrid_in_process(product, src_file, wgt_file,
+                                              dst_grid_name,
+                                              None if fused else regridded_file,
+                                              zero_process, parser,
+                                              stream_timeout)
+            except (RegridError, GribError, MissingFileError) as e:
+                WhfLog.error('The in-process regridding of %s was unsuccessful', \
+                             product)
+                raise
+            if fused:
+                # Nothing written, downscale_data() takes the fields
+                _fused_regridded[regridded_file] = regridded
+            return regridded_file
+
         if zero_process == True:
             regrid_prod_cmd = ncl_exec + " -Q "  + regrid_params + " " + \
                               regridding_exec_0hr
@@ -254,6 +317,618 @@ def regrid_data( product_name, file_to_regrid, parser, substitute_fcst = False,
             raise NCLError('NCL regridding of %s unsuccessful with return value %s'%(product,return_value))
     return regridded_file
 
+def regrid_data_batch(product_name, files_to_regrid, parser,
+                      downscale_shortwave=True):
+    """Regrids several files of one product (typically all the
+       newly arrived forecast hours of one issue time) with a
+       single invocation of the NCL regridding script, instead
+       of one invocation per file, so NCL start-up, library loading
+       and the destination grid read happen once.  Each input file
+       still gets its own regridded output file.  With the python
+       regrid engine the files go through regrid_data_pipeline()
+       instead.  A following
+       regrid_data() call for a file regridded here returns the
+       regridded file without regridding it again.
+
+    Args:
+        product_name (string):  The name of the product:
+                                HRRR, RAP, GFS or MRMS
+        files_to_regrid (list): The filenames of the input data
+                                (YYYYMMDD_ihh_fnnn_product.grb2 etc.,
+                                without the data directory), as
+                                for regrid_data().
+        parser (ConfigParser):  The parser to the config/parm file.
+        downscale_shortwave (boolean):  For the fused pipeline, as
+                                for the downscale_data() that follows.
+
+    Returns:
+        regridded (list): (input filename, regridded file) for each
+                          input file, the regridded file is None if
+                          that file could not be regridded (or, when
+                          streaming, is still being written).
+
+    """
+    product = product_name.upper()
+    if product not in ['HRRR', 'RAP', 'GFS', 'MRMS']:
+        WhfLog.error("Batch regridding not supported for %s", product)
+        raise UnrecognizedCommandError('Batch regridding not supported for %s'%product)
+    ncl_exec = parser.get('exe', 'ncl_exe')
+    wgt_file = parser.get('regridding', product + '_wgt_bilinear')
+    data_dir = parser.get('data_dir', product + '_data')
+    regridding_exec = parser.get('exe', product + '_regridding_exe')
+    output_dir_root = parser.get('regridding', product + '_output_dir')
+    dst_grid_name = parser.get('regridding', product + '_dst_grid_name')
+
+    # Input file, output directory and output file of each file
+    batch = []
+    skipped = []
+    import Grib2_Stream as gs
+    stream_timeout = gs.get_stream_timeout(parser, product)
+    for file_to_regrid in files_to_regrid:
+        (date,model,fcsthr) = extract_file_info(file_to_regrid)
+        data_file_to_regrid = data_dir + "/" + date + "/" + file_to_regrid
+        if stream_timeout > 0 and \
+           not gs.is_complete(product, data_file_to_regrid):
+            # Still being written, left to regrid_data() which waits
+            WhfLog.info("%s is not complete yet, not batched", file_to_regrid)
+            skipped.append((file_to_regrid, None))
+            continue
+        (subdir_file_path,hydro_filename) = \
+            create_output_name_and_subdir(product,data_file_to_regrid,data_dir)
+        output_file_dir = output_dir_root + "/" + subdir_file_path
+        mkdir_p(output_file_dir)
+        regridded_file = output_file_dir + "/" + hydro_filename
+        # Remove any earlier output so only this run's files count as done
+        if os.path.exists(regridded_file):
+            os.remove(regridded_file)
+        batch.append((file_to_regrid, data_file_to_regrid, output_file_dir,
+                      hydro_filename, regridded_file))
+    if not batch:
+        return skipped
+    if get_regrid_engine(parser, product) == 'python':
+        # No start-up cost to save, but decoding, regridding and
+        # writing of successive files overlap in a pipeline
+        return skipped + regrid_data_pipeline(product, [b[0] for b in batch],
+                                              parser, downscale_shortwave)
+    # Read the local copies if input staging is configured
+    src_files = [sc.stage_file(parser, b[1]) for b in batch]
+
+    start_regridding = time.time()
+    # The NCL regridding scripts take the input and output files
+    # as arrays in batch mode: 'srcfiles=(/"a","b"/)' etc.  The
+    # single file parameters are also set, to the first file.
+    def ncl_array(name, values):
+        return "'" + name + "=(/" + \
+               ",".join(['"' + v + '"' for v in values]) + "/)' "
+    (file_to_regrid,data_file,output_dir,hydro_filename,regridded_file) = batch[0]
+    regrid_params = "'srcfilename=" + '"' + src_files[0] + '"' + "' " + \
+                    "'wgtFileName_in=" + '"' + wgt_file + '"' + "' " + \
+                    "'dstGridName=" + '"' + dst_grid_name + '"' + "' " + \
+                    ncl_array('srcfiles', src_files)
+    if product == "MRMS":
+        # The MRMS script has no outdir, outFile is the full path
+        regrid_params += "'outFile=" + '"' + regridded_file + '"' + "' " + \
+                         ncl_array('outFiles', [b[4] for b in batch])
+    else:
+        regrid_params += "'outdir=" + '"' + output_dir + '"' + "' " + \
+                         "'outFile=" + '"' + hydro_filename + '"' + "' " + \
+                         ncl_array('outdirs', [b[2] for b in batch]) + \
+                         ncl_array('outFiles', [b[3] for b in batch])
+    regrid_prod_cmd = ncl_exec + " -Q " + regrid_params + " " + \
+                      regridding_exec
+    WhfLog.debug("batch regridding command: %s",regrid_prod_cmd)
+    return_value = ncl.run(regrid_prod_cmd)
+    if return_value != 0:
+        # Some files may still have been regridded, checked below
+        WhfLog.error('The batch regridding of %s returned %d', product,
+                     return_value)
+    WhfLog.info("Time(sec) to regrid %d %s files in one batch %s", len(batch),
+                product, time.time() - start_regridding)
+
+    # Per file success
+    regridded = skipped
+    for (file_to_regrid,data_file,output_dir,hydro_filename,regridded_file) in batch:
+        if os.path.exists(regridded_file):
+            WhfLog.info("Batch regridded %s into %s", file_to_regrid,
+                        regridded_file)
+            _batch_regridded.add((data_file, regridded_file))
+            regridded.append((file_to_regrid, regridded_file))
+        else:
+            WhfLog.error("Batch regridding of %s failed", file_to_regrid)
+            regridded.append((file_to_regrid, None))
+    return regridded
+
+def regrid_data_domains(product_name, file_to_regrid, parsers,
+                        zero_process=False):
+    """Regrids one input file to several WRF-Hydro domains (see
+       Domain_Config) with the python regrid engine, decoding the
+       input once: each domain's weights are applied to the same
+       decoded fields, the domains in parallel.  A following
+       regrid_data() call for the file with a domain's parser
+       returns the regridded file without regridding it again.
+       Domains using the NCL regrid engine are left to
+       regrid_data().
+
+    Args:
+        product_name (string):  The name of the product:
+                                HRRR, RAP, GFS or MRMS
+        file_to_regrid (string): The filename of the input data,
+                                 as for regrid_data().
+        parsers (list):  The parser of each domain.
+        zero_process (boolean):  True to regrid only the 0hr fields.
+
+    Returns:
+        regridded (list): The regridded file of each domain, None
+                          for the domains not regridded here.
+
+    """
+    import Regrid_Engine as rge
+    import Weight_Cache as wc
+    import Grib2_Index as gi
+    import Grib2_Reader as gr
+    import Grib2_Stream as gs
+    import Field_Cache as fc
+    from multiprocessing.pool import ThreadPool
+
+    product = product_name.upper()
+    if product not in ['HRRR', 'RAP', 'GFS', 'MRMS']:
+        WhfLog.error("Multi-domain regridding not supported for %s", product)
+        raise UnrecognizedCommandError('Multi-domain regridding not supported for %s'%product)
+
+    # Weights and output file of each domain regridded in-process
+    targets = []
+    (date,model,fcsthr) = extract_file_info(file_to_regrid)
+    for (index, parser) in enumerate(parsers):
+        if get_regrid_engine(parser, product) != 'python':
+            continue
+        data_dir = parser.get('data_dir', product + '_data')
+        data_file = data_dir + "/" + date + "/" + file_to_regrid
+        (subdir_file_path,hydro_filename) = \
+            create_output_name_and_subdir(product,data_file,data_dir)
+        if zero_process:
+            output_dir_root = parser.get('regridding', product + '_output_dir_0hr')
+        else:
+            output_dir_root = parser.get('regridding', product + '_output_dir')
+        output_file_dir = output_dir_root + "/" + subdir_file_path
+        mkdir_p(output_file_dir)
+        wgt_file = parser.get('regridding', product + '_wgt_bilinear')
+        dst_grid_name = parser.get('regridding', product + '_dst_grid_name')
+        # Load the weights now, not concurrently in the domain threads
+        rge.get_weights(wgt_file, dst_grid_name, wc.get_cache_dir(parser),
+                        get_regrid_kernel(parser, product),
+                        wc.get_weight_order(parser), rge.get_precision(parser))
+        targets.append((index, parser, data_file, wgt_file, dst_grid_name,
+                        output_file_dir + "/" + hydro_filename))
+    regridded = [None]*len(parsers)
+    if not targets:
+        return regridded
+
+    # Decode the whole fields once, as configured for the first domain
+    start_regridding = time.time()
+    (index, parser, data_file, wgt_file, dst_grid_name, regridded_file) = targets[0]
+    stream_timeout = gs.get_stream_timeout(parser, product)
+    if stream_timeout > 0:
+        fields = gs.stream_fields(product, data_file, zero_process, None,
+                                  stream_timeout)
+    else:
+        fields = gr.read_fields(product, sc.stage_file(parser, data_file),
+                                zero_process, None, None,
+                                gi.get_index_dir(parser),
+                                fc.get_field_cache(parser))
+
+    def regrid_domain(target):
+        (index, parser, data_file, wgt_file, dst_grid_name, regridded_file) = target
+        fused = get_fused_pipeline(parser, product)
+        try:
+            regridded = rge.regrid_fields(product, fields, wgt_file,
+                                          dst_grid_name,
+                                          None if fused else regridded_file,
+                                          wc.get_cache_dir(parser),
+                                          get_regrid_threads(parser),
+                                          get_regrid_kernel(parser, product),
+                                          wc.get_weight_order(parser),
+                                          rge.get_precision(parser))
+        except (RegridError, MissingFileError) as e:
+            WhfLog.error("In-process regridding of %s to %s failed: %s",
+                         data_file, dst_grid_name, e)
+            return None
+        if fused:
+            _fused_regridded[regridded_file] = regridded
+        return regridded_file
+
+    pool = ThreadPool(len(targets))
+    try:
+        done = pool.map(regrid_domain, targets)
+    finally:
+        pool.close()
+    for (target, regridded_file) in zip(targets, done):
+        if regridded_file is not None:
+            _batch_regridded.add((target[2], regridded_file))
+            regridded[target[0]] = regridded_file
+    WhfLog.info("Time(sec) to regrid %s to %d domains %s", file_to_regrid,
+                len(targets), time.time() - start_regridding)
+    return regridded
+
+def regrid_data_pipeline(product_name, files_to_regrid, parser,
+                         downscale_shortwave=True):
+    """Regrids several files of one product with the python regrid
+       engine as a pipeline of stages, each in its own thread with
+       bounded queues between them (see Stage_Pipeline): while one
+       file is regridded the next one is decoded and the previous one
+       written.  For a product in the fused pipeline (see
+       get_fused_pipeline) the regrid stage downscales as well and the
+       downscaled file is written instead of the regridded one.  A
+       following regrid_data() and downscale_data() for a file done
+       here return without doing it again.
+
+    Args:
+        product_name (string):  The name of the product:
+                                HRRR, RAP, GFS or MRMS
+        files_to_regrid (list): The filenames of the input data,
+                                as for regrid_data_batch().
+        parser (ConfigParser):  The parser to the config/parm file.
+        downscale_shortwave (boolean):  For the fused pipeline, as
+                                for the downscale_data() that follows;
+                                a downscale_data() asking otherwise
+                                fails, the regridded file was never
+                                written.
+
+    Returns:
+        regridded (list): (input filename, regridded file) for each
+                          input file, as for regrid_data_batch().
+
+    """
+    import Regrid_Engine as rge
+    import Weight_Cache as wc
+    import Grib2_Index as gi
+    import Grib2_Reader as gr
+    import Grib2_Stream as gs
+    import Field_Cache as fc
+    import Stage_Pipeline as sp
+
+    product = product_name.upper()
+    if product not in ['HRRR', 'RAP', 'GFS', 'MRMS']:
+        WhfLog.error("Pipeline regridding not supported for %s", product)
+        raise UnrecognizedCommandError('Pipeline regridding not supported for %s'%product)
+    wgt_file = parser.get('regridding', product + '_wgt_bilinear')
+    data_dir = parser.get('data_dir', product + '_data')
+    output_dir_root = parser.get('regridding', product + '_output_dir')
+    dst_grid_name = parser.get('regridding', product + '_dst_grid_name')
+    cache_dir = wc.get_cache_dir(parser)
+    kernel = get_regrid_kernel(parser, product)
+    order = wc.get_weight_order(parser)
+    stream_timeout = gs.get_stream_timeout(parser, product)
+    fused = get_fused_pipeline(parser, product)
+    if fused:
+        import Downscale_Engine as dse
+        import Terrain_Cache as tc
+        hgt_data_file = parser.get('downscaling', product + '_hgt_data')
+        geo_data_file = parser.get('downscaling', product + '_geo_data')
+        lapse_rate_file = parser.get('downscaling', 'lapse_rate_file')
+        sw_adjust = None
+        if downscale_shortwave:
+            sw_adjust = get_shortwave_adjust(parser, geo_data_file)
+        downscale_output_dir = parser.get('downscaling',
+                                          product + '_downscale_output_dir')
+    # Loaded once here, not by the first file in the regrid stage
+    precision = rge.get_precision(parser)
+    weights = rge.get_weights(wgt_file, dst_grid_name, cache_dir, kernel, order,
+                              precision)
+
+    # (input filename, input data file, regridded file, file written)
+    items = []
+    for file_to_regrid in files_to_regrid:
+        (date,model,fcsthr) = extract_file_info(file_to_regrid)
+        data_file = data_dir + "/" + date + "/" + file_to_regrid
+        (subdir_file_path,hydro_filename) = \
+            create_output_name_and_subdir(product,data_file,data_dir)
+        output_file_dir = output_dir_root + "/" + subdir_file_path
+        if fused:
+            out_dir = downscale_output_dir + "/" + subdir_file_path
+        else:
+            out_dir = output_file_dir
+        mkdir_p(out_dir)
+        items.append((file_to_regrid, data_file,
+                      output_file_dir + "/" + hydro_filename,
+                      out_dir + "/" + hydro_filename))
+
+    def decode(item, value):
+        (file_to_regrid, data_file, regridded_file, out_file) = item
+        if stream_timeout > 0:
+            return gs.stream_fields(product, data_file, False,
+                                    weights.footprint(), stream_timeout)
+        return gr.read_fields(product, sc.stage_file(parser, data_file),
+                              False, weights.footprint(), None,
+                              gi.get_index_dir(parser),
+                              fc.get_field_cache(parser))
+
+    def regrid(item, fields):
+        (file_to_regrid, data_file, regridded_file, out_file) = item
+        regridded = rge.regrid_fields(product, fields, wgt_file,
+                                      dst_grid_name, None, cache_dir,
+                                      get_regrid_threads(parser), kernel,
+                                      order, precision)
+        if fused:
+            valid_time = None
+            if downscale_shortwave:
+                valid_time = dse.valid_time(out_file)
+            regridded = dse.downscale_regridded(regridded, hgt_data_file,
+                                                geo_data_file,
+                                                lapse_rate_file, valid_time,
+                                                tc.get_cache_dir(parser),
+                                                sw_adjust, precision)
+        return regridded
+
+    def write(item, regridded):
+        (file_to_regrid, data_file, regridded_file, out_file) = item
+        if fused:
+            rge.write_ldasin(out_file, regridded, weights.dstShape())
+        else:
+            rge.write_regridded(product, regridded, dst_grid_name, out_file,
+                                weights.dstShape())
+        return out_file
+
+    start_regridding = time.time()
+    pipeline = sp.StagePipeline([('decode', decode), ('regrid', regrid),
+                                 ('write', write)],
+                                sp.get_queue_depth(parser))
+    done = pipeline.run(items)
+    WhfLog.info("Time(sec) to regrid %d %s files in pipeline %s", len(items),
+                product, time.time() - start_regridding)
+
+    regridded = []
+    for ((file_to_regrid, data_file, regridded_file, out_file), written) in done:
+        if written is None:
+            WhfLog.error("Pipeline regridding of %s failed", file_to_regrid)
+            regridded.append((file_to_regrid, None))
+            continue
+        _batch_regridded.add((data_file, regridded_file))
+        if fused:
+            _pipeline_downscaled[regridded_file] = downscale_shortwave
+        regridded.append((file_to_regrid, regridded_file))
+    return regridded
+
+def regrid_in_process(product, data_file, wgt_file, dst_grid_name,
+                      regridded_file, zero_process, parser, stream_timeout=0):
+    """Regrid one file with Regrid_Engine (the 'python' regrid
+       engine), with the weight cache, kernel, GRIB2 index and
+       decoded field cache configured in the parm file.
+
+    Args:
+        product (string):  HRRR, RAP, GFS or MRMS
+        data_file (string):  Full path of the GRIB2 file to regrid.
+        wgt_file (string):  ESMF weight file.
+        dst_grid_name (string):  Destination grid (geo_dst.nc) file.
+        regridded_file (string):  Full path of the output file, None
+                                  to keep the regridded fields in
+                                  memory only.
+        zero_process (boolean):  True to regrid only the 0hr fields.
+        parser (ConfigParser):  The parser to the config/parm file.
+        stream_timeout (int):  If > 0, data_file may still be being
+                               written: its fields are decoded as they
+                               land, for up to this many seconds.
+
+    Returns:
+        regridded (list):  (name, regridded field, units, description)
+                           of each field.
+
+    """
+    import Regrid_Engine as rge
+    import Weight_Cache as wc
+    import Grib2_Index as gi
+    import Field_Cache as fc
+    return rge.regrid_file(product, data_file, wgt_file, dst_grid_name,
+                    regridded_file, zero_process,
+                    wc.get_cache_dir(parser),
+                    get_regrid_threads(parser),
+                    get_regrid_kernel(parser, product),
+                    wc.get_weight_order(parser),
+                    gi.get_index_dir(parser),
+                    fc.get_field_cache(parser),
+                    stream_timeout,
+                    rge.get_precision(parser))
+
+def get_regrid_engine(parser, product):
+    """Determine which regridding engine is configured for
+       a product: the NCL scripts ('ncl') or the in-process
+       sparse matrix regridding in Regrid_Engine ('python').
+
+    Args:
+        parser (ConfigParser):  The parser to the config/parm file.
+        product (string):  The product name, e.g. HRRR, RAP, GFS, MRMS
+
+    Returns:
+        engine (string):  'ncl' or 'python'.  Defaults to 'ncl' when
+                          <product>_regrid_engine is not set in the
+                          [regridding] section.
+
+    """
+    option = product.upper() + '_regrid_engine'
+    if not parser.has_option('regridding', option):
+        return 'ncl'
+    engine = parser.get('regridding', option).strip().lower()
+    if engine not in ['ncl', 'python']:
+        WhfLog.error("Unrecognized regrid engine %s for %s", engine, product)
+        raise UnrecognizedCommandError('Unrecognized regrid engine %s for %s'%(engine,product))
+    return engine
+
+def get_downscale_engine(parser, product):
+    """Determine which downscaling engine is configured for
+       a product: the NCL scripts ('ncl') or the in-process
+       downscaling in Downscale_Engine ('python').
+
+    Args:
+        parser (ConfigParser):  The parser to the config/parm file.
+        product (string):  The product name, e.g. HRRR, RAP, GFS, CFSV2
+
+    Returns:
+        engine (string):  'ncl' or 'python'.  Defaults to 'ncl' when
+                          <product>_downscale_engine (CFS_downscale_engine
+                          for CFSV2) is not set in the [downscaling]
+                          section.
+
+    """
+    name = product.upper()
+    if name == 'CFSV2':
+        name = 'CFS'
+    option = name + '_downscale_engine'
+    if not parser.has_option('downscaling', option):
+        return 'ncl'
+    engine = parser.get('downscaling', option).strip().lower()
+    if engine not in ['ncl', 'python']:
+        WhfLog.error("Unrecognized downscale engine %s for %s", engine, product)
+        raise UnrecognizedCommandError('Unrecognized downscale engine %s for %s'%(engine,product))
+    return engine
+
+def get_single_pass_shortwave(parser):
+    """Whether the NCL downscaling adjusts the shortwave radiation
+       itself (All_WRF_Hydro_downscale.ncl given the valid time),
+       so the downscaled file is written once, instead of being
+       rewritten by topo_adj.ncl.  The in-process downscaling always
+       adjusts SWDOWN before writing.
+
+    Args:
+        parser (ConfigParser):  The parser to the config/parm file.
+
+    Returns:
+        single_pass (boolean):  True if single_pass_shortwave is set
+                                (non zero) in the [downscaling]
+                                section.
+
+    """
+    if not parser.has_option('downscaling', 'single_pass_shortwave'):
+        return False
+    return parser.getint('downscaling', 'single_pass_shortwave') != 0
+
+def get_shortwave_adjust(parser, geo_data_file):
+    """The in-process call of the Fortran shortwave adjustment
+       (Topo_Adj), if it is configured in place of topo_adj.ncl
+       and of the in-process downscaling's own adjustment.
+
+    Args:
+        parser (ConfigParser):  The parser to the config/parm file.
+        geo_data_file (string):  The geo file of the domain.
+
+    Returns:
+        sw_adjust (Topo_Adj.TopoAdj):  The adjustment of the domain
+                  when shortwave_adjust_library is set (non zero)
+                  in the [downscaling] section, None otherwise.
+
+    """
+    if not parser.has_option('downscaling', 'shortwave_adjust_library') or \
+       parser.getint('downscaling', 'shortwave_adjust_library') == 0:
+        return None
+    import Topo_Adj
+    return Topo_Adj.get_topo_adj(parser, geo_data_file)
+
+def downscale_in_process(product, downscale, file_to_downscale,
+                         downscaled_file):
+    """Run an in-process downscaling (Downscale_Engine) of a
+       regridded file, then remove the regridded file as the NCL
+       downscaling does.  If the downscaling fails, its incomplete
+       output is removed and the regridded file kept.
+
+    Args:
+        product (string):  The product name, for the log.
+        downscale (function):  Downscales file_to_downscale into
+                               downscaled_file, no arguments.
+        file_to_downscale (string):  The regridded file.
+        downscaled_file (string):  The downscaled file.
+
+    Returns:
+        None
+
+    """
+    import Stage_Pipeline as sp
+    start = time.time()
+    try:
+        downscale()
+    except:
+        WhfLog.error('The in-process downscaling of %s was unsuccessful',
+                     product)
+        if os.path.exists(downscaled_file):
+            os.remove(downscaled_file)
+        raise
+    sp.log_stage('downscale ' + product, start)
+    try:
+        os.remove(file_to_downscale)
+    except OSError:
+        WhfLog.error('Failed to remove ' + file_to_downscale)
+        raise SystemCommandError('Finished with regridded files, failed to remove %s'%file_to_downscale)
+
+def get_fused_pipeline(parser, product):
+    """Whether a product goes through the fused in-process pipeline:
+       decoded, regridded, downscaled and shortwave adjusted in
+       memory, with only the downscaled file written (no regridded
+       file written, read back and removed).
+
+    Args:
+        parser (ConfigParser):  The parser to the config/parm file.
+        product (string):  The product name, e.g. HRRR, RAP, GFS
+
+    Returns:
+        fused (boolean):  True if <product>_fused_pipeline is set
+                          (non zero) in the [downscaling] section,
+                          for a downscaled product regridded by the
+                          python regrid engine.
+
+    """
+    option = product.upper() + '_fused_pipeline'
+    if not parser.has_option('downscaling', option) or \
+       parser.getint('downscaling', option) == 0:
+        return False
+    if product.upper() not in ['HRRR', 'RAP', 'GFS']:
+        return False
+    if get_regrid_engine(parser, product) != 'python':
+        WhfLog.warning("%s needs the python regrid engine, not fused", option)
+        return False
+    return True
+
+def get_regrid_threads(parser):
+    """Number of threads used by the in-process regridding
+       of the fields of one file.
+
+    Args:
+        parser (ConfigParser):  The parser to the config/parm file.
+
+    Returns:
+        num_threads (int):  regrid_threads from the [regridding]
+                            section, 1 if it is not set.
+
+    """
+    if not parser.has_option('regridding', 'regrid_threads'):
+        return 1
+    return max(1, int(parser.get('regridding', 'regrid_threads')))
+
+def get_regrid_kernel(parser, product=None):
+    """The kernel used by the in-process regridding.
+
+    Args:
+        parser (ConfigParser):  The parser to the config/parm file.
+        product (string):  The product name, e.g. HRRR, MRMS; its
+                           <product>_regrid_kernel in the [regridding]
+                           section overrides regrid_kernel.
+
+    Returns:
+        kernel (string):  regrid_kernel from the [regridding] section:
+                          'csr' (sparse matrix, the default), 'gather'
+                          (4-point gather for structured source grids)
+                          or 'sparse' (nonzero source cells only, for
+                          mostly zero fields such as MRMS).
+
+    """
+    option = 'regrid_kernel'
+    if product is not None and \
+       parser.has_option('regridding', product.upper() + '_regrid_kernel'):
+        option = product.upper() + '_regrid_kernel'
+    if not parser.has_option('regridding', option):
+        return 'csr'
+    kernel = parser.get('regridding', option).strip().lower()
+    if kernel not in ['csr', 'gather', 'sparse']:
+        WhfLog.error("Unrecognized regrid kernel %s", kernel)
+        raise UnrecognizedCommandError('Unrecognized regrid kernel %s'%kernel)
+    return kernel
+
 def get_filepaths(dir):
     """Generates the file names in a directory tree
        by walking the tree either top-down or bottom-up.
@@ -419,11 +1094,16 @@ def downscale_data(product_name, file_to_downscale, parser, downscale_shortwave=
     If downscaling SWDOWN (shortwave radiation) is requested  
     then a second NCL script is invoked (topo_adj.ncl).  This second 
     NCL script invokes a Fortran application (topo_adjf90.so, 
-    built from topo_adj.f90). 
+    built from topo_adj.f90).  With shortwave_adjust_library set
+    in the [downscaling] section, the Fortran routine is called
+    in-process instead (Topo_Adj).  With single_pass_shortwave
+    set, the downscaling script adjusts SWDOWN itself before
+    writing, and there is no second step. 
 
     NOTE:  If the additional downscaling
     (of shortwave radiation) is requested, the adj_topo.ncl script
-    will "clobber" the previously created downscaled files.
+    will "clobber" the previously created downscaled files, unless
+    single_pass_shortwave is set.
 
 
     Args:
@@ -524,6 +1204,7 @@ def downscale_data(product_name, file_to_downscale, parser, downscale_shortwave=
 
     else:
         # Downscale as usual
+        single_pass = False
         if product == "CFSV2":
             # Double check to make sure input file exists
             try:
@@ -531,6 +1212,23 @@ def downscale_data(product_name, file_to_downscale, parser, downscale_shortwave=
             except:
                 raise
 
+            if get_downscale_engine(parser, product) == 'python':
+                import Downscale_Engine as dse
+                import Terrain_Cache as tc
+                import Regrid_Engine as rge
+                downscale_in_process(product,
+                                     lambda: dse.downscale_cfs(file_to_downscale,
+                                                               hgt_data_file,
+                                                               geo_data_file,
+                                                               lapse_rate_file,
+                                                               out_path,
+                                                               verYYYYMMDDHH,
+                                                               tc.get_cache_dir(parser),
+                                                               get_shortwave_adjust(parser, geo_data_file),
+                                                               rge.get_precision(parser)),
+                                     file_to_downscale, out_path)
+                return
+
             # Create input NCL command components
             input_file1_param = "'hgtFileSrc=" + '"' + hgt_data_file + '"' + "' "
             input_file2_param = "'hgtFileDst=" + '"' + geo_data_file + '"' + "' "
@@ -541,6 +1239,10 @@ def downscale_data(product_name, file_to_downscale, parser, downscale_shortwave=
             downscale_params =  input_file1_param + input_file2_param + \
                       input_file3_param + input_file4_param + lapse_file_param + \
                       time_param 
+            import Regrid_Engine as rge
+            if rge.get_precision(parser) == 'single':
+                # float instead of double computations and output
+                downscale_params = downscale_params + "'precision=" + '"single"' + "' "
             downscale_cmd = ncl_exec + " -Q " + downscale_params + " " + downscale_exe 
         else:
 
@@ -569,6 +1271,60 @@ def downscale_data(product_name, file_to_downscale, parser, downscale_shortwave=
             # already exist. 
             if not os.path.exists(full_downscaled_dir):
                 mkdir_p(full_downscaled_dir) 
+
+            if file_to_downscale in _pipeline_downscaled:
+                # The fused pipeline wrote the downscaled file only,
+                # there is no regridded file to downscale again
+                shortwave = _pipeline_downscaled.pop(file_to_downscale)
+                if not os.path.exists(full_downscaled_file):
+                    WhfLog.error("%s downscaled in pipeline not found",
+                                 full_downscaled_file)
+                    raise MissingFileError('File %s not found'%full_downscaled_file)
+                if shortwave != downscale_shortwave:
+                    WhfLog.error("%s was downscaled in pipeline with shortwave "
+                                 "adjustment %s, not %s", full_downscaled_file,
+                                 shortwave, downscale_shortwave)
+                    os.remove(full_downscaled_file)
+                    raise InvalidArgumentError('%s was downscaled in pipeline with shortwave adjustment %s, not %s'%(full_downscaled_file, shortwave, downscale_shortwave))
+                WhfLog.info("Already downscaled in pipeline: %s",
+                            full_downscaled_file)
+                return
+
+            regridded = _fused_regridded.pop(file_to_downscale, None)
+            if regridded is not None:
+                # Fused pipeline: the regridded fields are in memory,
+                # downscale (and adjust SWDOWN) in-process and write
+                # the downscaled file only
+                import Downscale_Engine as dse
+                import Terrain_Cache as tc
+                import Regrid_Engine as rge
+                import Stage_Pipeline as sp
+                start = time.time()
+                dse.downscale_fields(regridded, hgt_data_file, geo_data_file,
+                                     lapse_rate_file, full_downscaled_file,
+                                     downscale_shortwave,
+                                     tc.get_cache_dir(parser),
+                                     get_shortwave_adjust(parser, geo_data_file),
+                                     rge.get_precision(parser))
+                sp.log_stage('downscale ' + product, start)
+                return
+
+            if get_downscale_engine(parser, product) == 'python':
+                import Downscale_Engine as dse
+                import Terrain_Cache as tc
+                import Regrid_Engine as rge
+                downscale_in_process(product,
+                                     lambda: dse.downscale_file(file_to_downscale,
+                                                                hgt_data_file,
+                                                                geo_data_file,
+                                                                lapse_rate_file,
+                                                                full_downscaled_file,
+                                                                downscale_shortwave,
+                                                                tc.get_cache_dir(parser),
+                                                                get_shortwave_adjust(parser, geo_data_file),
+                                                                rge.get_precision(parser)),
+                                     file_to_downscale, full_downscaled_file)
+                return
     
             # Create the key-value pairs that make up the
             # input for the NCL script responsible for
@@ -583,11 +1339,18 @@ def downscale_data(product_name, file_to_downscale, parser, downscale_shortwave=
             if zero_process == True:
                 downscale_cmd = ncl_exec + " -Q " + downscale_params + " " + downscale_exe_0hr
             else:  
+                if downscale_shortwave and get_single_pass_shortwave(parser):
+                    # The downscaling script adjusts SWDOWN before
+                    # writing its output, no topo_adj.ncl run after it
+                    WhfLog.info("Shortwave downscaling in the downscaling script...")
+                    time_param = "'verYYYYMMDDHH=" + '"' + regridded_file[0:10] + '"' + "' "
+                    downscale_params = downscale_params + time_param
+                    single_pass = True
                 downscale_cmd = ncl_exec + " -Q " + downscale_params + " " + downscale_exe
     
         # Downscale the shortwave radiation, if requested...
         # Key-value pairs for downscaling SWDOWN, shortwave radiation.
-        if downscale_shortwave:
+        if downscale_shortwave and not single_pass:
             WhfLog.info("Shortwave downscaling requested...")
             downscale_swdown_exe = parser.get('exe', 'shortwave_downscaling_exe') 
             swdown_output_file_param = "'outFile=" + '"' + \
@@ -606,7 +1369,21 @@ def downscale_data(product_name, file_to_downscale, parser, downscale_shortwave=
     
             #Invoke the NCL script for performing a single downscaling.
             return_value = ncl.run(downscale_cmd)
-            swdown_return_value = ncl.run(downscale_shortwave_cmd)
+            sw_adjust = get_shortwave_adjust(parser, geo_data_file)
+            if sw_adjust is None:
+                swdown_return_value = ncl.run(downscale_shortwave_cmd)
+            elif return_value == 0:
+                # Call topo_adj in-process on the downscaled file
+                # instead of through topo_adj.ncl
+                swdown_return_value = 0
+                try:
+                    sw_adjust.adjustFile(full_downscaled_file)
+                except Exception as e:
+                    WhfLog.error("In-process SWDOWN downscaling of %s failed: %s",
+                                 full_downscaled_file, e)
+                    swdown_return_value = 1
+            else:
+                swdown_return_value = 0
             end = time.time()
             elapsed = end - start
     
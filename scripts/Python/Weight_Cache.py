@@ -0,0 +1,403 @@
+"""Weight_Cache
+Compiled on-disk cache of the ESMF regridding weights.  Each
+[regridding] <product>_wgt_bilinear netCDF file is converted once into
+a compact binary CSR matrix (int32 column indices, float32 weights and
+precomputed row pointers) plus the source footprint the columns are
+numbered in, stored as .npy files that are memory mapped
+on load.  Parallel workers therefore share one copy of the weights
+through the page cache.  When the gather kernel is selected the
+4-point gather form (gather_*.npy) is added to the entry on first use,
+and likewise the transposed matrix (t_*.npy) for the sparse kernel.
+
+With the 'tile' weight order the matrix is also reordered when it is
+compiled: destination rows go tile by tile over the destination grid
+(TILE_SIZE x TILE_SIZE cells) and source columns are renumbered in
+order of first use, so each tile reads a compact range of the source
+whatever the orientation of the two grids.  The column permutation is
+stored with the entry; the regrid results are put back in grid order
+(a strided copy) before they are written.
+
+Entries are keyed by the weight file path, size and modification time
+and by the destination grid file, and are rebuilt automatically when
+any of these change.  The cache can be filled ahead of time with:
+
+   python Weight_Cache.py <config file>
+"""
+
+import os
+import sys
+import shutil
+import hashlib
+import tempfile
+import numpy as np
+import scipy.sparse as sp
+from ConfigParser import SafeConfigParser
+import WhfLog
+import Regrid_Engine as rge
+from ForcingEngineError import MissingFileError
+from ForcingEngineError import UnrecognizedCommandError
+
+# Bump when the on-disk layout changes so old entries are not reused
+CACHE_VERSION = 3
+
+# Files making up one cache entry
+_ARRAYS = ['indptr', 'indices', 'data', 'shape']
+
+# Supported [regridding] weight_order values
+WEIGHT_ORDERS = ['native', 'tile']
+
+# Destination tile size of the 'tile' order
+TILE_SIZE = 64
+
+#----------------------------------------------------------------------------
+def _file_signature(fname):
+   """Returns 'path:size:mtime' for a file, '' if fname is empty"""
+   if not fname:
+      return ''
+   if not os.path.exists(fname):
+      WhfLog.error('File: ' + fname + ' not found.')
+      raise MissingFileError('File %s not found'%fname)
+   st = os.stat(fname)
+   return '%s:%d:%d'%(os.path.abspath(fname), st.st_size, int(st.st_mtime))
+
+#----------------------------------------------------------------------------
+def cache_key(wgtFile, dstGridName, order='native'):
+   """Key identifying a compiled weight matrix
+
+   Parameters
+   ----------
+   wgtFile: str
+      ESMF weight file
+   dstGridName: str
+      Destination grid file (geo_dst.nc) the weights map onto
+   order: str
+      Matrix ordering, one of WEIGHT_ORDERS
+
+   Returns
+   -------
+   str
+      Hex digest of version, ordering, path/size/mtime of both files
+   """
+   h = hashlib.sha1()
+   h.update(('v%d|%s|%s|%s'%(CACHE_VERSION, order, _file_signature(wgtFile),
+                             _file_signature(dstGridName))).encode('utf-8'))
+   return h.hexdigest()
+
+#----------------------------------------------------------------------------
+def entry_dir(wgtFile, dstGridName, cacheDir, order='native'):
+   """Directory holding the cache entry for a weight file
+
+   Named <weight file basename>.<paths hash>.<order>.<key> so stale
+   entries for the same weight file, destination grid and ordering are
+   easy to find
+   """
+   return os.path.join(cacheDir, _entry_base(wgtFile, dstGridName, order) +
+                       cache_key(wgtFile, dstGridName, order))
+
+#----------------------------------------------------------------------------
+def _entry_base(wgtFile, dstGridName, order):
+   """Start of the entry directory names of a weight file, destination
+   grid and ordering; the hash of the absolute paths keeps apart weight
+   files of the same name in different directories and the domains of
+   one weight file"""
+   h = hashlib.sha1()
+   h.update(os.path.abspath(wgtFile) + '|' +
+            (os.path.abspath(dstGridName) if dstGridName else ''))
+   return os.path.splitext(os.path.basename(wgtFile))[0] + '.' + \
+          h.hexdigest()[:12] + '.' + order + '.'
+
+#----------------------------------------------------------------------------
+def _purge_stale(wgtFile, dstGridName, cacheDir, keep, order):
+   """Remove entries for wgtFile and dstGridName with this ordering other
+   than keep"""
+   base = _entry_base(wgtFile, dstGridName, order)
+   for name in os.listdir(cacheDir):
+      path = os.path.join(cacheDir, name)
+      if name.startswith(base) and path != keep and os.path.isdir(path):
+         WhfLog.info("Removing stale weight cache entry %s", path)
+         shutil.rmtree(path, ignore_errors=True)
+
+#----------------------------------------------------------------------------
+def reorder(weights, tile=TILE_SIZE):
+   """Reorder sparse matrix weights for locality
+
+   Destination rows are put in tile order (Regrid_Engine.tile_rows),
+   then source columns are numbered in order of first use by the rows,
+   so neighbouring rows read neighbouring entries of the (permuted)
+   source vector.
+
+   Parameters
+   ----------
+   weights: Regrid_Engine.RegridWeights
+      Weights in grid order
+   tile: int
+      Destination tile size
+
+   Returns
+   -------
+   Regrid_Engine.RegridWeights
+      The same weights with a reordered matrix
+   """
+   (ny, nx) = weights.dstShape()
+   if ny*nx != weights.numDst():
+      WhfLog.warning("Cannot reorder weights %s, keeping native order",
+                     weights._wgtFile)
+      return weights
+   coo = weights._matrix.tocoo()
+   row = rge.tile_rows((ny, nx), tile)[coo.row]
+   nRows = -(-ny // tile)*-(-nx // tile)*tile*tile
+   # first use of each column in the new row order; unused columns last
+   byRow = np.argsort(row, kind='mergesort')
+   (used, first) = np.unique(coo.col[byRow], return_index=True)
+   colOrder = np.concatenate((used[np.argsort(first, kind='mergesort')],
+                              np.setdiff1d(np.arange(weights.numSrc()), used)))
+   newCol = np.empty(weights.numSrc(), dtype=np.int64)
+   newCol[colOrder] = np.arange(weights.numSrc())
+   matrix = sp.csr_matrix((coo.data, (row, newCol[coo.col])),
+                          shape=(nRows, weights.numSrc()))
+   return rge.RegridWeights(weights._wgtFile, matrix, weights._srcShape,
+                            weights._dstShape, weights.footprint(),
+                            tile, colOrder)
+
+#----------------------------------------------------------------------------
+def build(wgtFile, dstGridName, cacheDir, order='native'):
+   """Compile an ESMF weight file into a cache entry, if not already there
+
+   The entry is written to a temporary directory which is renamed into
+   place, so concurrent workers never see a partial entry.
+
+   Parameters
+   ----------
+   wgtFile: str
+      ESMF weight file
+   dstGridName: str
+      Destination grid file
+   cacheDir: str
+      Cache directory
+   order: str
+      Matrix ordering, one of WEIGHT_ORDERS
+
+   Returns
+   -------
+   str
+      The entry directory
+   """
+   entry = entry_dir(wgtFile, dstGridName, cacheDir, order)
+   if os.path.isdir(entry):
+      return entry
+   if not os.path.exists(cacheDir):
+      os.makedirs(cacheDir)
+
+   WhfLog.info("Compiling weights %s into %s", wgtFile, entry)
+   weights = rge.read_esmf_weights(wgtFile)
+   weights._matrix.sum_duplicates()
+   if order == 'tile':
+      weights = reorder(weights)
+   matrix = weights._matrix
+   tmpDir = tempfile.mkdtemp(dir=cacheDir, prefix='.build.')
+   try:
+      # scipy needs indptr and indices of the same type
+      if matrix.nnz < 2**31:
+         idxType = np.int32
+      else:
+         idxType = np.int64
+      np.save(os.path.join(tmpDir, 'indptr.npy'), matrix.indptr.astype(idxType))
+      np.save(os.path.join(tmpDir, 'indices.npy'), matrix.indices.astype(idxType))
+      np.save(os.path.join(tmpDir, 'data.npy'), matrix.data.astype(np.float32))
+      # matrix shape, source and destination grid shapes, source
+      # footprint, tile size (0 for rows in grid order)
+      shape = list(matrix.shape) + list(weights._srcShape) + \
+              list(weights._dstShape) + list(weights.footprint()) + \
+              [weights._tile or 0]
+      np.save(os.path.join(tmpDir, 'shape.npy'), np.array(shape, dtype=np.int64))
+      if weights._colOrder is not None:
+         # native integers, so take() needs no conversion
+         np.save(os.path.join(tmpDir, 'col_order.npy'),
+                 weights._colOrder.astype(np.intp))
+      try:
+         os.rename(tmpDir, entry)
+      except OSError:
+         # another worker got there first
+         if not os.path.isdir(entry):
+            raise
+   finally:
+      if os.path.isdir(tmpDir):
+         shutil.rmtree(tmpDir, ignore_errors=True)
+   _purge_stale(wgtFile, dstGridName, cacheDir, entry, order)
+   return entry
+
+#----------------------------------------------------------------------------
+def _save_in_entry(entry, name, values):
+   """Add an array to an existing entry, atomically"""
+   fd, tmpName = tempfile.mkstemp(dir=entry, prefix='.' + name, suffix='.npy')
+   os.close(fd)
+   np.save(tmpName, values)
+   os.rename(tmpName, os.path.join(entry, name + '.npy'))
+
+#----------------------------------------------------------------------------
+def build_gather(entry, weights):
+   """Add the 4-point gather form of the weights to an entry, if possible
+
+   Parameters
+   ----------
+   entry: str
+      Entry directory
+   weights: Regrid_Engine.RegridWeights
+      The entry's sparse matrix weights
+
+   Returns
+   -------
+   bool
+      True if the entry has gather arrays, False if the weights are not
+      4-point bilinear (recorded so it is not tried again)
+   """
+   if os.path.exists(os.path.join(entry, 'gather_index.npy')):
+      return True
+   if os.path.exists(os.path.join(entry, 'gather_none.npy')):
+      return False
+   gather = rge.gather_from_csr(weights)
+   if gather is None:
+      WhfLog.info("Weights %s are not 4-point bilinear, using sparse matrix",
+                  weights._wgtFile)
+      _save_in_entry(entry, 'gather_none', np.zeros(0))
+      return False
+   _save_in_entry(entry, 'gather_fy', gather._fy)
+   _save_in_entry(entry, 'gather_fx', gather._fx)
+   _save_in_entry(entry, 'gather_unmapped', gather._unmapped)
+   # written last, its presence marks the gather arrays complete
+   _save_in_entry(entry, 'gather_index', gather._index)
+   return True
+
+#----------------------------------------------------------------------------
+def build_transposed(entry, weights):
+   """Add the transposed weights used by the sparse kernel to an entry
+
+   Parameters
+   ----------
+   entry: str
+      Entry directory
+   weights: Regrid_Engine.RegridWeights
+      The entry's sparse matrix weights
+
+   Returns
+   -------
+   None
+   """
+   if os.path.exists(os.path.join(entry, 't_indptr.npy')):
+      return
+   (transposed, unmapped) = weights.transposed()
+   if transposed.nnz < 2**31:
+      idxType = np.int32
+   else:
+      idxType = np.int64
+   _save_in_entry(entry, 't_indices', transposed.indices.astype(idxType))
+   _save_in_entry(entry, 't_data', transposed.data.astype(np.float32))
+   _save_in_entry(entry, 't_unmapped', unmapped.astype(np.int64))
+   # written last, its presence marks the transposed arrays complete
+   _save_in_entry(entry, 't_indptr', transposed.indptr.astype(idxType))
+
+#----------------------------------------------------------------------------
+def load(wgtFile, dstGridName, cacheDir, kernel='csr', order='native'):
+   """Memory map the compiled weights, building the entry if needed
+
+   Parameters
+   ----------
+   wgtFile: str
+      ESMF weight file
+   dstGridName: str
+      Destination grid file
+   cacheDir: str
+      Cache directory
+   kernel: str
+      'csr' for the sparse matrix, 'gather' for the 4-point gather form,
+      'sparse' for the sparse matrix and its transpose
+   order: str
+      Matrix ordering, one of WEIGHT_ORDERS
+
+   Returns
+   -------
+   Regrid_Engine.RegridWeights or Regrid_Engine.GatherWeights
+   """
+   entry = build(wgtFile, dstGridName, cacheDir, order)
+   arrays = {}
+   for name in _ARRAYS:
+      arrays[name] = np.load(os.path.join(entry, name + '.npy'), mmap_mode='r')
+   colOrder = None
+   if os.path.exists(os.path.join(entry, 'col_order.npy')):
+      colOrder = np.load(os.path.join(entry, 'col_order.npy'), mmap_mode='r')
+   shape = [int(s) for s in arrays['shape']]
+   matrix = sp.csr_matrix((arrays['data'], arrays['indices'], arrays['indptr']),
+                          shape=(shape[0], shape[1]), copy=False)
+   weights = rge.RegridWeights(wgtFile, matrix, shape[2:4], shape[4:6], shape[6:10],
+                               shape[10] or None, colOrder)
+   if kernel == 'gather' and build_gather(entry, weights):
+      for name in ['gather_index', 'gather_fy', 'gather_fx', 'gather_unmapped']:
+         arrays[name] = np.load(os.path.join(entry, name + '.npy'), mmap_mode='r')
+      weights = rge.GatherWeights(wgtFile, arrays['gather_index'], arrays['gather_fy'],
+                                  arrays['gather_fx'], arrays['gather_unmapped'],
+                                  shape[2:4], shape[4:6], shape[6:10])
+   if kernel == 'sparse':
+      build_transposed(entry, weights)
+      for name in ['t_indptr', 't_indices', 't_data', 't_unmapped']:
+         arrays[name] = np.load(os.path.join(entry, name + '.npy'), mmap_mode='r')
+      nDst = shape[4]*shape[5]
+      transposed = sp.csr_matrix((arrays['t_data'], arrays['t_indices'],
+                                  arrays['t_indptr']),
+                                 shape=(shape[1], nDst), copy=False)
+      weights._transposed = (transposed, arrays['t_unmapped'])
+   WhfLog.debug("Memory mapped weights for %s from %s", wgtFile, entry)
+   return weights
+
+#----------------------------------------------------------------------------
+def get_cache_dir(parser):
+   """Weight cache directory from the [regridding] section, None if not set"""
+   if parser.has_option('regridding', 'weight_cache_dir'):
+      cacheDir = parser.get('regridding', 'weight_cache_dir').strip()
+      if cacheDir:
+         return cacheDir
+   return None
+
+#----------------------------------------------------------------------------
+def get_weight_order(parser):
+   """Weight matrix ordering from the [regridding] section, default 'native'"""
+   if not parser.has_option('regridding', 'weight_order'):
+      return 'native'
+   order = parser.get('regridding', 'weight_order').strip().lower()
+   if order not in WEIGHT_ORDERS:
+      WhfLog.error("Unrecognized weight order %s", order)
+      raise UnrecognizedCommandError('Unrecognized weight order %s'%order)
+   return order
+
+#----------------------------------------------------------------------------
+def main(argv):
+   """Compile the weights of every product configured in a config file
+
+   Parameters
+   ----------
+   argv: list
+      [config file]
+
+   Returns
+   -------
+   1 for error, 0 for success
+   """
+   if len(argv) != 1 or not os.path.exists(argv[0]):
+      print 'Usage: python Weight_Cache.py <config file>'
+      return 1
+   parser = SafeConfigParser()
+   parser.read(argv[0])
+   cacheDir = get_cache_dir(parser)
+   if cacheDir is None:
+      print 'ERROR weight_cache_dir not set in [regridding] of', argv[0]
+      return 1
+   order = get_weight_order(parser)
+   for product in rge.SUPPORTED_PRODUCTS:
+      wgtFile = parser.get('regridding', product + '_wgt_bilinear')
+      dstGridName = parser.get('regridding', product + '_dst_grid_name')
+      print product, build(wgtFile, dstGridName, cacheDir, order)
+   return 0
+
+#----------------------------------------------
+
+if __name__ == "__main__":
+   sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,432 @@
+"""Weight_Generator
+Generates bilinear regridding weights from a source grid to a WRF-Hydro
+destination grid (geo_dst.nc XLAT_M/XLONG_M) without ESMF.  The weights
+are written in the ESMF weight file layout (row/col/S, src_grid_dims,
+dst_grid_dims, ...) read by the NCL regridding scripts and by
+Regrid_Engine, so a new domain or source grid only needs:
+
+   python Weight_Generator.py <config file> <product> <source file> [weight file]
+
+where <source file> is any input file of the product (GRIB2, or netCDF
+with lat/lon variables).  The weight file defaults to
+<product>_wgt_bilinear in the [regridding] section, which is only
+written if it does not exist yet.
+
+Regular latitude-longitude sources (GFS, MRMS) are located by direct
+index arithmetic.  Curvilinear sources (HRRR, RAP Lambert conformal)
+use a KD-tree of the source points on the unit sphere to find the
+nearest source point, then invert the bilinear map of the surrounding
+cells in a plane tangent to each destination point.
+"""
+
+import os
+import sys
+import time
+import numpy as np
+from scipy.spatial import cKDTree
+from netCDF4 import Dataset
+from ConfigParser import SafeConfigParser
+import WhfLog
+from ForcingEngineError import MissingFileError
+from ForcingEngineError import RegridError
+
+# Destination points processed at a time (bounds the memory used)
+CHUNK_SIZE = 1000000
+
+# Tolerance on the bilinear cell coordinates, for points on cell edges
+_EDGE_TOLERANCE = 1.0e-6
+
+# Newton iterations used to invert the bilinear map of a cell
+_NEWTON_ITERATIONS = 8
+
+# Latitude/longitude variable names looked for in netCDF source files
+_NETCDF_LATLON_NAMES = [('XLAT_M', 'XLONG_M'), ('gridlat_0', 'gridlon_0'),
+                        ('lat_0', 'lon_0'), ('latitude', 'longitude'),
+                        ('lat', 'lon')]
+
+#----------------------------------------------------------------------------
+def _to_xyz(lat, lon):
+   """Unit sphere cartesian coordinates, last axis x, y, z"""
+   rlat = np.radians(lat)
+   rlon = np.radians(lon)
+   return np.stack([np.cos(rlat)*np.cos(rlon), np.cos(rlat)*np.sin(rlon),
+                    np.sin(rlat)], axis=-1)
+
+#----------------------------------------------------------------------------
+def read_source_coords(srcFile):
+   """Read the latitude/longitude of the source grid cell centers
+
+   Parameters
+   ----------
+   srcFile: str
+      GRIB2 file (first message's grid is used) or netCDF file
+
+   Returns
+   -------
+   tuple
+      (lat, lon), 2-d (ny, nx) arrays in degrees
+   """
+   if not os.path.exists(srcFile):
+      WhfLog.error('File: ' + srcFile + ' not found.')
+      raise MissingFileError('File %s not found'%srcFile)
+   if srcFile.endswith(('grib', 'grb', 'grib2', 'grb2')):
+      import pygrib
+      grbs = pygrib.open(srcFile)
+      try:
+         (lat, lon) = grbs.message(1).latlons()
+      finally:
+         grbs.close()
+      return (np.asarray(lat, dtype=np.float64), np.asarray(lon, dtype=np.float64))
+
+   nc = Dataset(srcFile, 'r')
+   try:
+      for (latName, lonName) in _NETCDF_LATLON_NAMES:
+         if latName in nc.variables and lonName in nc.variables:
+            lat = np.squeeze(nc.variables[latName][:]).astype(np.float64)
+            lon = np.squeeze(nc.variables[lonName][:]).astype(np.float64)
+            break
+      else:
+         raise RegridError('No latitude/longitude variables in %s'%srcFile)
+   finally:
+      nc.close()
+   if lat.ndim == 1:
+      (lon, lat) = np.meshgrid(lon, lat)
+   return (lat, lon)
+
+#----------------------------------------------------------------------------
+def read_destination_coords(dstGridName):
+   """Read XLAT_M/XLONG_M from a WRF-Hydro geo file
+
+   Returns
+   -------
+   tuple
+      (lat, lon), 2-d (ny, nx) arrays in degrees
+   """
+   if not os.path.exists(dstGridName):
+      WhfLog.error('File: ' + dstGridName + ' not found.')
+      raise MissingFileError('File %s not found'%dstGridName)
+   nc = Dataset(dstGridName, 'r')
+   try:
+      lat = np.asarray(nc.variables['XLAT_M'][0, :, :], dtype=np.float64)
+      lon = np.asarray(nc.variables['XLONG_M'][0, :, :], dtype=np.float64)
+   finally:
+      nc.close()
+   return (lat, lon)
+
+#----------------------------------------------------------------------------
+def _is_rectilinear(lat, lon):
+   """True if latitude varies only along rows and longitude only along
+   columns, with constant spacing"""
+   if lat.shape[0] < 2 or lat.shape[1] < 2:
+      return False
+   if not (np.allclose(lat, lat[:, :1]) and np.allclose(lon, lon[:1, :])):
+      return False
+   dlat = np.diff(lat[:, 0])
+   dlon = np.diff(lon[0, :])
+   return np.allclose(dlat, dlat[0]) and np.allclose(dlon, dlon[0]) and \
+          dlat[0] != 0.0 and dlon[0] != 0.0
+
+#----------------------------------------------------------------------------
+def _rectilinear_corners(srcLat, srcLon, dstLat, dstLon):
+   """Corner index and fractions on a regular latitude-longitude grid
+
+   Returns
+   -------
+   tuple
+      (j, i, fy, fx, valid, periodic) as for bilinear_corners
+   """
+   (ny, nx) = srcLat.shape
+   lat0 = srcLat[0, 0]
+   dlat = srcLat[1, 0] - lat0
+   lon0 = srcLon[0, 0]
+   dlon = srcLon[0, 1] - lon0
+   periodic = abs(abs(dlon)*nx - 360.0) < 0.5*abs(dlon)
+
+   y = (dstLat - lat0)/dlat
+   # longitudes measured from the first source column, in its direction
+   if dlon > 0.0:
+      x = np.mod(dstLon - lon0, 360.0)/dlon
+   else:
+      x = np.mod(lon0 - dstLon, 360.0)/(-dlon)
+   j = np.floor(y).astype(np.int64)
+   i = np.floor(x).astype(np.int64)
+   fy = y - j
+   fx = x - i
+   # points exactly on the last row/column use the cell before it
+   onEdge = (j == ny - 1) & (fy < _EDGE_TOLERANCE)
+   j = np.where(onEdge, ny - 2, j)
+   fy = np.where(onEdge, 1.0, fy)
+   imax = nx - 1
+   if not periodic:
+      onEdge = (i == nx - 1) & (fx < _EDGE_TOLERANCE)
+      i = np.where(onEdge, nx - 2, i)
+      fx = np.where(onEdge, 1.0, fx)
+      imax = nx - 2
+   valid = (j >= 0) & (j <= ny - 2) & (i >= 0) & (i <= imax)
+   return (j, i, fy, fx, valid, periodic)
+
+#----------------------------------------------------------------------------
+def _inverse_bilinear(px, py):
+   """Solve for the cell coordinates of the origin in quadrilaterals
+
+   Parameters
+   ----------
+   px, py: numpy.ndarray
+      (n, 4) corner coordinates, corners ordered (j,i), (j,i+1),
+      (j+1,i), (j+1,i+1), relative to the point being located
+
+   Returns
+   -------
+   tuple
+      (t, s) row and column direction cell coordinates, inside the
+      cell when both are in [0, 1]
+   """
+   ax = px[:, 0]
+   ay = py[:, 0]
+   bx = px[:, 1] - px[:, 0]
+   by = py[:, 1] - py[:, 0]
+   cx = px[:, 2] - px[:, 0]
+   cy = py[:, 2] - py[:, 0]
+   dx = px[:, 3] - px[:, 2] - px[:, 1] + px[:, 0]
+   dy = py[:, 3] - py[:, 2] - py[:, 1] + py[:, 0]
+   s = np.full(ax.shape, 0.5)
+   t = np.full(ax.shape, 0.5)
+   with np.errstate(divide='ignore', invalid='ignore'):
+      for it in range(_NEWTON_ITERATIONS):
+         fx = ax + bx*s + cx*t + dx*s*t
+         fy = ay + by*s + cy*t + dy*s*t
+         j11 = bx + dx*t
+         j12 = cx + dx*s
+         j21 = by + dy*t
+         j22 = cy + dy*s
+         det = j11*j22 - j12*j21
+         s = s - (j22*fx - j12*fy)/det
+         t = t - (j11*fy - j21*fx)/det
+   return (t, s)
+
+#----------------------------------------------------------------------------
+def _curvilinear_corners(srcLat, srcLon, dstLat, dstLon):
+   """Corner index and fractions on a logically rectangular grid
+
+   Returns
+   -------
+   tuple
+      (j, i, fy, fx, valid, periodic) as for bilinear_corners
+   """
+   (ny, nx) = srcLat.shape
+   srcXyz = _to_xyz(srcLat, srcLon).reshape(-1, 3)
+   start = time.time()
+   tree = cKDTree(srcXyz)
+   WhfLog.debug("Time(sec) to build KD-tree of %d source points: %s",
+                srcXyz.shape[0], time.time() - start)
+
+   n = dstLat.size
+   dLat = dstLat.reshape(-1)
+   dLon = dstLon.reshape(-1)
+   jOut = np.zeros(n, dtype=np.int64)
+   iOut = np.zeros(n, dtype=np.int64)
+   fyOut = np.zeros(n)
+   fxOut = np.zeros(n)
+   validOut = np.zeros(n, dtype=bool)
+   for c0 in range(0, n, CHUNK_SIZE):
+      c1 = min(n, c0 + CHUNK_SIZE)
+      q = _to_xyz(dLat[c0:c1], dLon[c0:c1])
+      try:
+         (dist, nearest) = tree.query(q, n_jobs=-1)
+      except TypeError:
+         (dist, nearest) = tree.query(q, workers=-1)
+      (jn, inear) = np.divmod(nearest, nx)
+
+      # tangent plane basis at each destination point
+      rlat = np.radians(dLat[c0:c1])
+      rlon = np.radians(dLon[c0:c1])
+      east = np.stack([-np.sin(rlon), np.cos(rlon), np.zeros(rlon.shape)], axis=-1)
+      north = np.stack([-np.sin(rlat)*np.cos(rlon), -np.sin(rlat)*np.sin(rlon),
+                        np.cos(rlat)], axis=-1)
+
+      found = np.zeros(c1 - c0, dtype=bool)
+      # the point lies in one of the four cells around the nearest source point
+      for (oj, oi) in [(0, 0), (-1, 0), (0, -1), (-1, -1)]:
+         cj = np.clip(jn + oj, 0, ny - 2)
+         ci = np.clip(inear + oi, 0, nx - 2)
+         corners = [cj*nx + ci, cj*nx + ci + 1, (cj + 1)*nx + ci, (cj + 1)*nx + ci + 1]
+         pts = np.stack([srcXyz[k] for k in corners], axis=1)
+         px = np.einsum('nkc,nc->nk', pts, east)
+         py = np.einsum('nkc,nc->nk', pts, north)
+         (t, s) = _inverse_bilinear(px, py)
+         inside = (~found) & (s >= -_EDGE_TOLERANCE) & (s <= 1.0 + _EDGE_TOLERANCE) & \
+                  (t >= -_EDGE_TOLERANCE) & (t <= 1.0 + _EDGE_TOLERANCE)
+         idx = c0 + np.nonzero(inside)[0]
+         jOut[idx] = cj[inside]
+         iOut[idx] = ci[inside]
+         fyOut[idx] = np.clip(t[inside], 0.0, 1.0)
+         fxOut[idx] = np.clip(s[inside], 0.0, 1.0)
+         validOut[idx] = True
+         found |= inside
+   shape = dstLat.shape
+   return (jOut.reshape(shape), iOut.reshape(shape), fyOut.reshape(shape),
+           fxOut.reshape(shape), validOut.reshape(shape), False)
+
+#----------------------------------------------------------------------------
+def bilinear_corners(srcLat, srcLon, dstLat, dstLon):
+   """Locate each destination point in the source grid
+
+   Parameters
+   ----------
+   srcLat, srcLon: numpy.ndarray
+      (ny, nx) source grid cell center coordinates, degrees
+   dstLat, dstLon: numpy.ndarray
+      Destination point coordinates, degrees
+
+   Returns
+   -------
+   tuple
+      (j, i, fy, fx, valid, periodic): lower-left corner (j, i) of the
+      source cell holding each destination point, fractional offsets
+      in the row (fy) and column (fx) directions, True where the point
+      lies in the source grid, and True if the source grid wraps around
+      in longitude (corner i+1 is then taken modulo nx)
+   """
+   if _is_rectilinear(srcLat, srcLon):
+      WhfLog.debug("Source grid is regular latitude-longitude")
+      return _rectilinear_corners(srcLat, srcLon, dstLat, dstLon)
+   return _curvilinear_corners(srcLat, srcLon, dstLat, dstLon)
+
+#----------------------------------------------------------------------------
+def corners_to_triplets(j, i, fy, fx, valid, srcShape, periodic):
+   """Convert corner indices and fractions to ESMF row/col/S triplets
+
+   Returns
+   -------
+   tuple
+      (row, col, S), 1-based row (destination) and col (source) indices
+   """
+   (ny, nx) = srcShape
+   dst = np.nonzero(valid.reshape(-1))[0]
+   j = j.reshape(-1)[dst]
+   i = i.reshape(-1)[dst]
+   fy = fy.reshape(-1)[dst]
+   fx = fx.reshape(-1)[dst]
+   i1 = i + 1
+   if periodic:
+      i1 = np.mod(i1, nx)
+   cols = [j*nx + i, j*nx + i1, (j + 1)*nx + i, (j + 1)*nx + i1]
+   wgts = [(1.0 - fy)*(1.0 - fx), (1.0 - fy)*fx, fy*(1.0 - fx), fy*fx]
+   row = np.tile(dst, 4)
+   col = np.concatenate(cols)
+   S = np.concatenate(wgts)
+   # drop zero weights (points on cell edges), order by destination
+   keep = S != 0.0
+   order = np.argsort(row[keep], kind='mergesort')
+   return ((row[keep][order] + 1).astype(np.int32),
+           (col[keep][order] + 1).astype(np.int32), S[keep][order])
+
+#----------------------------------------------------------------------------
+def write_esmf_weights(wgtFile, row, col, S, srcLat, srcLon, dstLat, dstLon):
+   """Write weights in the ESMF weight file layout
+
+   Parameters
+   ----------
+   wgtFile: str
+      Output weight file
+   row, col, S: numpy.ndarray
+      1-based destination/source indices and weights
+   srcLat, srcLon, dstLat, dstLon: numpy.ndarray
+      (ny, nx) grid coordinates
+
+   Returns
+   -------
+   None
+   """
+   nc = Dataset(wgtFile, 'w', format='NETCDF3_64BIT_OFFSET')
+   try:
+      nc.title = 'WRF-Hydro forcing engine bilinear weights'
+      nc.normalization = 'destarea'
+      nc.map_method = 'Bilinear remapping'
+      nc.conventions = 'NCAR-CSM'
+      nc.createDimension('n_a', srcLat.size)
+      nc.createDimension('n_b', dstLat.size)
+      nc.createDimension('n_s', S.size)
+      nc.createDimension('src_grid_rank', 2)
+      nc.createDimension('dst_grid_rank', 2)
+      # grid dims are stored Fortran order (nx, ny)
+      nc.createVariable('src_grid_dims', 'i4', ('src_grid_rank',))[:] = \
+         [srcLat.shape[1], srcLat.shape[0]]
+      nc.createVariable('dst_grid_dims', 'i4', ('dst_grid_rank',))[:] = \
+         [dstLat.shape[1], dstLat.shape[0]]
+      for (name, dim, values) in [('yc_a', 'n_a', srcLat), ('xc_a', 'n_a', srcLon),
+                                  ('yc_b', 'n_b', dstLat), ('xc_b', 'n_b', dstLon)]:
+         var = nc.createVariable(name, 'f8', (dim,))
+         var.units = 'degrees'
+         var[:] = values.reshape(-1)
+      nc.createVariable('mask_a', 'i4', ('n_a',))[:] = np.ones(srcLat.size, dtype=np.int32)
+      nc.createVariable('mask_b', 'i4', ('n_b',))[:] = np.ones(dstLat.size, dtype=np.int32)
+      frac = np.zeros(dstLat.size)
+      frac[row - 1] = 1.0
+      nc.createVariable('frac_b', 'f8', ('n_b',))[:] = frac
+      nc.createVariable('row', 'i4', ('n_s',))[:] = row
+      nc.createVariable('col', 'i4', ('n_s',))[:] = col
+      nc.createVariable('S', 'f8', ('n_s',))[:] = S
+   finally:
+      nc.close()
+
+#----------------------------------------------------------------------------
+def generate(srcFile, dstGridName, wgtFile):
+   """Generate a bilinear weight file
+
+   Parameters
+   ----------
+   srcFile: str
+      An input file on the source grid
+   dstGridName: str
+      Destination grid (geo_dst.nc) file
+   wgtFile: str
+      Weight file to write
+
+   Returns
+   -------
+   None
+   """
+   start = time.time()
+   (srcLat, srcLon) = read_source_coords(srcFile)
+   (dstLat, dstLon) = read_destination_coords(dstGridName)
+   (j, i, fy, fx, valid, periodic) = bilinear_corners(srcLat, srcLon, dstLat, dstLon)
+   (row, col, S) = corners_to_triplets(j, i, fy, fx, valid, srcLat.shape, periodic)
+   write_esmf_weights(wgtFile, row, col, S, srcLat, srcLon, dstLat, dstLon)
+   WhfLog.info("Time(sec) to generate %s: %s, %d of %d destination points mapped",
+               wgtFile, time.time() - start, int(valid.sum()), valid.size)
+
+#----------------------------------------------------------------------------
+def main(argv):
+   """Generate the weights of one product configured in a config file
+
+   Parameters
+   ----------
+   argv: list
+      [config file, product, source file, (optional) weight file]
+
+   Returns
+   -------
+   1 for error, 0 for success
+   """
+   if len(argv) not in [3, 4] or not os.path.exists(argv[0]):
+      print 'Usage: python Weight_Generator.py <config file> <product> <source file> [weight file]'
+      return 1
+   parser = SafeConfigParser()
+   parser.read(argv[0])
+   product = argv[1].upper()
+   dstGridName = parser.get('regridding', product + '_dst_grid_name')
+   if len(argv) == 4:
+      wgtFile = argv[3]
+   else:
+      wgtFile = parser.get('regridding', product + '_wgt_bilinear')
+      if os.path.exists(wgtFile):
+         print 'ERROR', wgtFile, 'exists, give the weight file to write explicitly'
+         return 1
+   generate(argv[2], dstGridName, wgtFile)
+   return 0
+
+#----------------------------------------------
+
+if __name__ == "__main__":
+   sys.exit(main(sys.argv[1:]))